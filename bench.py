@@ -0,0 +1,324 @@
+"""Нагрузочный тест бота без Telegram.
+
+Поднимает локальную заглушку Bot API, направляет на нее бота через
+TELEGRAM_API_URL и прогоняет через dp.feed_update синтетические апдейты:
+регистрацию, выбор курса, отправку решений и проверку админом.
+
+Запуск:
+    python bench.py --users 200 --concurrency 50 --output bench.json
+    python bench.py --compare bench.json --threshold 0.2   # код 1 при регрессии
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from aiohttp import web
+
+TOKEN = "123456:BENCHMARK"
+ADMIN_ID = 1
+USER_ID_BASE = 10_000
+
+# Методы Bot API, которые возвращают Message
+MESSAGE_METHODS = {
+    "sendmessage", "sendphoto", "senddocument", "editmessagetext",
+    "editmessagereplymarkup", "editmessagecaption", "copymessage", "forwardmessage",
+}
+
+
+class StubBotAPI:
+    """Заглушка Bot API: отвечает правдоподобными объектами и считает вызовы."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls: Dict[str, int] = {}
+        self._message_ids = itertools.count(1)
+        self._runner = None
+        self.url = None
+
+    def _message(self, chat_id) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id or ADMIN_ID), "type": "private"},
+            "text": "ok",
+        }
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"].lower()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        payload = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == "getme":
+            result = {"id": 42, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "sendmediagroup":
+            result = [self._message(payload.get("chat_id"))]
+        elif method in MESSAGE_METHODS:
+            result = self._message(payload.get("chat_id"))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+
+class UpdateFactory:
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    def message(self, user_id: int, text: str) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self._update_ids), "message": message}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "from": self._user(user_id),
+                "chat_instance": "bench",
+                "data": data,
+                "message": {
+                    "message_id": next(self._message_ids),
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "text": "menu",
+                },
+            },
+        }
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = {}
+
+    def add(self, phase: str, seconds: float):
+        self.latencies.setdefault(phase, []).append(seconds)
+
+    @staticmethod
+    def summary(values: List[float]) -> dict:
+        ordered = sorted(values)
+
+        def pct(p):
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 3)
+
+        return {
+            "count": len(ordered),
+            "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+            "p50_ms": pct(0.50),
+            "p95_ms": pct(0.95),
+            "p99_ms": pct(0.99),
+            "max_ms": round(ordered[-1] * 1000, 3),
+        }
+
+
+async def run_benchmark(args) -> dict:
+    stub = StubBotAPI(latency=args.api_latency / 1000)
+    await stub.start()
+
+    workdir = tempfile.mkdtemp(prefix="xcourses-bench-")
+    os.environ.update({
+        "TOKEN": TOKEN,
+        "ADMIN_ID": str(ADMIN_ID),
+        "DATABASE_NAME": os.path.join(workdir, "bench.db"),
+        "TELEGRAM_API_URL": stub.url,
+        "BOT_MODE": "polling",
+        # Счетчик SQL-запросов берется из метрик; HTTP-эндпоинт на случайном порту
+        "METRICS_ENABLED": "1",
+        "METRICS_PORT": "0",
+        # Измеряем сам бот, а не лимиты Telegram
+        "SEND_RATE": str(args.send_rate),
+        "SEND_CHAT_INTERVAL": "0",
+        # Сценарий шлет апдейты быстрее живого пользователя — антифлуд их бы отбрасывал
+        "THROTTLE_RATE": "1000",
+        "THROTTLE_BURST": "1000",
+    })
+    import xcoursestbot as app
+    from aiogram.types import Update
+
+    factory = UpdateFactory()
+    recorder = Recorder()
+
+    async def feed(phase: str, raw: dict):
+        update = Update.model_validate(raw, context={"bot": app.bot})
+        start = time.perf_counter()
+        await app.dp.feed_update(app.bot, update)
+        recorder.add(phase, time.perf_counter() - start)
+
+    app.init_db()
+    await app.dp.emit_startup(bot=app.bot, dispatcher=app.dp)
+
+    # Каталог: курс → модуль → задания (не входит в замер)
+    await feed("setup", factory.message(ADMIN_ID, "📝 Добавить курс"))
+    await feed("setup", factory.message(ADMIN_ID, "Бенчмарк"))
+    await feed("setup", factory.message(ADMIN_ID, "Курс для нагрузочного теста"))
+    await feed("setup", factory.message(ADMIN_ID, "/skip"))
+    course_id = (await app.db.fetchone("SELECT MAX(course_id) FROM courses"))[0]
+    await feed("setup", factory.callback(ADMIN_ID, app.AddModuleCb(course_id=course_id).pack()))
+    await feed("setup", factory.message(ADMIN_ID, "Модуль 1"))
+    module_id = (await app.db.fetchone("SELECT MAX(module_id) FROM modules"))[0]
+    for n in range(args.tasks):
+        await feed("setup", factory.callback(ADMIN_ID, app.AddTaskCourseCb(course_id=course_id).pack()))
+        await feed("setup", factory.callback(ADMIN_ID, app.AddTaskModuleCb(module_id=module_id).pack()))
+        await feed("setup", factory.message(ADMIN_ID, f"Задание {n + 1}"))
+        await feed("setup", factory.message(ADMIN_ID, "Условие задания"))
+        await feed("setup", factory.message(ADMIN_ID, "/skip"))
+    task_ids = [row[0] for row in await app.db.fetchall(
+        "SELECT task_id FROM tasks WHERE module_id = ? ORDER BY task_id", (module_id,))]
+    await app.outbox.close(args.drain_timeout)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    users = [USER_ID_BASE + n for n in range(args.users)]
+
+    async def student(user_id: int):
+        task_id = task_ids[user_id % len(task_ids)]
+        async with semaphore:
+            await feed("registration", factory.message(user_id, "/start"))
+            await feed("registration", factory.message(user_id, f"Студент Номер{user_id}"))
+            await feed("browsing", factory.message(user_id, "📚 Выбрать курс"))
+            await feed("browsing", factory.callback(user_id, "select_course"))
+            await feed("browsing", factory.callback(user_id, app.CourseCb(course_id=course_id).pack()))
+            await feed("browsing", factory.callback(user_id, app.ModuleCb(module_id=module_id).pack()))
+            await feed("submission", factory.callback(user_id, app.TaskCb(task_id=task_id).pack()))
+            await feed("submission", factory.message(user_id, f"Решение пользователя {user_id}"))
+
+    async def review(user_id: int):
+        task_id = task_ids[user_id % len(task_ids)]
+        action = "accept" if user_id % 3 else "reject"
+        async with semaphore:
+            await feed("review", factory.callback(
+                ADMIN_ID, app.ReviewCb(action=action, task_id=task_id, user_id=user_id).pack()))
+
+    db_ops_before = app.DB_QUERY_SECONDS.total_count()
+    started = time.perf_counter()
+    await asyncio.gather(*(student(user_id) for user_id in users))
+    await asyncio.gather(*(review(user_id) for user_id in users))
+    processed = time.perf_counter() - started
+    # Уведомления уходят через очередь — ждем, пока она опустеет
+    await app.outbox.close(args.drain_timeout)
+    elapsed = time.perf_counter() - started
+    db_ops = app.DB_QUERY_SECONDS.total_count() - db_ops_before
+
+    await app.dp.emit_shutdown(bot=app.bot, dispatcher=app.dp)
+    await app.bot.session.close()
+    app.db.close()
+    app.db_pool.close()
+    await stub.stop()
+
+    measured = [v for phase, values in recorder.latencies.items() if phase != "setup" for v in values]
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "users": args.users,
+            "tasks": args.tasks,
+            "concurrency": args.concurrency,
+            "api_latency_ms": args.api_latency,
+        },
+        "updates": len(measured),
+        "processing_seconds": round(processed, 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "updates_per_sec": round(len(measured) / processed, 1),
+        "db_ops_per_update": round(db_ops / len(measured), 2),
+        "api_calls": dict(sorted(stub.calls.items())),
+        "latency": Recorder.summary(measured),
+        "phases": {
+            phase: Recorder.summary(values)
+            for phase, values in recorder.latencies.items() if phase != "setup"
+        },
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> List[str]:
+    """Возвращает список регрессий относительно baseline."""
+    regressions = []
+    checks = [
+        ("updates_per_sec", current["updates_per_sec"], baseline["updates_per_sec"], True),
+        ("db_ops_per_update", current["db_ops_per_update"], baseline["db_ops_per_update"], False),
+    ]
+    for key in ("p50_ms", "p95_ms", "p99_ms"):
+        checks.append((f"latency.{key}", current["latency"][key], baseline["latency"][key], False))
+
+    print(f"{'метрика':<22}{'baseline':>12}{'текущее':>12}{'изменение':>12}")
+    for name, now, before, higher_is_better in checks:
+        change = (now - before) / before if before else 0.0
+        print(f"{name:<22}{before:>12}{now:>12}{change:>+11.1%}")
+        worse = -change if higher_is_better else change
+        if worse > threshold:
+            regressions.append(f"{name}: {before} → {now} ({change:+.1%})")
+    return regressions
+
+
+def print_report(result: dict):
+    print(f"Апдейтов: {result['updates']} за {result['processing_seconds']} с "
+          f"({result['updates_per_sec']} upd/s), SQL-запросов на апдейт: {result['db_ops_per_update']}")
+    print(f"{'фаза':<14}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    rows = dict(result["phases"], total=result["latency"])
+    for phase, stats in rows.items():
+        print(f"{phase:<14}{stats['count']:>8}{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест xcoursesbot на заглушке Bot API")
+    parser.add_argument("--users", type=int, default=200, help="число синтетических студентов")
+    parser.add_argument("--tasks", type=int, default=5, help="число заданий в модуле")
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременно активных студентов")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="задержка заглушки Bot API, мс")
+    parser.add_argument("--send-rate", type=float, default=10000, help="SEND_RATE: общий лимит очереди отправки и прямых ответов")
+    parser.add_argument("--drain-timeout", type=float, default=60, help="ожидание очереди отправки, с")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    parser.add_argument("--compare", help="JSON с прошлым прогоном для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимое ухудшение (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    result = asyncio.run(run_benchmark(args))
+    print_report(result)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.threshold)
+        if regressions:
+            print("Регрессии:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+import asyncio
+import importlib
+import itertools
+import json
+import os
+import sqlite3
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+import pytest
+from aiogram.client.session.base import BaseSession
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+@pytest.fixture(scope="session")
+def loop():
+    # Очереди и блокировки бота привязываются к первому циклу, в котором их использовали
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def run(loop):
+    return loop.run_until_complete
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    # Модуль бота читает настройки при импорте: временная БД и фиктивный токен
+    os.environ.setdefault("TOKEN", "123456:TEST")
+    os.environ.setdefault("ADMIN_ID", "1")
+    os.environ["DATABASE_NAME"] = str(tmp_path_factory.mktemp("db") / "bot.db")
+    module = importlib.import_module("xcoursestbot")
+    module.init_db()
+    yield module
+    module.db_pool.close()
+
+
+@pytest.fixture
+def migrated_db(app, tmp_path):
+    """Отдельная БД со всеми миграциями: для проверок триггеров на чистых данных."""
+    conn = sqlite3.connect(tmp_path / "migrated.db")
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys = ON")
+    app.run_migrations(conn)
+    yield conn
+    conn.close()
+
+
+class FakeSession(BaseSession):
+    """Сессия бота без сети: запоминает вызовы Bot API и отвечает успехом."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+        self._ids = itertools.count(1000)
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls.append(method)
+        chat_id = getattr(method, "chat_id", None) or 1
+        message = {
+            "message_id": next(self._ids), "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"}, "text": "ok"
+        }
+        result = message if type(method).__name__.startswith(("Send", "Edit")) else True
+        return self.check_response(bot, method, 200, json.dumps({"ok": True, "result": result})).result
+
+
+@pytest.fixture
+def bot_api(app):
+    session = FakeSession()
+    # Middleware сессии (метрики, подтверждение callback) переносятся в подмену
+    session.middleware = app.bot.session.middleware
+    original, app.bot.session = app.bot.session, session
+    yield session
+    app.bot.session = original
+
+
+async def settle(app):
+    """Дожидается обработки апдейтов, сборки альбомов и отправки исходящих."""
+    await app.update_scheduler.drain(5)
+    await app.albums.close()
+    await app.outbox.close(5)
+
+
+_update_ids = itertools.count(1)
+
+
+def make_message(app, user_id: int, text: Optional[str], **fields):
+    from aiogram.types import Update
+
+    message = {
+        "message_id": next(_update_ids), "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+    }
+    if text is not None:
+        message["text"] = text
+    if text and text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    message.update(fields)
+    return Update.model_validate({"update_id": next(_update_ids), "message": message}, context={"bot": app.bot})
+
+
+def make_callback(app, user_id: int, data: str):
+    from aiogram.types import Update
+
+    callback = {
+        "id": str(next(_update_ids)), "chat_instance": "test", "data": data,
+        "from": {"id": user_id, "is_bot": False, "first_name": "Test"},
+        "message": {
+            "message_id": next(_update_ids), "date": int(time.time()), "text": "menu",
+            "chat": {"id": user_id, "type": "private"},
+        },
+    }
+    return Update.model_validate({"update_id": next(_update_ids), "callback_query": callback}, context={"bot": app.bot})
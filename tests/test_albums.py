@@ -0,0 +1,44 @@
+from conftest import make_message, settle
+
+
+def _setup_task(app, user_id):
+    conn = app.db_pool.acquire()
+    try:
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO users (user_id, full_name) VALUES (?, ?)", (user_id, "Альбом Тестов"))
+            course_id = conn.execute("INSERT INTO courses (title) VALUES ('Альбомы')").lastrowid
+            module_id = conn.execute("INSERT INTO modules (course_id, title) VALUES (?, 'М1')", (course_id,)).lastrowid
+            task_id = conn.execute(
+                "INSERT INTO tasks (module_id, title, content) VALUES (?, 'З1', 'текст')", (module_id,)
+            ).lastrowid
+        app.catalog.load(conn.cursor())
+    finally:
+        app.db_pool.release(conn)
+    return task_id
+
+
+def _photo(app, user_id, file_id):
+    return make_message(app, user_id, None, media_group_id="album-1",
+                        photo=[{"file_id": file_id, "file_unique_id": file_id, "width": 1, "height": 1}])
+
+
+def test_text_after_album_does_not_lose_album(app, bot_api, run):
+    user_id = 5002
+    task_id = _setup_task(app, user_id)
+    key = app.StorageKey(bot_id=app.bot.id, chat_id=user_id, user_id=user_id)
+
+    async def scenario():
+        await app.fsm_storage.set_state(key, app.TaskStates.waiting_for_solution)
+        await app.fsm_storage.set_data(key, {"task_id": task_id})
+        # Текст приходит раньше, чем истекает окно сборки альбома
+        for update in (_photo(app, user_id, "p1"), _photo(app, user_id, "p2"),
+                       make_message(app, user_id, "и еще комментарий")):
+            await app.dp.feed_update(app.bot, update, detach_updates=True)
+        await settle(app)
+        return await app.db.fetchone(
+            "SELECT file_id FROM submissions WHERE user_id = ? AND task_id = ?", (user_id, task_id)
+        )
+
+    submission = run(scenario())
+    assert submission is not None
+    assert submission["file_id"] == "photo:p1,photo:p2"
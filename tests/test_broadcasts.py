@@ -0,0 +1,30 @@
+class RecordingSender:
+    def __init__(self, loop):
+        self.loop = loop
+        self.methods = []
+
+    async def send(self, method):
+        self.methods.append(method)
+        future = self.loop.create_future()
+        future.set_result(None)
+        return future
+
+
+def test_unchanged_progress_is_not_edited_again(app, run, loop):
+    sender = RecordingSender(loop)
+    engine = app.BroadcastEngine(app.db, sender, concurrency=1, batch_size=10)
+    job = {"broadcast_id": 1, "admin_chat_id": 5901, "progress_message_id": 77}
+
+    async def scenario():
+        await engine._report(job, {"sent": 1, "pending": 2})
+        # Рассылка на паузе: те же счетчики несколько тиков подряд
+        await engine._report(job, {"sent": 1, "pending": 2})
+        await engine._report(job, {"sent": 1, "pending": 2})
+        await engine._report(job, {"sent": 3})
+        await engine._report(job, {"sent": 3}, done=True)
+
+    run(scenario())
+    texts = [method.text for method in sender.methods]
+    assert len(texts) == 3
+    assert texts[0].endswith("Отправлено: 1/3\nОшибок: 0")
+    assert "завершена" in texts[-1]
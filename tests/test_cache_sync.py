@@ -0,0 +1,24 @@
+def test_writes_from_another_instance_refresh_caches(app, run):
+    # Другой экземпляр пишет в ту же БД мимо кешей этого процесса
+    conn = app.db_pool.acquire()
+    try:
+        with conn:
+            conn.execute("INSERT INTO users (user_id, full_name) VALUES (5201, 'Старое Имя')")
+    finally:
+        app.db_pool.release(conn)
+    run(app.cache_sync.check())
+    assert run(app.profiles.get(5201)).full_name == "Старое Имя"
+
+    conn = app.db_pool.acquire()
+    try:
+        with conn:
+            course_id = conn.execute("INSERT INTO courses (title) VALUES ('С другого экземпляра')").lastrowid
+            conn.execute("UPDATE users SET full_name = 'Новое Имя' WHERE user_id = 5201")
+    finally:
+        app.db_pool.release(conn)
+
+    assert course_id not in app.catalog.courses
+    assert run(app.cache_sync.check()) == ["catalog", "profiles"]
+    assert app.catalog.courses[course_id].title == "С другого экземпляра"
+    assert run(app.profiles.get(5201)).full_name == "Новое Имя"
+    assert run(app.cache_sync.check()) == []
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+
+from conftest import make_callback, settle
+
+
+@pytest.fixture
+def router(app, monkeypatch):
+    # Тестовые маршруты живут в отдельном роутере и не попадают в маршруты бота
+    router = app.CallbackRouter()
+    monkeypatch.setattr(app, "callbacks", router)
+    return router
+
+
+def _register(app, router, prefix, deferred_ack):
+    @router.route(prefix, deferred_ack=deferred_ack)
+    async def handler(callback):
+        await asyncio.sleep(app.callback_acks.delay * 3)
+        await callback.answer("готово")
+
+
+def _feed(app, run, user_id, data):
+    async def scenario():
+        await app.dp.feed_update(app.bot, make_callback(app, user_id, data), detach_updates=True)
+        await settle(app)
+
+    run(scenario())
+
+
+def test_slow_handler_answers_its_own_toast(app, bot_api, run, router):
+    _register(app, router, "test_slow_toast", deferred_ack=False)
+    _feed(app, run, 5101, "test_slow_toast")
+
+    calls = [type(call).__name__ for call in bot_api.calls]
+    assert calls == ["AnswerCallbackQuery"]
+    assert bot_api.calls[0].text == "готово"
+
+
+def test_deferred_route_is_acknowledged_early(app, bot_api, run, router):
+    _register(app, router, "test_slow_deferred", deferred_ack=True)
+    _feed(app, run, 5102, "test_slow_deferred")
+
+    calls = [type(call).__name__ for call in bot_api.calls]
+    assert calls == ["AnswerCallbackQuery", "SendMessage"]
+    assert bot_api.calls[0].text is None
+    assert bot_api.calls[1].text == "готово"
+
+
+def test_deferred_route_error_stays_a_toast(app, bot_api, run, monkeypatch):
+    # Раннее подтверждение сработало бы раньше любого обработчика
+    monkeypatch.setattr(app.callback_acks, "delay", 0)
+    _feed(app, run, 5103, app.TaskCb(task_id=999999).pack())
+
+    calls = [type(call).__name__ for call in bot_api.calls]
+    assert calls == ["AnswerCallbackQuery"]
+    assert bot_api.calls[0].text == "❌ Задание не найдено"
@@ -0,0 +1,35 @@
+from conftest import make_callback, settle
+
+
+def _feed(app, run, user_id, data):
+    async def scenario():
+        await app.dp.feed_update(app.bot, make_callback(app, user_id, data), detach_updates=True)
+        await settle(app)
+
+    run(scenario())
+
+
+def test_stale_delete_button_reports_missing_course(app, bot_api, run):
+    admin_id = int(app.ADMIN_ID)
+    _feed(app, run, admin_id, app.DeleteCourseCb(course_id=999999).pack())
+    _feed(app, run, admin_id, app.ConfirmDeleteCb(course_id=999999).pack())
+
+    texts = [call.text for call in bot_api.calls]
+    assert texts == ["❌ Курс не найден", "❌ Курс не найден"]
+
+
+def test_course_deletion_requires_admin(app, bot_api, run):
+    conn = app.db_pool.acquire()
+    try:
+        with conn:
+            course_id = conn.execute("INSERT INTO courses (title) VALUES ('Не удалять')").lastrowid
+        app.catalog.load(conn.cursor())
+    finally:
+        app.db_pool.release(conn)
+
+    _feed(app, run, 5601, app.DeleteCourseCb(course_id=course_id).pack())
+    _feed(app, run, 5601, app.ConfirmDeleteCb(course_id=course_id).pack())
+
+    assert not any(type(call).__name__ == "EditMessageText" for call in bot_api.calls)
+    assert course_id in app.catalog.courses
+    assert run(app.db.fetchone("SELECT 1 FROM courses WHERE course_id = ?", (course_id,))) is not None
@@ -0,0 +1,23 @@
+import json
+
+
+def _sync(app, package):
+    courses, _ = app.parse_course_package("course.json", json.dumps(package).encode())
+    report = app.ImportReport(dry_run=False)
+    conn = app.db_pool.acquire()
+    try:
+        with conn:
+            app.sync_course_package(conn.cursor(), courses, {}, report)
+        return conn.execute(
+            "SELECT description, media_id FROM courses WHERE title = ?", (package["title"],)
+        ).fetchone()
+    finally:
+        app.db_pool.release(conn)
+
+
+def test_missing_description_keeps_stored_value(app):
+    course = {"title": "Импорт", "description": "Описание", "media": "photo-id", "modules": []}
+    assert tuple(_sync(app, course)) == ("Описание", "photo-id")
+
+    assert tuple(_sync(app, {"title": "Импорт", "modules": []})) == ("Описание", "photo-id")
+    assert tuple(_sync(app, {"title": "Импорт", "description": None, "modules": []})) == (None, "photo-id")
@@ -0,0 +1,124 @@
+import pytest
+
+
+class CountingDatabase:
+    """Обертка над AsyncDatabase, считающая транзакции записи."""
+
+    def __init__(self, db):
+        self._db = db
+        self.transactions = 0
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    async def transaction(self, func, *args):
+        self.transactions += 1
+        return await self._db.transaction(func, *args)
+
+    async def execute(self, sql, params=()):
+        return await self.transaction(lambda cursor: cursor.execute(sql, params).lastrowid)
+
+
+def _storage(app, shared):
+    return app.SQLiteStorage(CountingDatabase(app.db), ttl=60, flush_interval=3600,
+                             cache_idle=600, shared=shared)
+
+
+def _key(app, user_id):
+    return app.StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+def _row(app, storage, key):
+    conn = app.db_pool.acquire()
+    try:
+        row = conn.execute(
+            "SELECT state, data FROM fsm_storage WHERE key = ?", (storage._key_builder.build(key),)
+        ).fetchone()
+        return tuple(row) if row else None
+    finally:
+        app.db_pool.release(conn)
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_round_trip_and_clear(app, run, shared):
+    storage = _storage(app, shared)
+    key = _key(app, 5501 + shared)
+
+    async def scenario():
+        await storage.set_state(key, app.TaskStates.waiting_for_solution)
+        await storage.set_data(key, {"task_id": 7})
+        await storage.flush()
+        saved = _row(app, storage, key)
+        # Новый экземпляр хранилища читает то же самое из БД
+        reloaded = _storage(app, shared)
+        loaded = await reloaded.get_state(key), await reloaded.get_data(key)
+        # state.clear(): сначала состояние, потом данные
+        await storage.set_state(key, None)
+        await storage.set_data(key, {})
+        await storage.close()
+        await reloaded.close()
+        return saved, loaded
+
+    saved, loaded = run(scenario())
+    assert saved == (app.TaskStates.waiting_for_solution.state, '{"task_id": 7}')
+    assert loaded == (app.TaskStates.waiting_for_solution.state, {"task_id": 7})
+    assert _row(app, storage, key) is None
+
+
+def test_flush_batches_changes_into_one_transaction(app, run):
+    storage = _storage(app, shared=False)
+    keys = [_key(app, user_id) for user_id in range(5511, 5516)]
+
+    async def scenario():
+        for key in keys:
+            await storage.set_state(key, "Flow:step")
+            await storage.set_data(key, {"n": key.user_id})
+        written_before_flush = [_row(app, storage, key) for key in keys]
+        await storage.flush()
+        await storage.flush()  # изменений нет — транзакции тоже
+        await storage.close()
+        return written_before_flush
+
+    assert run(scenario()) == [None] * len(keys)
+    assert storage._db.transactions == 1
+    assert [_row(app, storage, key) for key in keys] == [("Flow:step", f'{{"n": {key.user_id}}}') for key in keys]
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_expire_removes_abandoned_states(app, run, shared):
+    storage = _storage(app, shared)
+    stale, fresh = _key(app, 5521 + 2 * shared), _key(app, 5522 + 2 * shared)
+
+    async def scenario():
+        for key in (stale, fresh):
+            await storage.set_state(key, "Flow:step")
+        await storage.flush()
+        await app.db.execute(
+            "UPDATE fsm_storage SET updated_at = updated_at - 3600 WHERE key = ?",
+            (storage._key_builder.build(stale),)
+        )
+        await storage.expire()
+        await storage.close()
+
+    run(scenario())
+    assert _row(app, storage, stale) is None
+    assert _row(app, storage, fresh) == ("Flow:step", "{}")
+
+
+def test_shared_column_writes_do_not_overwrite_each_other(app, run):
+    first, second = _storage(app, shared=True), _storage(app, shared=True)
+    key = _key(app, 5531)
+
+    async def scenario():
+        # Каждый экземпляр прочитал запись до того, как другой ее изменил
+        await first.get_data(key)
+        await second.get_state(key)
+        await first.set_state(key, "Flow:step")
+        await second.set_data(key, {"answer": 42})
+        result = await first.get_state(key), await first.get_data(key)
+        await first.close()
+        await second.close()
+        return result
+
+    assert run(scenario()) == ("Flow:step", {"answer": 42})
+    assert first._db.transactions == 1 and second._db.transactions == 1
@@ -0,0 +1,23 @@
+def test_disabled_registry_hands_out_null_metrics(app):
+    registry = app.MetricsRegistry(enabled=False)
+    counter = registry.counter("test_total", "счетчик", ("result",))
+    histogram = registry.histogram("test_seconds", "гистограмма")
+
+    assert counter is app.NULL_METRIC and histogram is app.NULL_METRIC
+    counter.inc("hit")
+    histogram.observe(0.5)
+    assert histogram.total_count() == 0
+    assert registry.render() == "\n"
+
+
+def test_enabled_registry_renders_observations(app):
+    registry = app.MetricsRegistry(enabled=True)
+    registry.counter("test_total", "счетчик", ("result",)).inc("hit")
+    histogram = registry.histogram("test_seconds", "гистограмма", ("operation",))
+    histogram.observe(0.5, "select")
+    histogram.observe(0.01, "insert")
+    assert histogram.total_count() == 2
+
+    text = registry.render()
+    assert 'test_total{result="hit"} 1.0' in text
+    assert 'test_seconds_count{operation="select"} 1' in text
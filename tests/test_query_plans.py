@@ -0,0 +1,38 @@
+import sqlite3
+
+
+def test_migrations_are_idempotent(app):
+    conn = app.db_pool.acquire()
+    try:
+        app.run_migrations(conn)
+        versions = [row[0] for row in conn.execute("SELECT version FROM schema_version ORDER BY version")]
+    finally:
+        app.db_pool.release(conn)
+    assert versions == [version for version, _, _ in app.MIGRATIONS]
+
+
+def test_hot_queries_use_indexes(app):
+    conn = app.db_pool.acquire()
+    try:
+        assert app.check_query_plans(conn.cursor()) == []
+    finally:
+        app.db_pool.release(conn)
+
+
+def test_duplicate_submissions_are_backed_up(app, tmp_path):
+    conn = sqlite3.connect(tmp_path / "old.db")
+    cursor = conn.cursor()
+    app._migration_initial(cursor)
+    cursor.execute("INSERT INTO users (user_id, full_name) VALUES (1, 'Старый Студент')")
+    cursor.execute("INSERT INTO courses (title) VALUES ('Курс')")
+    cursor.execute("INSERT INTO modules (course_id, title) VALUES (1, 'Модуль')")
+    cursor.execute("INSERT INTO tasks (module_id, title, content) VALUES (1, 'Задание', 'текст')")
+    cursor.executemany(
+        "INSERT INTO submissions (user_id, task_id, content) VALUES (1, 1, ?)", [("первое",), ("второе",)]
+    )
+
+    app._migration_indexes(cursor)
+
+    assert cursor.execute("SELECT content FROM submissions").fetchall() == [("первое",)]
+    assert cursor.execute("SELECT content FROM submissions_duplicates").fetchall() == [("второе",)]
+    conn.close()
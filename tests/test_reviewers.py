@@ -0,0 +1,261 @@
+import time
+
+import pytest
+
+from conftest import make_callback, make_message, settle
+
+
+@pytest.fixture
+def pools(app):
+    reviewers = app.reviewers
+    saved = reviewers.global_ids, reviewers._course_ids, reviewers.strategy
+    reviewers.global_ids, reviewers._course_ids = [int(app.ADMIN_ID)], {}
+    yield reviewers
+    reviewers.global_ids, reviewers._course_ids, reviewers.strategy = saved
+
+
+def _course(cursor, title, tasks=1):
+    course_id = cursor.execute("INSERT INTO courses (title) VALUES (?)", (title,)).lastrowid
+    module_id = cursor.execute("INSERT INTO modules (course_id, title) VALUES (?, 'М')", (course_id,)).lastrowid
+    task_ids = [
+        cursor.execute("INSERT INTO tasks (module_id, title, content) VALUES (?, ?, '')",
+                       (module_id, f"{title} {n}")).lastrowid
+        for n in range(1, tasks + 1)
+    ]
+    return course_id, task_ids
+
+
+def _submit(cursor, user_id, task_id, reviewer_id=None, lease_expires_at=None, status='pending'):
+    cursor.execute("INSERT OR IGNORE INTO users (user_id, full_name) VALUES (?, ?)", (user_id, f"Студент {user_id}"))
+    return cursor.execute(
+        "INSERT INTO submissions (user_id, task_id, status, reviewer_id, lease_expires_at, content) "
+        "VALUES (?, ?, ?, ?, ?, 'решение')",
+        (user_id, task_id, status, reviewer_id, lease_expires_at)
+    ).lastrowid
+
+
+def _write(app, func):
+    conn = app.db_pool.acquire()
+    try:
+        with conn:
+            result = func(conn.cursor())
+        app.catalog.load(conn.cursor())
+        return result
+    finally:
+        app.db_pool.release(conn)
+
+
+def _status(app, run, submission_id):
+    row = run(app.db.fetchone("SELECT status FROM submissions WHERE submission_id = ?", (submission_id,)))
+    return row['status']
+
+
+def test_course_reviewer_cannot_take_other_course_submissions(app, bot_api, run, pools):
+    def setup(cursor):
+        course_a, (task_a,) = _course(cursor, "Курс А")
+        course_b, (task_b,) = _course(cursor, "Курс Б")
+        course_c, (task_c,) = _course(cursor, "Курс В")
+        return (course_a, course_b), task_b, {
+            "own": _submit(cursor, 5701, task_a),
+            # Не назначено, аренда истекла, освобождено /remove_reviewer — все из чужого курса
+            "legacy": _submit(cursor, 5702, task_b),
+            "expired": _submit(cursor, 5703, task_b, reviewer_id=7002, lease_expires_at=time.time() - 1),
+            "released": _submit(cursor, 5704, task_b, reviewer_id=7002, lease_expires_at=0),
+            "global": _submit(cursor, 5705, task_c),
+        }
+
+    (course_a, course_b), task_b, subs = _write(app, setup)
+    pools._course_ids = {course_a: [7001], course_b: [7002]}
+    pools.global_ids = [int(app.ADMIN_ID), 7003]
+    foreign = [subs["legacy"], subs["expired"], subs["released"], subs["global"]]
+
+    def visible(reviewer_id):
+        rows, _ = run(app.db.read(app._review_page, None, 0, True, 100, reviewer_id))
+        return {row['submission_id'] for row in rows} & set(subs.values())
+
+    assert visible(7001) == {subs["own"]}
+    assert visible(7002) == {subs["legacy"], subs["expired"], subs["released"]}
+    # Общий пул видит только курсы без своего пула
+    assert visible(7003) == {subs["global"]}
+    assert visible(None) == set(subs.values())
+
+    assert not any(run(app.db.transaction(pools.claim, sid, 7001)) for sid in foreign)
+    assert run(app.db.transaction(app._apply_reviews, foreign, "accepted", 7001)) == []
+    assert {_status(app, run, sid) for sid in foreign} == {"pending"}
+
+    async def review(user_id):
+        data = app.ReviewCb(action="accept", task_id=task_b, user_id=user_id).pack()
+        await app.dp.feed_update(app.bot, make_callback(app, 7001, data), detach_updates=True)
+        await settle(app)
+
+    run(review(5702))
+    assert _status(app, run, subs["legacy"]) == "pending"
+    assert bot_api.calls[0].text.startswith("⚠️")
+
+    assert run(app.db.transaction(pools.claim, subs["expired"], 7002))
+    assert run(app.db.transaction(pools.claim, subs["own"], 7001))
+
+
+def _pool(app, strategy, lease=60):
+    return app.ReviewerPool(None, global_ids=[10, 20, 30], strategy=strategy, lease=lease, check_interval=60)
+
+
+def test_round_robin_cycles_through_candidates(app, migrated_db):
+    pool = _pool(app, "round_robin")
+    cursor = migrated_db.cursor()
+    assert [pool.choose(cursor, None, 1) for _ in range(4)] == [10, 20, 30, 10]
+    # Без исключенного проверяющего — своя очередь ходов
+    assert [pool.choose(cursor, None, 1, exclude=20) for _ in range(3)] == [10, 30, 10]
+
+
+def test_least_pending_and_sticky_strategies(app, migrated_db):
+    cursor = migrated_db.cursor()
+    course_id, task_ids = _course(cursor, "Стратегии", tasks=4)
+    _submit(cursor, 1, task_ids[0], reviewer_id=10, lease_expires_at=time.time() + 60)
+    _submit(cursor, 2, task_ids[0], reviewer_id=10, lease_expires_at=time.time() + 60)
+    _submit(cursor, 3, task_ids[0], reviewer_id=20, lease_expires_at=time.time() + 60)
+    # Проверенные решения не считаются нагрузкой
+    _submit(cursor, 4, task_ids[0], reviewer_id=30, status='accepted')
+    _submit(cursor, 5, task_ids[0], reviewer_id=30, status='rejected')
+
+    least = _pool(app, "least_pending")
+    assert least.choose(cursor, course_id, 1) == 30
+    assert least.choose(cursor, course_id, 1, exclude=30) == 20
+
+    sticky = _pool(app, "sticky")
+    # Студент 1 остается у своего проверяющего, даже если тот загружен больше других
+    assert sticky.choose(cursor, course_id, 1) == 10
+    # Новому студенту — наименее загруженный
+    assert sticky.choose(cursor, course_id, 99) == 30
+    # Исключенный проверяющий не выбирается и для «своего» студента
+    assert sticky.choose(cursor, course_id, 1, exclude=10) == 30
+
+    # Пул курса заменяет общий
+    sticky._course_ids = {course_id: [40]}
+    assert sticky.choose(cursor, course_id, 1) == 40
+
+
+def test_expired_leases_move_to_another_reviewer(app, migrated_db):
+    cursor = migrated_db.cursor()
+    course_id, (task_id, other_task) = _course(cursor, "Аренда", tasks=2)
+    pool = _pool(app, "round_robin", lease=600)
+    expired = _submit(cursor, 1, task_id, reviewer_id=10, lease_expires_at=time.time() - 1)
+    active = _submit(cursor, 2, task_id, reviewer_id=20, lease_expires_at=time.time() + 60)
+    reviewed = _submit(cursor, 3, other_task, reviewer_id=10, lease_expires_at=0, status='accepted')
+    pool.mark_pushed(cursor, expired, 10)
+
+    assert pool._reassign(cursor) == [(task_id, 1, 20, True)]
+
+    rows = {row['submission_id']: row for row in cursor.execute(
+        "SELECT submission_id, reviewer_id, lease_expires_at FROM submissions"
+    )}
+    assert rows[expired]['reviewer_id'] == 20 and rows[expired]['lease_expires_at'] > time.time() + 500
+    assert rows[active]['reviewer_id'] == 20
+    assert rows[reviewed]['reviewer_id'] == 10
+    assert pool._reassign(cursor) == []
+
+    # Единственный проверяющий курса получает решение обратно — это не переназначение
+    pool._course_ids = {course_id: [10]}
+    cursor.execute("UPDATE submissions SET reviewer_id = 10, lease_expires_at = 0 WHERE submission_id = ?",
+                   (expired,))
+    assert pool._reassign(cursor) == []
+    row = cursor.execute("SELECT reviewer_id, lease_expires_at FROM submissions WHERE submission_id = ?",
+                         (expired,)).fetchone()
+    assert row['reviewer_id'] == 10 and row['lease_expires_at'] > time.time()
+
+
+def test_unreviewed_submission_is_pushed_to_each_reviewer_once(app, migrated_db):
+    cursor = migrated_db.cursor()
+    course_id, (task_id,) = _course(cursor, "Повторы")
+    pool = _pool(app, "round_robin", lease=600)
+    pool._course_ids = {course_id: [10, 20]}
+    submission_id = _submit(cursor, 1, task_id, reviewer_id=10, lease_expires_at=time.time() - 1)
+    pool.mark_pushed(cursor, submission_id, 10)
+
+    pushes = []
+    for _ in range(4):
+        moved = pool._reassign(cursor)
+        pushes += [push for *_, push in moved]
+        cursor.execute("UPDATE submissions SET lease_expires_at = 0 WHERE submission_id = ?", (submission_id,))
+    # Решение ходит между проверяющими, но каждому присылается только один раз
+    assert pushes == [True, False, False, False]
+
+
+def test_submissions_without_lease_are_assigned(app, migrated_db):
+    cursor = migrated_db.cursor()
+    _, (task_id,) = _course(cursor, "Без аренды")
+    pool = _pool(app, "round_robin", lease=600)
+    # Решение до пулов проверяющих или сохраненное при пустом пуле
+    legacy = _submit(cursor, 1, task_id)
+
+    assert pool._reassign(cursor) == [(task_id, 1, 10, True)]
+    row = cursor.execute("SELECT reviewer_id, lease_expires_at FROM submissions WHERE submission_id = ?",
+                         (legacy,)).fetchone()
+    assert row['reviewer_id'] == 10 and row['lease_expires_at'] > time.time()
+
+    # Пока пул пуст, решение остается без проверяющего и ждет следующего прохода
+    empty = _pool(app, "round_robin")
+    empty.global_ids = []
+    other = _submit(cursor, 2, task_id)
+    assert empty._reassign(cursor) == []
+    assert cursor.execute("SELECT reviewer_id FROM submissions WHERE submission_id = ?", (other,)).fetchone()[0] is None
+
+
+def test_batch_accept_skips_unavailable_and_groups_notifications(app, bot_api, run, pools):
+    reviewer_id = 7101
+
+    def setup(cursor):
+        course_id, tasks = _course(cursor, "Пакетная проверка", tasks=3)
+        return course_id, tasks, [
+            _submit(cursor, 5801, tasks[0]),
+            _submit(cursor, 5801, tasks[1]),
+            _submit(cursor, 5802, tasks[0], reviewer_id=7102, lease_expires_at=time.time() - 1),
+            _submit(cursor, 5803, tasks[0], status='accepted'),
+            _submit(cursor, 5804, tasks[0], reviewer_id=7102, lease_expires_at=time.time() + 600),
+        ]
+
+    course_id, tasks, selected = _write(app, setup)
+    pools._course_ids = {course_id: [reviewer_id, 7102]}
+    key = app.StorageKey(bot_id=app.bot.id, chat_id=reviewer_id, user_id=reviewer_id)
+
+    async def scenario():
+        await app.fsm_storage.set_data(key, {"review_course": course_id, "review_selected": selected})
+        data = app.ReviewQueueCb(action="accept", value=0).pack()
+        await app.dp.feed_update(app.bot, make_callback(app, reviewer_id, data), detach_updates=True)
+        await settle(app)
+        return await app.fsm_storage.get_data(key)
+
+    data = run(scenario())
+
+    toasts = [call.text for call in bot_api.calls if type(call).__name__ == "AnswerCallbackQuery"]
+    assert toasts == ["✅ Принято: 3, пропущено: 2"]
+    sent = {call.chat_id: call.text for call in bot_api.calls if type(call).__name__ == "SendMessage"}
+    assert sorted(sent) == [5801, 5802]
+    assert sent[5801].startswith("📢 Проверены ваши решения — принято ✅")
+    assert "Пакетная проверка 1" in sent[5801] and "Пакетная проверка 2" in sent[5801]
+    assert sent[5802] == "📢 Ваше решение по заданию \"Пакетная проверка 1\" принято ✅."
+    assert [_status(app, run, sid) for sid in selected] == ["accepted"] * 4 + ["pending"]
+    assert data["review_selected"] == []
+
+
+def test_queue_header_counts_only_what_the_reviewer_can_take(app, bot_api, run, pools):
+    def setup(cursor):
+        own_course, (own_task,) = _course(cursor, "Свой курс")
+        other_course, (other_task,) = _course(cursor, "Чужой курс")
+        _submit(cursor, 5901, own_task)
+        _submit(cursor, 5902, own_task, reviewer_id=7202, lease_expires_at=time.time() + 600)
+        for user_id in (5903, 5904, 5905):
+            _submit(cursor, user_id, other_task)
+        return own_course, other_course
+
+    own_course, other_course = _write(app, setup)
+    pools._course_ids = {own_course: [7201, 7202], other_course: [7203]}
+
+    async def scenario(user_id):
+        await app.dp.feed_update(app.bot, make_message(app, user_id, "/queue"), detach_updates=True)
+        await settle(app)
+
+    run(scenario(7201))
+    run(scenario(7203))
+    headers = [call.text.split("\n", 1)[0] for call in bot_api.calls]
+    assert headers == ["📋 Очередь проверки (все курсы): 1 ожидают", "📋 Очередь проверки (все курсы): 3 ожидают"]
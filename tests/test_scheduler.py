@@ -0,0 +1,54 @@
+import logging
+
+from conftest import make_callback, make_message, settle
+
+
+def test_detached_updates_see_state_set_by_previous_update(app, bot_api, run):
+    user_id = 5001
+
+    async def scenario():
+        # Как при polling: апдейты только ставятся в очередь, обработка идет позже
+        await app.dp.feed_update(app.bot, make_message(app, user_id, "/start"), detach_updates=True)
+        await app.dp.feed_update(app.bot, make_message(app, user_id, "Иван Иванов"), detach_updates=True)
+        await settle(app)
+        profile = await app.db.fetchone("SELECT full_name FROM users WHERE user_id = ?", (user_id,))
+        state = await app.fsm_storage.get_state(
+            app.StorageKey(bot_id=app.bot.id, chat_id=user_id, user_id=user_id)
+        )
+        return profile, state
+
+    profile, state = run(scenario())
+    assert profile is not None and profile["full_name"] == "Иван Иванов"
+    assert state is None
+
+
+def test_detached_handler_errors_reach_error_handlers(app, bot_api, run, monkeypatch, caplog):
+    router = app.CallbackRouter()
+    monkeypatch.setattr(app, "callbacks", router)
+    errors = []
+
+    @router.route("test_raises")
+    async def raises(callback):
+        raise RuntimeError("сломалось")
+
+    async def on_error(event):
+        errors.append(event)
+        return True
+
+    app.dp.errors.register(on_error)
+    update = make_callback(app, 5004, "test_raises")
+    try:
+        async def scenario():
+            await app.dp.feed_update(app.bot, update, detach_updates=True)
+            await settle(app)
+
+        with caplog.at_level(logging.INFO, logger="aiogram.event"):
+            run(scenario())
+    finally:
+        app.dp.errors.handlers[:] = [h for h in app.dp.errors.handlers if h.callback is not on_error]
+
+    assert [type(event.exception) for event in errors] == [RuntimeError]
+    assert errors[0].update.update_id == update.update_id
+    # Одна строка aiogram об апдейте — после обработки, а не при постановке в очередь
+    lines = [r.getMessage() for r in caplog.records if r.name == "aiogram.event" and r.args[0] == update.update_id]
+    assert len(lines) == 1 and " is handled." in lines[0]
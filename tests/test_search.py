@@ -0,0 +1,80 @@
+def _indexed(conn):
+    return {row[0]: (row[1], row[2]) for row in conn.execute("SELECT rowid, title, body FROM catalog_fts")}
+
+
+def _expected(conn):
+    rows = conn.execute('''
+        SELECT course_id * 3, title, COALESCE(description, '') FROM courses
+        UNION ALL SELECT module_id * 3 + 1, title, '' FROM modules
+        UNION ALL SELECT task_id * 3 + 2, title, COALESCE(content, '') FROM tasks
+    ''')
+    return {row[0]: (row[1], row[2]) for row in rows}
+
+
+def _search(app, conn, text):
+    rows, _ = app._search_page(conn.cursor(), app._fts_query(text), 0, 20)
+    return {row['rowid'] for row in rows}
+
+
+def test_fts_index_follows_catalog_changes(app, migrated_db):
+    conn = migrated_db
+    with conn:
+        course_id = conn.execute(
+            "INSERT INTO courses (title, description) VALUES ('Основы Python', 'Переменные и циклы')"
+        ).lastrowid
+        other_id = conn.execute("INSERT INTO courses (title) VALUES ('Алгоритмы')").lastrowid
+        module_id = conn.execute(
+            "INSERT INTO modules (course_id, title) VALUES (?, 'Функции')", (course_id,)
+        ).lastrowid
+        task_id = conn.execute(
+            "INSERT INTO tasks (module_id, title, content) VALUES (?, 'Факториал', 'Напишите рекурсивную функцию')",
+            (module_id,)
+        ).lastrowid
+        other_module = conn.execute(
+            "INSERT INTO modules (course_id, title) VALUES (?, 'Сортировки')", (other_id,)
+        ).lastrowid
+        conn.execute("INSERT INTO tasks (module_id, title, content) VALUES (?, 'Пузырек', 'Обмен соседей')", (other_module,))
+    assert _indexed(conn) == _expected(conn)
+
+    assert _search(app, conn, "python") == {course_id * 3}
+    assert _search(app, conn, "цикл") == {course_id * 3}
+    assert _search(app, conn, "рекурсивн") == {task_id * 3 + 2}
+    assert _search(app, conn, "функци") == {module_id * 3 + 1, task_id * 3 + 2}
+
+    with conn:
+        conn.execute("UPDATE courses SET description = 'Списки и словари' WHERE course_id = ?", (course_id,))
+        conn.execute("UPDATE modules SET title = 'Замыкания' WHERE module_id = ?", (module_id,))
+        conn.execute("UPDATE tasks SET content = 'Итеративное решение' WHERE task_id = ?", (task_id,))
+    assert _indexed(conn) == _expected(conn)
+    assert _search(app, conn, "цикл") == set()
+    assert _search(app, conn, "словари") == {course_id * 3}
+    assert _search(app, conn, "замыкания") == {module_id * 3 + 1}
+    assert _search(app, conn, "рекурсивн") == set()
+
+    with conn:
+        conn.execute("DELETE FROM tasks WHERE module_id = ?", (other_module,))
+        conn.execute("DELETE FROM courses WHERE course_id = ?", (course_id,))
+    assert _indexed(conn) == _expected(conn) == {other_id * 3: ("Алгоритмы", ""), other_module * 3 + 1: ("Сортировки", "")}
+    assert _search(app, conn, "факториал") == set()
+    assert _search(app, conn, "сорт") == {other_module * 3 + 1}
+
+
+def test_search_renders_cached_catalog_entries(app, run):
+    conn = app.db_pool.acquire()
+    try:
+        with conn:
+            course_id = conn.execute("INSERT INTO courses (title) VALUES ('Криптография')").lastrowid
+            module_id = conn.execute(
+                "INSERT INTO modules (course_id, title) VALUES (?, 'Шифр Цезаря')", (course_id,)
+            ).lastrowid
+        app.catalog.load(conn.cursor())
+    finally:
+        app.db_pool.release(conn)
+
+    text, markup = run(app.render_search("криптограф"))
+    assert "📘 Криптография" in text
+    assert [row[0].callback_data for row in markup.inline_keyboard] == [app.CourseCb(course_id=course_id).pack()]
+
+    text, markup = run(app.render_search("шифр"))
+    assert "📂 Криптография / Шифр Цезаря" in text
+    assert [row[0].callback_data for row in markup.inline_keyboard] == [app.ModuleCb(module_id=module_id).pack()]
@@ -0,0 +1,27 @@
+import pytest
+from aiogram.methods import SendMessage
+
+from conftest import settle
+
+
+@pytest.fixture
+def small_bucket(app):
+    original = app.send_limiter.bucket
+    app.send_limiter.bucket = app.TokenBucket(rate=0.001, capacity=3)
+    yield app.send_limiter.bucket
+    app.send_limiter.bucket = original
+
+
+def test_direct_replies_and_outbox_share_send_rate(app, bot_api, run, small_bucket):
+    async def scenario():
+        await app.bot.send_message(5301, "прямой ответ")
+        await app.bot.answer_callback_query("1")
+        await app.outbox.send(SendMessage(chat_id=5302, text="из очереди"))
+        await settle(app)
+
+    run(scenario())
+
+    assert [type(call).__name__ for call in bot_api.calls] == ["SendMessage", "AnswerCallbackQuery", "SendMessage"]
+    # Два сообщения — два токена; answerCallbackQuery лимит не расходует
+    assert small_bucket.try_acquire()
+    assert not small_bucket.try_acquire()
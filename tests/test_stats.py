@@ -0,0 +1,57 @@
+def _snapshot(conn):
+    return (
+        conn.execute("SELECT * FROM course_stats ORDER BY course_id").fetchall(),
+        conn.execute("SELECT * FROM task_stats ORDER BY task_id").fetchall(),
+    )
+
+
+def _assert_matches_rebuild(app, conn):
+    # Триггеры должны давать ровно то же, что пересчет с нуля
+    maintained = [list(map(tuple, rows)) for rows in _snapshot(conn)]
+    with conn:
+        app.rebuild_stats(conn.cursor())
+    rebuilt = [list(map(tuple, rows)) for rows in _snapshot(conn)]
+    assert maintained == rebuilt
+    return maintained
+
+
+def test_triggers_agree_with_rebuild(app, migrated_db):
+    conn = migrated_db
+    with conn:
+        conn.executemany("INSERT INTO users (user_id, full_name) VALUES (?, ?)",
+                         [(1, "Первый"), (2, "Второй"), (3, "Третий")])
+        for course in ("А", "Б"):
+            course_id = conn.execute("INSERT INTO courses (title) VALUES (?)", (course,)).lastrowid
+            for module in range(2):
+                module_id = conn.execute("INSERT INTO modules (course_id, title) VALUES (?, ?)",
+                                         (course_id, f"{course}{module}")).lastrowid
+                for task in range(2):
+                    conn.execute("INSERT INTO tasks (module_id, title, content) VALUES (?, ?, '')",
+                                 (module_id, f"{course}{module}{task}"))
+        conn.execute("INSERT INTO courses (title) VALUES ('Пустой')")
+        task_ids = [row[0] for row in conn.execute("SELECT task_id FROM tasks ORDER BY task_id")]
+        conn.executemany("INSERT INTO submissions (user_id, task_id) VALUES (?, ?)",
+                         [(user_id, task_id) for user_id in (1, 2, 3) for task_id in task_ids])
+    courses, _ = _assert_matches_rebuild(app, conn)
+    assert [(row[1], row[2], row[3], row[6]) for row in courses][:2] == [(2, 4, 12, 12), (2, 4, 12, 12)]
+
+    with conn:
+        conn.execute("UPDATE submissions SET status = 'accepted', score = 90 WHERE user_id = 1")
+        conn.execute("UPDATE submissions SET status = 'rejected' WHERE user_id = 2 AND task_id % 2 = 0")
+        # Повторная проверка уже проверенного решения
+        conn.execute("UPDATE submissions SET status = 'rejected' WHERE user_id = 1 AND task_id = ?", (task_ids[0],))
+    _assert_matches_rebuild(app, conn)
+
+    with conn:
+        conn.execute("DELETE FROM users WHERE user_id = 2")
+    _assert_matches_rebuild(app, conn)
+
+    with conn:
+        conn.execute("DELETE FROM tasks WHERE task_id = ?", (task_ids[-1],))
+        conn.execute("DELETE FROM modules WHERE module_id = (SELECT MIN(module_id) FROM modules)")
+    _assert_matches_rebuild(app, conn)
+
+    with conn:
+        conn.execute("DELETE FROM courses WHERE title = 'Б'")
+    courses, tasks = _assert_matches_rebuild(app, conn)
+    assert len(courses) == 2 and len(tasks) == 2
@@ -0,0 +1,53 @@
+from conftest import make_callback, make_message
+
+
+def _photo(app, user_id, media_group_id):
+    return make_message(app, user_id, None, media_group_id=media_group_id,
+                        photo=[{"file_id": "p", "file_unique_id": "p", "width": 1, "height": 1}])
+
+
+def _passed(app, run, throttling, updates):
+    passed = []
+
+    async def handler(event, data):
+        passed.append(event)
+
+    async def scenario():
+        for update in updates:
+            event = update.message or update.callback_query
+            await throttling(handler, update, {"event_from_user": event.from_user})
+
+    run(scenario())
+    return len(passed)
+
+
+def test_dropped_messages_get_one_warning(app, bot_api, run):
+    throttling = app.ThrottlingMiddleware(rate=0.001, burst=2)
+    updates = [make_message(app, 5401, f"сообщение {i}") for i in range(5)]
+
+    assert _passed(app, run, throttling, updates) == 2
+    assert [type(call).__name__ for call in bot_api.calls] == ["SendMessage"]
+
+
+def test_album_parts_use_album_budget(app, bot_api, run):
+    throttling = app.ThrottlingMiddleware(rate=0.001, burst=2, album_parts=10)
+    # Первый альбом тратит один токен и пропускает не больше 10 частей
+    assert _passed(app, run, throttling, [_photo(app, 5402, "a1") for _ in range(12)]) == 10
+    assert len(bot_api.calls) == 1
+    assert _passed(app, run, throttling, [_photo(app, 5402, "a2") for _ in range(3)]) == 3
+    # Токенов больше нет: третий альбом отклоняется целиком, с одним предупреждением
+    assert _passed(app, run, throttling, [_photo(app, 5402, "a3") for _ in range(3)]) == 0
+    assert len(bot_api.calls) == 2
+
+
+def test_reviewers_are_not_throttled(app, bot_api, run, monkeypatch):
+    monkeypatch.setattr(app.reviewers, "_course_ids", {0: [5403]})
+    throttling = app.ThrottlingMiddleware(rate=0.001, burst=2)
+    # Отметки и листание очереди проверки — больше нажатий, чем позволяет всплеск
+    clicks = [make_callback(app, 5403, app.ReviewQueueCb(action="toggle", value=n).pack()) for n in range(6)]
+
+    assert _passed(app, run, throttling, clicks) == 6
+    assert bot_api.calls == []
+    # Обычный пользователь с тем же потоком нажатий ограничивается
+    student = [make_callback(app, 5404, app.ReviewQueueCb(action="toggle", value=n).pack()) for n in range(6)]
+    assert _passed(app, run, throttling, student) == 2
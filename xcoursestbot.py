@@ -1,128 +1,2267 @@
 ### BLOCK 1: BASE SETUP ###
-import random 
 import os
 import logging
 import sqlite3
+import queue
+import threading
+import time
+import asyncio
+import contextvars
+import csv
+import functools
+import gzip
+import hashlib
+import inspect
+import io
+import json
+import posixpath
+import re
+import tempfile
+import zipfile
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 logging.basicConfig()
 logger = logging.getLogger('sqlalchemy.engine')
 logger.setLevel(logging.INFO)
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
+from aiogram.dispatcher.event.bases import UNHANDLED
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.filters import Command
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.filters import Command, CommandObject
+from aiogram.filters.callback_data import CallbackData
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError
+)
+from aiogram.methods import (
+    AnswerCallbackQuery,
+    EditMessageText,
+    SendDocument,
+    SendMediaGroup,
+    SendMessage,
+    SendPhoto,
+    TelegramMethod
+)
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Union
 from aiogram.types import (
     Message,
+    BufferedInputFile,
     CallbackQuery,
+    ErrorEvent,
+    FSInputFile,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     ReplyKeyboardRemove
 )
 from aiogram.utils.media_group import MediaGroupBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+import yaml
+
+# Загрузка переменных окружения
+load_dotenv()
+TOKEN = os.getenv('TOKEN')
+ADMIN_ID = os.getenv('ADMIN_ID')
+# Проверяющие через запятую; по умолчанию решения проверяет ADMIN_ID
+REVIEWER_IDS = os.getenv('REVIEWER_IDS')
+DATABASE_NAME = os.getenv('DATABASE_NAME', 'bot.db')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
+# Профиль хранения SQLite
+DB_JOURNAL_MODE = os.getenv('DB_JOURNAL_MODE', 'WAL').upper()
+DB_SYNCHRONOUS = os.getenv('DB_SYNCHRONOUS', 'NORMAL').upper()
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000'))
+DB_MMAP_SIZE = int(os.getenv('DB_MMAP_SIZE', str(256 * 1024 * 1024)))
+DB_CACHE_SIZE = int(os.getenv('DB_CACHE_SIZE', '-20000'))  # < 0 — размер в КиБ
+DB_WRITE_BATCH_SIZE = int(os.getenv('DB_WRITE_BATCH_SIZE', '100'))
+DB_WRITE_BATCH_DELAY_MS = float(os.getenv('DB_WRITE_BATCH_DELAY_MS', '2'))
+
+# Кеш профилей пользователей (имя, текущий курс)
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', '10000'))
+PROFILE_CACHE_TTL = float(os.getenv('PROFILE_CACHE_TTL', '600'))
+# Несколько экземпляров на одной БД: как часто проверять чужие изменения каталога,
+# проверяющих и профилей (секунды); 0 — один экземпляр, проверка не нужна
+CACHE_SYNC_INTERVAL = float(os.getenv('CACHE_SYNC_INTERVAL', '0'))
+
+# Режим запуска: polling или webhook (Cloud Run)
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Сколько запросов Telegram держит открытыми одновременно (1–100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+WEB_HOST = os.getenv('WEB_HOST', '0.0.0.0')
+WEB_PORT = int(os.getenv('PORT', '8080'))
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '32'))
+# Сколько апдейтов может ждать в очереди и обрабатываться одновременно
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '8'))
+# Антифлуд: действий пользователя в секунду и допустимый всплеск
+THROTTLE_RATE = float(os.getenv('THROTTLE_RATE', '2'))
+THROTTLE_BURST = float(os.getenv('THROTTLE_BURST', '5'))
+# Сколько ждать ответа обработчика с deferred_ack, прежде чем подтвердить нажатие пустым ответом
+CALLBACK_ACK_DELAY = float(os.getenv('CALLBACK_ACK_DELAY', '0.1'))
+
+# Метрики Prometheus (локальный эндпоинт /metrics)
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '0').lower() in ('1', 'true', 'yes')
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+
+# Админ-панель
+USERS_PAGE_SIZE = int(os.getenv('USERS_PAGE_SIZE', '20'))
+REVIEW_PAGE_SIZE = int(os.getenv('REVIEW_PAGE_SIZE', '8'))
+# 0 — не присылать админу каждое решение, проверять через очередь
+REVIEW_PUSH = os.getenv('REVIEW_PUSH', '1').lower() in ('1', 'true', 'yes')
+
+# Поиск по каталогу (/search)
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', '8'))
+
+# Инициализация бота (диспетчер создается после FSM-хранилища, BLOCK 2.1)
+if TELEGRAM_API_URL:
+    # Свой сервер Bot API (локальный telegram-bot-api или заглушка из bench.py)
+    bot = Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=TOKEN)
+
+# Настройка логгера
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+)
+logger = logging.getLogger(__name__)
+
+def adapt_datetime(dt):
+    return dt.isoformat()
+
+def convert_datimestamp(b):
+    return datetime.fromisoformat(b.decode())
+
+### BLOCK 1.1: METRICS ###
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self._values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1.0):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for values, total in self._values.items():
+                lines.append(f"{self.name}{_labels(self.labels, values)} {total}")
+        return lines
+
+
+class Histogram:
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # значения меток → [счетчики по корзинам..., сумма, количество]
+        self._series: Dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def total_count(self) -> int:
+        """Число наблюдений по всем значениям меток."""
+        with self._lock:
+            return sum(series[-1] for series in self._series.values())
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for values, series in self._series.items():
+                cumulative = 0
+                for bound, hits in zip(self.buckets, series):
+                    cumulative += hits
+                    le = _labels(self.labels + ("le",), values + (repr(bound),))
+                    lines.append(f"{self.name}_bucket{le} {cumulative}")
+                le = _labels(self.labels + ("le",), values + ("+Inf",))
+                lines.append(f"{self.name}_bucket{le} {series[-1]}")
+                lines.append(f"{self.name}_sum{_labels(self.labels, values)} {series[-2]}")
+                lines.append(f"{self.name}_count{_labels(self.labels, values)} {series[-1]}")
+        return lines
+
+
+class NullMetric:
+    """Заглушка для выключенных метрик: вызовы ничего не делают и не берут блокировку."""
+
+    def inc(self, *label_values, amount: float = 1.0):
+        pass
+
+    def observe(self, value: float, *label_values):
+        pass
+
+    def total_count(self) -> int:
+        return 0
+
+    def render(self) -> List[str]:
+        return []
+
+
+NULL_METRIC = NullMetric()
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+class MetricsRegistry:
+    """Метрики в текстовом формате Prometheus.
+
+    Без внешних зависимостей: счетчики и гистограммы с метками плюс
+    gauge-функции, которые вычисляются в момент запроса /metrics.
+    Выключенный реестр выдает NULL_METRIC, чтобы горячие пути не платили за учет.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._metrics = []
+        self._gauges: List[Tuple[str, str, Any]] = []
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Counter:
+        if not self.enabled:
+            return NULL_METRIC
+        metric = Counter(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Histogram:
+        if not self.enabled:
+            return NULL_METRIC
+        metric = Histogram(name, help_text, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help_text: str, func):
+        self._gauges.append((name, help_text, func))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for name, help_text, func in self._gauges:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {func()}"]
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry(enabled=METRICS_ENABLED)
+UPDATES_TOTAL = metrics.counter(
+    "bot_updates_total", "Полученные апдейты", ("type",))
+UPDATE_SECONDS = metrics.histogram(
+    "bot_update_duration_seconds", "Полное время обработки апдейта", ("type",))
+UPDATE_QUEUE_SECONDS = metrics.histogram(
+    "bot_update_queue_wait_seconds", "Время ожидания апдейта в очереди планировщика")
+HANDLER_SECONDS = metrics.histogram(
+    "bot_handler_duration_seconds", "Время работы обработчика", ("handler",))
+HANDLER_ERRORS = metrics.counter(
+    "bot_handler_errors_total", "Необработанные исключения в обработчиках", ("handler", "error"))
+DB_QUERY_SECONDS = metrics.histogram(
+    "bot_db_query_duration_seconds", "Время выполнения SQL-запросов", ("operation",))
+API_SECONDS = metrics.histogram(
+    "bot_telegram_request_duration_seconds", "Время запросов к Telegram Bot API", ("method",))
+API_ERRORS = metrics.counter(
+    "bot_telegram_errors_total", "Ошибки запросов к Telegram Bot API", ("method", "error"))
+OUTBOX_SECONDS = metrics.histogram(
+    "bot_outbox_latency_seconds", "Время от постановки в очередь отправки до результата")
+THROTTLED_TOTAL = metrics.counter(
+    "bot_throttled_total", "Отброшенные антифлудом апдейты", ("reason",))
+PROFILE_CACHE = metrics.counter(
+    "bot_profile_cache_total", "Обращения к кешу профилей пользователей", ("result",))
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор, который замеряет время каждого execute/executemany."""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - start, _sql_operation(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - start, _sql_operation(sql))
+
+
+def _sql_operation(sql: str) -> str:
+    return sql.lstrip().split(None, 1)[0].lower() if sql.strip() else "empty"
+
+
+# При выключенных метриках используется обычный курсор — накладных расходов нет
+DB_CURSOR = TimedCursor if METRICS_ENABLED else sqlite3.Cursor
+
+sqlite3.register_adapter(datetime, adapt_datetime)
+sqlite3.register_converter("timestamp", convert_datimestamp)
+
+class ConnectionPool:
+    """Пул долгоживущих соединений SQLite.
+
+    Соединения открываются лениво (не больше size), PRAGMA выставляются один
+    раз при создании, а перед выдачей давно простаивавшее соединение
+    проверяется запросом SELECT 1.
+    """
+
+    def __init__(self, database: str, size: int = 5, timeout: float = 10.0,
+                 healthcheck_interval: float = 30.0):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._created = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.database,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            check_same_thread=False
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        if DB_JOURNAL_MODE in ('WAL', 'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY'):
+            conn.execute(f"PRAGMA journal_mode = {DB_JOURNAL_MODE}")
+        if DB_SYNCHRONOUS in ('OFF', 'NORMAL', 'FULL', 'EXTRA'):
+            conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size = {DB_CACHE_SIZE}")
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    def acquire(self):
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    can_create = self._created < self.size
+                    if can_create:
+                        self._created += 1
+                if can_create:
+                    try:
+                        return self._connect()
+                    except Exception:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                try:
+                    conn, last_used = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise sqlite3.OperationalError("Пул соединений с БД исчерпан")
+
+            if time.monotonic() - last_used < self.healthcheck_interval:
+                return conn
+            try:
+                conn.execute("SELECT 1")
+                return conn
+            except sqlite3.Error as e:
+                logger.warning(f"Соединение с БД не прошло проверку: {e}")
+                self._discard(conn)
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        self._idle.put_nowait((conn, time.monotonic()))
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+db_pool = ConnectionPool(
+    DATABASE_NAME,
+    size=int(os.getenv('DB_POOL_SIZE', '5')),
+    timeout=float(os.getenv('DB_POOL_TIMEOUT', '10')),
+    healthcheck_interval=float(os.getenv('DB_POOL_HEALTHCHECK', '30'))
+)
+
+
+class Database:
+    """Контекстный менеджер: берет соединение из пула и отдает курсор."""
+
+    def __enter__(self):
+        self.conn = db_pool.acquire()
+        return self.conn.cursor(DB_CURSOR)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type:
+                self.conn.rollback()
+            else:
+                self.conn.commit()
+        finally:
+            db_pool.release(self.conn)
+
+
+### BLOCK 2: SCHEMA MIGRATIONS ###
+def _migration_initial(cursor):
+    # Users table
+    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        full_name TEXT NOT NULL,
+        current_course INTEGER,
+        registered_at timestamp DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(current_course) REFERENCES courses(course_id) ON DELETE SET NULL
+    )''')
+
+    # Courses table
+    cursor.execute('''CREATE TABLE IF NOT EXISTS courses (
+        course_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        title TEXT UNIQUE NOT NULL,
+        description TEXT,
+        media_id TEXT
+    )''')
+
+    # Modules table
+    cursor.execute('''CREATE TABLE IF NOT EXISTS modules (
+        module_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        course_id INTEGER NOT NULL,
+        title TEXT NOT NULL,
+        media_id TEXT,
+        FOREIGN KEY(course_id) REFERENCES courses(course_id) ON DELETE CASCADE
+    )''')
+
+    # Tasks table
+    cursor.execute('''CREATE TABLE IF NOT EXISTS tasks (
+        task_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        module_id INTEGER NOT NULL,
+        title TEXT NOT NULL,
+        content TEXT NOT NULL,
+        file_id TEXT,
+        FOREIGN KEY(module_id) REFERENCES modules(module_id) ON DELETE CASCADE
+    )''')
+
+    # Submissions table с улучшенными ограничениями
+    cursor.execute('''CREATE TABLE IF NOT EXISTS submissions (
+        submission_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        task_id INTEGER NOT NULL,
+        status TEXT DEFAULT 'pending' CHECK(status IN ('pending', 'accepted', 'rejected')),
+        score INTEGER CHECK(score BETWEEN 0 AND 100),
+        submitted_at timestamp DEFAULT CURRENT_TIMESTAMP,
+        file_id TEXT,
+        content TEXT,
+        FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE,
+        FOREIGN KEY(task_id) REFERENCES tasks(task_id) ON DELETE CASCADE
+    )''')
+
+def _migration_indexes(cursor):
+    # Перед UNIQUE-индексом оставляем только первое решение по каждому заданию,
+    # а повторные переносим в submissions_duplicates, чтобы их можно было восстановить
+    duplicates = '''FROM submissions WHERE submission_id NOT IN (
+        SELECT MIN(submission_id) FROM submissions GROUP BY user_id, task_id
+    )'''
+    count = cursor.execute(f"SELECT COUNT(*) {duplicates}").fetchone()[0]
+    if count:
+        cursor.execute("CREATE TABLE IF NOT EXISTS submissions_duplicates AS SELECT * FROM submissions WHERE 0")
+        cursor.execute(f"INSERT INTO submissions_duplicates SELECT * {duplicates}")
+        cursor.execute(f"DELETE {duplicates}")
+        logger.warning(f"Повторные решения ({count}) перенесены в submissions_duplicates")
+    cursor.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_submissions_user_task ON submissions(user_id, task_id)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS ix_submissions_task_status ON submissions(task_id, status)"
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_modules_course ON modules(course_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_tasks_module ON tasks(module_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_users_current_course ON users(current_course)")
+
+
+def _migration_fsm_storage(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS fsm_storage (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL DEFAULT '{}',
+        updated_at REAL NOT NULL
+    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_fsm_storage_updated ON fsm_storage(updated_at)")
+
+
+def _migration_broadcasts(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS broadcasts (
+        broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        admin_chat_id INTEGER,
+        progress_message_id INTEGER,
+        status TEXT NOT NULL DEFAULT 'running' CHECK(status IN ('running', 'done')),
+        created_at timestamp DEFAULT CURRENT_TIMESTAMP
+    )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        broadcast_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending' CHECK(status IN ('pending', 'sent', 'failed')),
+        PRIMARY KEY (broadcast_id, user_id),
+        FOREIGN KEY(broadcast_id) REFERENCES broadcasts(broadcast_id) ON DELETE CASCADE
+    ) WITHOUT ROWID''')
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS ix_broadcast_recipients_status "
+        "ON broadcast_recipients(broadcast_id, status, user_id)"
+    )
+
+
+# Триггеры, поддерживающие course_stats/task_stats (миграция 5)
+STATS_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS trg_stats_course_insert AFTER INSERT ON courses
+    BEGIN
+        INSERT OR IGNORE INTO course_stats (course_id) VALUES (NEW.course_id);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_stats_course_delete AFTER DELETE ON courses
+    BEGIN
+        DELETE FROM course_stats WHERE course_id = OLD.course_id;
+        DELETE FROM task_stats WHERE course_id = OLD.course_id;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_stats_module_insert AFTER INSERT ON modules
+    BEGIN
+        UPDATE course_stats SET modules = modules + 1 WHERE course_id = NEW.course_id;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_stats_module_delete AFTER DELETE ON modules
+    BEGIN
+        UPDATE course_stats SET modules = modules - 1 WHERE course_id = OLD.course_id;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_stats_task_insert AFTER INSERT ON tasks
+    BEGIN
+        INSERT OR IGNORE INTO task_stats (task_id, course_id)
+            SELECT NEW.task_id, course_id FROM modules WHERE module_id = NEW.module_id;
+        UPDATE course_stats SET tasks = tasks + 1
+            WHERE course_id = (SELECT course_id FROM modules WHERE module_id = NEW.module_id);
+    END''',
+    # Вычитаем оставшиеся счетчики задания целиком: так результат не зависит
+    # от того, успели ли каскадно удалиться решения до этого триггера
+    '''CREATE TRIGGER IF NOT EXISTS trg_stats_task_delete AFTER DELETE ON tasks
+    BEGIN
+        UPDATE course_stats SET
+            tasks = tasks - 1,
+            submissions = submissions - IFNULL((SELECT submissions FROM task_stats WHERE task_id = OLD.task_id), 0),
+            accepted = accepted - IFNULL((SELECT accepted FROM task_stats WHERE task_id = OLD.task_id), 0),
+            rejected = rejected - IFNULL((SELECT rejected FROM task_stats WHERE task_id = OLD.task_id), 0),
+            pending = pending - IFNULL((SELECT pending FROM task_stats WHERE task_id = OLD.task_id), 0)
+        WHERE course_id = (SELECT course_id FROM task_stats WHERE task_id = OLD.task_id);
+        DELETE FROM task_stats WHERE task_id = OLD.task_id;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_stats_submission_insert AFTER INSERT ON submissions
+    BEGIN
+        UPDATE task_stats SET
+            submissions = submissions + 1,
+            accepted = accepted + (NEW.status IS 'accepted'),
+            rejected = rejected + (NEW.status IS 'rejected'),
+            pending = pending + (NEW.status IS 'pending')
+        WHERE task_id = NEW.task_id;
+        UPDATE course_stats SET
+            submissions = submissions + 1,
+            accepted = accepted + (NEW.status IS 'accepted'),
+            rejected = rejected + (NEW.status IS 'rejected'),
+            pending = pending + (NEW.status IS 'pending')
+        WHERE course_id = (SELECT course_id FROM task_stats WHERE task_id = NEW.task_id);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_stats_submission_status AFTER UPDATE OF status ON submissions
+    WHEN OLD.status IS NOT NEW.status
+    BEGIN
+        UPDATE task_stats SET
+            accepted = accepted + (NEW.status IS 'accepted') - (OLD.status IS 'accepted'),
+            rejected = rejected + (NEW.status IS 'rejected') - (OLD.status IS 'rejected'),
+            pending = pending + (NEW.status IS 'pending') - (OLD.status IS 'pending')
+        WHERE task_id = NEW.task_id;
+        UPDATE course_stats SET
+            accepted = accepted + (NEW.status IS 'accepted') - (OLD.status IS 'accepted'),
+            rejected = rejected + (NEW.status IS 'rejected') - (OLD.status IS 'rejected'),
+            pending = pending + (NEW.status IS 'pending') - (OLD.status IS 'pending')
+        WHERE course_id = (SELECT course_id FROM task_stats WHERE task_id = NEW.task_id);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_stats_submission_delete AFTER DELETE ON submissions
+    BEGIN
+        UPDATE task_stats SET
+            submissions = submissions - 1,
+            accepted = accepted - (OLD.status IS 'accepted'),
+            rejected = rejected - (OLD.status IS 'rejected'),
+            pending = pending - (OLD.status IS 'pending')
+        WHERE task_id = OLD.task_id;
+        UPDATE course_stats SET
+            submissions = submissions - 1,
+            accepted = accepted - (OLD.status IS 'accepted'),
+            rejected = rejected - (OLD.status IS 'rejected'),
+            pending = pending - (OLD.status IS 'pending')
+        WHERE course_id = (SELECT course_id FROM task_stats WHERE task_id = OLD.task_id);
+    END''',
+]
+
+
+def _migration_stats(cursor):
+    # Счетчики по курсам и заданиям поддерживаются триггерами; статистика
+    # читается одной выборкой вместо JOIN по всем решениям
+    cursor.execute('''CREATE TABLE IF NOT EXISTS course_stats (
+        course_id INTEGER PRIMARY KEY,
+        modules INTEGER NOT NULL DEFAULT 0,
+        tasks INTEGER NOT NULL DEFAULT 0,
+        submissions INTEGER NOT NULL DEFAULT 0,
+        accepted INTEGER NOT NULL DEFAULT 0,
+        rejected INTEGER NOT NULL DEFAULT 0,
+        pending INTEGER NOT NULL DEFAULT 0
+    )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS task_stats (
+        task_id INTEGER PRIMARY KEY,
+        course_id INTEGER NOT NULL,
+        submissions INTEGER NOT NULL DEFAULT 0,
+        accepted INTEGER NOT NULL DEFAULT 0,
+        rejected INTEGER NOT NULL DEFAULT 0,
+        pending INTEGER NOT NULL DEFAULT 0
+    )''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_task_stats_course ON task_stats(course_id)")
+
+    for trigger in STATS_TRIGGERS:
+        cursor.execute(trigger)
+    rebuild_stats(cursor)
+
+
+def rebuild_stats(cursor):
+    """Пересчитывает course_stats и task_stats с нуля по исходным таблицам."""
+    cursor.execute("DELETE FROM task_stats")
+    cursor.execute("DELETE FROM course_stats")
+    cursor.execute('''
+        INSERT INTO task_stats (task_id, course_id, submissions, accepted, rejected, pending)
+        SELECT t.task_id, m.course_id, COUNT(s.submission_id),
+               IFNULL(SUM(s.status IS 'accepted'), 0),
+               IFNULL(SUM(s.status IS 'rejected'), 0),
+               IFNULL(SUM(s.status IS 'pending'), 0)
+        FROM tasks t
+        JOIN modules m ON m.module_id = t.module_id
+        LEFT JOIN submissions s ON s.task_id = t.task_id
+        GROUP BY t.task_id
+    ''')
+    cursor.execute('''
+        INSERT INTO course_stats (course_id, modules, tasks, submissions, accepted, rejected, pending)
+        SELECT c.course_id,
+               (SELECT COUNT(*) FROM modules m WHERE m.course_id = c.course_id),
+               COUNT(ts.task_id),
+               IFNULL(SUM(ts.submissions), 0),
+               IFNULL(SUM(ts.accepted), 0),
+               IFNULL(SUM(ts.rejected), 0),
+               IFNULL(SUM(ts.pending), 0)
+        FROM courses c
+        LEFT JOIN task_stats ts ON ts.course_id = c.course_id
+        GROUP BY c.course_id
+    ''')
+    return cursor.execute("SELECT COUNT(*) FROM course_stats").fetchone()[0]
+
+
+def _migration_media_cache(cursor):
+    # Медиа из импортируемых пакетов загружаются в Telegram один раз:
+    # по хешу содержимого запоминается полученный file_id
+    cursor.execute('''CREATE TABLE IF NOT EXISTS media_cache (
+        sha256 TEXT NOT NULL,
+        kind TEXT NOT NULL CHECK(kind IN ('photo', 'document')),
+        file_id TEXT NOT NULL,
+        created_at timestamp DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (sha256, kind)
+    ) WITHOUT ROWID''')
+
+
+def _migration_review_queue(cursor):
+    # Очередь проверки: WHERE status = 'pending' ORDER BY submission_id (rowid в индексе)
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_submissions_status ON submissions(status)")
+
+
+def _migration_reviewers(cursor):
+    cursor.execute("ALTER TABLE submissions ADD COLUMN reviewer_id INTEGER")
+    cursor.execute("ALTER TABLE submissions ADD COLUMN lease_expires_at REAL")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS ix_submissions_reviewer ON submissions(reviewer_id, status)"
+    )
+    # Частичный индекс: фоновая задача ищет только ожидающие решения с истекшей арендой
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS ix_submissions_lease ON submissions(lease_expires_at) "
+        "WHERE status = 'pending'"
+    )
+    cursor.execute('''CREATE TABLE IF NOT EXISTS course_reviewers (
+        course_id INTEGER NOT NULL,
+        reviewer_id INTEGER NOT NULL,
+        PRIMARY KEY (course_id, reviewer_id),
+        FOREIGN KEY(course_id) REFERENCES courses(course_id) ON DELETE CASCADE
+    ) WITHOUT ROWID''')
+
+
+# rowid в catalog_fts кодирует тип и id записи: курс — id*3, модуль — id*3+1,
+# задание — id*3+2. Так триггеры меняют строку индекса по rowid без сканирования
+CATALOG_FTS_TRIGGERS = [
+    '''CREATE TRIGGER IF NOT EXISTS trg_fts_course_insert AFTER INSERT ON courses
+    BEGIN
+        INSERT INTO catalog_fts (rowid, title, body)
+            VALUES (NEW.course_id * 3, NEW.title, COALESCE(NEW.description, ''));
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_fts_course_update AFTER UPDATE OF title, description ON courses
+    BEGIN
+        UPDATE catalog_fts SET title = NEW.title, body = COALESCE(NEW.description, '')
+            WHERE rowid = NEW.course_id * 3;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_fts_course_delete AFTER DELETE ON courses
+    BEGIN
+        DELETE FROM catalog_fts WHERE rowid = OLD.course_id * 3;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_fts_module_insert AFTER INSERT ON modules
+    BEGIN
+        INSERT INTO catalog_fts (rowid, title, body) VALUES (NEW.module_id * 3 + 1, NEW.title, '');
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_fts_module_update AFTER UPDATE OF title ON modules
+    BEGIN
+        UPDATE catalog_fts SET title = NEW.title WHERE rowid = NEW.module_id * 3 + 1;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_fts_module_delete AFTER DELETE ON modules
+    BEGIN
+        DELETE FROM catalog_fts WHERE rowid = OLD.module_id * 3 + 1;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_fts_task_insert AFTER INSERT ON tasks
+    BEGIN
+        INSERT INTO catalog_fts (rowid, title, body)
+            VALUES (NEW.task_id * 3 + 2, NEW.title, COALESCE(NEW.content, ''));
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_fts_task_update AFTER UPDATE OF title, content ON tasks
+    BEGIN
+        UPDATE catalog_fts SET title = NEW.title, body = COALESCE(NEW.content, '')
+            WHERE rowid = NEW.task_id * 3 + 2;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS trg_fts_task_delete AFTER DELETE ON tasks
+    BEGIN
+        DELETE FROM catalog_fts WHERE rowid = OLD.task_id * 3 + 2;
+    END''',
+]
+
+
+def _migration_catalog_search(cursor):
+    cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS catalog_fts USING fts5(
+        title,
+        body,
+        tokenize = 'unicode61 remove_diacritics 2'
+    )''')
+    for trigger in CATALOG_FTS_TRIGGERS:
+        cursor.execute(trigger)
+    cursor.execute('''INSERT INTO catalog_fts (rowid, title, body)
+        SELECT course_id * 3, title, COALESCE(description, '') FROM courses
+        UNION ALL
+        SELECT module_id * 3 + 1, title, '' FROM modules
+        UNION ALL
+        SELECT task_id * 3 + 2, title, COALESCE(content, '') FROM tasks''')
+
+
+# Таблица → кеш в памяти, который нужно перечитать после ее изменения
+CACHE_VERSION_TABLES = {
+    'courses': 'catalog',
+    'modules': 'catalog',
+    'tasks': 'catalog',
+    'course_reviewers': 'reviewers',
+    'users': 'profiles',
+}
+
+CACHE_VERSION_TRIGGERS = [
+    f'''CREATE TRIGGER IF NOT EXISTS trg_cache_{table}_{event.lower()} AFTER {event} ON {table}
+    BEGIN
+        UPDATE cache_versions SET version = version + 1 WHERE name = '{name}';
+    END'''
+    for table, name in CACHE_VERSION_TABLES.items()
+    for event in ('INSERT', 'UPDATE', 'DELETE')
+]
+
+
+def _migration_cache_versions(cursor):
+    # Версии кешей растут триггерами при любой записи, в том числе с других экземпляров
+    cursor.execute('''CREATE TABLE IF NOT EXISTS cache_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID''')
+    cursor.executemany(
+        "INSERT OR IGNORE INTO cache_versions (name) VALUES (?)",
+        [(name,) for name in sorted(set(CACHE_VERSION_TABLES.values()))]
+    )
+    for trigger in CACHE_VERSION_TRIGGERS:
+        cursor.execute(trigger)
+
+
+def _migration_review_pushes(cursor):
+    # Кому решение уже присылалось: при переназначении повторно не присылаем
+    cursor.execute('''CREATE TABLE IF NOT EXISTS review_pushes (
+        submission_id INTEGER NOT NULL,
+        reviewer_id INTEGER NOT NULL,
+        PRIMARY KEY (submission_id, reviewer_id),
+        FOREIGN KEY(submission_id) REFERENCES submissions(submission_id) ON DELETE CASCADE
+    ) WITHOUT ROWID''')
+    cursor.execute('''INSERT OR IGNORE INTO review_pushes (submission_id, reviewer_id)
+        SELECT submission_id, reviewer_id FROM submissions
+        WHERE status = 'pending' AND reviewer_id IS NOT NULL''')
+
+
+# Упорядоченный список миграций: (версия, описание, функция)
+MIGRATIONS = [
+    (1, "initial schema", _migration_initial),
+    (2, "secondary indexes and unique submissions", _migration_indexes),
+    (3, "persistent FSM storage", _migration_fsm_storage),
+    (4, "broadcast jobs", _migration_broadcasts),
+    (5, "materialized course and task statistics", _migration_stats),
+    (6, "uploaded media cache", _migration_media_cache),
+    (7, "pending review queue index", _migration_review_queue),
+    (8, "reviewer assignment and leases", _migration_reviewers),
+    (9, "full-text catalog search", _migration_catalog_search),
+    (10, "cache versions for multi-instance invalidation", _migration_cache_versions),
+    (11, "review push history", _migration_review_pushes),
+]
+
+
+def run_migrations(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at timestamp DEFAULT CURRENT_TIMESTAMP
+    )''')
+    conn.commit()
+
+    for version, description, migrate in MIGRATIONS:
+        cursor = conn.cursor()
+        # BEGIN IMMEDIATE не даст двум экземплярам бота применить миграцию дважды
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            cursor.execute("SELECT 1 FROM schema_version WHERE version = ?", (version,))
+            if cursor.fetchone():
+                conn.rollback()
+                continue
+            logger.info(f"Применяется миграция {version}: {description}")
+            migrate(cursor)
+            cursor.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description)
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+# Горячие запросы и таблицы, которые они не должны просматривать целиком
+HOT_QUERIES = [
+    ("task_selected",
+     "SELECT status, score FROM submissions WHERE user_id = ? AND task_id = ?", (0, 0),
+     ("submissions",)),
+    ("modules_kb",
+     "SELECT module_id, title FROM modules WHERE course_id = ?", (0,),
+     ("modules",)),
+    ("module_selected",
+     "SELECT task_id, title FROM tasks WHERE module_id = ?", (0,),
+     ("tasks",)),
+    ("show_stats",
+     "SELECT c.title FROM course_stats s JOIN courses c ON c.course_id = s.course_id", (),
+     ("s",)),
+    ("review_queue",
+     '''SELECT s.submission_id FROM submissions s JOIN users u ON u.user_id = s.user_id
+        WHERE s.status = 'pending' AND s.submission_id > ? ORDER BY s.submission_id LIMIT 9''', (0,),
+     ("s",)),
+    ("expired_leases",
+     "SELECT submission_id FROM submissions "
+     "WHERE status = 'pending' AND (lease_expires_at < ? OR lease_expires_at IS NULL)", (0,),
+     ("submissions",)),
+    ("list_users",
+     '''SELECT u.user_id, (SELECT COUNT(*) FROM submissions s WHERE s.user_id = u.user_id)
+        FROM users u WHERE user_id > ? AND current_course = ? ORDER BY u.user_id LIMIT 21''', (0, 0),
+     ("u", "s")),
+]
+
+
+def check_query_plans(cursor):
+    """Проверяет через EXPLAIN QUERY PLAN, что горячие запросы используют индексы.
+
+    Возвращает список (имя запроса, строка плана) для найденных полных сканов.
+    """
+    problems = []
+    for name, sql, params, tables in HOT_QUERIES:
+        for row in cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall():
+            detail = row[3]
+            for table in tables:
+                if detail in (f"SCAN {table}", f"SCAN TABLE {table}"):
+                    problems.append((name, detail))
+    return problems
+
+
+def init_db():
+    # Миграции применяются один раз при запуске, а не при каждом соединении
+    conn = db_pool.acquire()
+    try:
+        run_migrations(conn)
+        for name, detail in check_query_plans(conn.cursor()):
+            logger.warning(f"Запрос {name} не использует индекс: {detail}")
+        catalog.load(conn.cursor())
+        reviewers.load(conn.cursor())
+        cache_sync.load(conn.cursor())
+    finally:
+        db_pool.release(conn)
+
+
+class WriteQueue:
+    """Единственный поток-писатель SQLite.
+
+    Запросы на запись накапливаются в очереди и выполняются пачкой в одной
+    транзакции: каждая операция — в своем SAVEPOINT, так что ошибка одной
+    не откатывает остальные, а коммит (и fsync) один на всю пачку.
+    """
+
+    def __init__(self, pool: ConnectionPool, batch_size: int = 100, batch_delay: float = 0.002):
+        self._pool = pool
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args) -> Future:
+        future = Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+                self._thread.start()
+        self._queue.put((func, args, future))
+        return future
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        conn = self._pool._connect()
+        conn.isolation_level = None  # транзакциями управляем вручную
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+                self._commit(conn, self._collect(item))
+        finally:
+            conn.close()
+
+    def _commit(self, conn, batch):
+        cursor = conn.cursor()
+        timed = conn.cursor(DB_CURSOR)
+        results = []
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for func, args, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                cursor.execute("SAVEPOINT write_item")
+                try:
+                    results.append((future, func(timed, *args), None))
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT write_item")
+                    results.append((future, None, e))
+                cursor.execute("RELEASE SAVEPOINT write_item")
+            cursor.execute("COMMIT")
+        except Exception as e:
+            logger.error(f"Ошибка пакетной записи в БД: {e}")
+            if conn.in_transaction:
+                conn.rollback()
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+
+class AsyncDatabase:
+    """Асинхронный слой доступа к БД.
+
+    Чтение выполняется в пуле потоков на соединениях из ConnectionPool,
+    запись — через WriteQueue, поэтому обработчики не блокируют цикл событий
+    на дисковых операциях, а пишущие запросы не мешают читающим.
+    """
+
+    def __init__(self, workers: int, writer: WriteQueue):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="db")
+        self._writer = writer
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args))
+
+    @staticmethod
+    def _in_transaction(func, *args):
+        with Database() as cursor:
+            return func(cursor, *args)
+
+    async def read(self, func, *args):
+        """Выполняет func(cursor, *args) на читающем соединении."""
+        return await self.run(self._in_transaction, func, *args)
+
+    async def transaction(self, func, *args):
+        """Выполняет func(cursor, *args) в очереди записи и возвращает результат."""
+        return await asyncio.wrap_future(self._writer.submit(func, *args))
+
+    async def fetchone(self, sql: str, params=()):
+        return await self.read(lambda cursor: cursor.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params=()):
+        return await self.read(lambda cursor: cursor.execute(sql, params).fetchall())
+
+    async def execute(self, sql: str, params=()):
+        """Выполняет запрос на запись и возвращает lastrowid."""
+        return await self.transaction(lambda cursor: cursor.execute(sql, params).lastrowid)
+
+    def close(self):
+        self._writer.close()
+        self._executor.shutdown(wait=True)
+
+
+db = AsyncDatabase(
+    workers=db_pool.size,
+    writer=WriteQueue(
+        db_pool,
+        batch_size=DB_WRITE_BATCH_SIZE,
+        batch_delay=DB_WRITE_BATCH_DELAY_MS / 1000
+    )
+)
+
+### BLOCK 2.1: FSM STORAGE ###
+class _FSMRecord:
+    __slots__ = ('state', 'data', 'touched')
+
+    def __init__(self, state: Optional[str] = None, data: Optional[dict] = None):
+        self.state = state
+        self.data = data or {}
+        self.touched = time.monotonic()
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm_storage той же БД.
+
+    Состояния читаются в кеш при первом обращении, изменения копятся в
+    памяти и раз в flush_interval записываются одной транзакцией. Записи,
+    не менявшиеся дольше ttl, удаляются как брошенные, а чистые записи,
+    к которым не обращались cache_idle секунд, вытесняются из кеша.
+
+    Кеш с отложенной записью корректен только для одного экземпляра бота:
+    другой экземпляр не видит несохраненных изменений и перезаписывает их.
+    С shared=True (FSM_SHARED=1, несколько экземпляров на одной БД) кеш
+    отключается: каждое чтение идет в БД, а set_state и set_data сразу
+    обновляют только свой столбец, не затирая изменения других экземпляров.
+    """
+
+    def __init__(self, database: AsyncDatabase, ttl: float, flush_interval: float,
+                 cache_idle: float, key_builder: Optional[KeyBuilder] = None, shared: bool = False):
+        self._db = database
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.cache_idle = cache_idle
+        self.shared = shared
+        self._key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache: Dict[str, _FSMRecord] = {}
+        self._dirty = set()
+        self._flush_task = None
+
+    async def _load(self, storage_key: str) -> _FSMRecord:
+        row = await self._db.fetchone(
+            "SELECT state, data FROM fsm_storage WHERE key = ?", (storage_key,)
+        )
+        return _FSMRecord(row['state'], json.loads(row['data'])) if row else _FSMRecord()
+
+    async def _record(self, key: StorageKey) -> Tuple[str, _FSMRecord]:
+        storage_key = self._key_builder.build(key)
+        if self.shared:
+            return storage_key, await self._load(storage_key)
+        record = self._cache.get(storage_key)
+        if record is None:
+            record = self._cache.setdefault(storage_key, await self._load(storage_key))
+        record.touched = time.monotonic()
+        return storage_key, record
+
+    async def _write_column(self, key: StorageKey, column: str, value):
+        """Сквозная запись одного столбца для режима shared."""
+        storage_key = self._key_builder.build(key)
+
+        def _write(cursor):
+            cursor.execute(
+                f"INSERT INTO fsm_storage (key, {column}, updated_at) VALUES (?, ?, ?) "
+                f"ON CONFLICT(key) DO UPDATE SET {column} = excluded.{column}, updated_at = excluded.updated_at",
+                (storage_key, value, time.time())
+            )
+            if value is None or value == '{}':
+                # После state.clear() запись пуста — удаляем ее, как это делает flush()
+                cursor.execute(
+                    "DELETE FROM fsm_storage WHERE key = ? AND state IS NULL AND data = '{}'",
+                    (storage_key,)
+                )
+
+        await self._db.transaction(_write)
+        # Фоновая задача здесь только удаляет брошенные состояния
+        self._start_loop()
+
+    def _mark_dirty(self, storage_key: str):
+        self._dirty.add(storage_key)
+        self._start_loop()
+
+    def _start_loop(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state = state.state if isinstance(state, State) else state
+        if self.shared:
+            await self._write_column(key, "state", state)
+            return
+        storage_key, record = await self._record(key)
+        record.state = state
+        self._mark_dirty(storage_key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, record = await self._record(key)
+        return record.state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        if self.shared:
+            await self._write_column(key, "data", json.dumps(data, ensure_ascii=False))
+            return
+        storage_key, record = await self._record(key)
+        record.data = data.copy()
+        self._mark_dirty(storage_key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, record = await self._record(key)
+        return record.data.copy()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        now = time.time()
+        upserts, deletes = [], []
+        for storage_key in dirty:
+            record = self._cache.get(storage_key)
+            if record is None or (record.state is None and not record.data):
+                deletes.append((storage_key,))
+            else:
+                upserts.append((storage_key, record.state, json.dumps(record.data, ensure_ascii=False), now))
+
+        def _write(cursor):
+            cursor.executemany(
+                "INSERT INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = excluded.state, "
+                "data = excluded.data, updated_at = excluded.updated_at",
+                upserts
+            )
+            cursor.executemany("DELETE FROM fsm_storage WHERE key = ?", deletes)
+
+        try:
+            await self._db.transaction(_write)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения FSM: {e}")
+            self._dirty |= dirty
+
+    async def expire(self):
+        # Брошенные состояния удаляются из БД, давно неиспользуемые — из кеша
+        await self._db.execute(
+            "DELETE FROM fsm_storage WHERE updated_at < ?", (time.time() - self.ttl,)
+        )
+        now = time.monotonic()
+        for storage_key, record in list(self._cache.items()):
+            idle = now - record.touched
+            if storage_key in self._dirty:
+                continue
+            if idle > self.cache_idle or idle > self.ttl:
+                del self._cache[storage_key]
+
+    async def _flush_loop(self):
+        last_expire = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if time.monotonic() - last_expire > min(self.ttl, 60):
+                last_expire = time.monotonic()
+                try:
+                    await self.expire()
+                except Exception as e:
+                    logger.error(f"Ошибка очистки FSM: {e}")
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+
+fsm_storage = SQLiteStorage(
+    db,
+    ttl=float(os.getenv('FSM_TTL', str(7 * 24 * 3600))),
+    flush_interval=float(os.getenv('FSM_FLUSH_INTERVAL', '1')),
+    cache_idle=float(os.getenv('FSM_CACHE_IDLE', '600')),
+    # 1 — несколько экземпляров бота на одной БД: без кеша, запись сразу
+    shared=os.getenv('FSM_SHARED', '0').lower() in ('1', 'true', 'yes')
+)
+dp = Dispatcher(storage=fsm_storage)
+
+### BLOCK 2.2: CATALOG CACHE ###
+class CourseEntry(NamedTuple):
+    course_id: int
+    title: str
+    description: Optional[str]
+    media_id: Optional[str]
+    module_ids: Tuple[int, ...] = ()
+
+
+class ModuleEntry(NamedTuple):
+    module_id: int
+    course_id: int
+    title: str
+    media_id: Optional[str]
+    task_ids: Tuple[int, ...] = ()
+
+
+class TaskEntry(NamedTuple):
+    task_id: int
+    module_id: int
+    title: str
+    content: str
+    file_id: Optional[str]
+
+
+class CatalogCache:
+    """Дерево курс → модуль → задание в памяти процесса.
+
+    Загружается один раз при запуске и обновляется обработчиками
+    администратора при каждой записи, поэтому навигация студентов
+    по каталогу не обращается к SQLite. version растет при каждом изменении.
+    """
+
+    def __init__(self):
+        self.courses: Dict[int, CourseEntry] = {}
+        self.modules: Dict[int, ModuleEntry] = {}
+        self.tasks: Dict[int, TaskEntry] = {}
+        self.version = 0
+
+    def load(self, cursor):
+        courses = {
+            row['course_id']: CourseEntry(row['course_id'], row['title'], row['description'], row['media_id'])
+            for row in cursor.execute(
+                "SELECT course_id, title, description, media_id FROM courses ORDER BY course_id"
+            )
+        }
+        modules = {
+            row['module_id']: ModuleEntry(row['module_id'], row['course_id'], row['title'], row['media_id'])
+            for row in cursor.execute(
+                "SELECT module_id, course_id, title, media_id FROM modules ORDER BY module_id"
+            )
+        }
+        tasks = {
+            row['task_id']: TaskEntry(row['task_id'], row['module_id'], row['title'], row['content'], row['file_id'])
+            for row in cursor.execute(
+                "SELECT task_id, module_id, title, content, file_id FROM tasks ORDER BY task_id"
+            )
+        }
+
+        module_tasks = {}
+        for task in tasks.values():
+            module_tasks.setdefault(task.module_id, []).append(task.task_id)
+        course_modules = {}
+        for module in modules.values():
+            modules[module.module_id] = module._replace(task_ids=tuple(module_tasks.get(module.module_id, ())))
+            course_modules.setdefault(module.course_id, []).append(module.module_id)
+        for course in courses.values():
+            courses[course.course_id] = course._replace(
+                module_ids=tuple(course_modules.get(course.course_id, ()))
+            )
+
+        self.courses, self.modules, self.tasks = courses, modules, tasks
+        self.version += 1
+
+    def course_modules(self, course_id: int) -> List[ModuleEntry]:
+        course = self.courses.get(course_id)
+        return [self.modules[module_id] for module_id in course.module_ids] if course else []
+
+    def module_tasks(self, module_id: int) -> List[TaskEntry]:
+        module = self.modules.get(module_id)
+        return [self.tasks[task_id] for task_id in module.task_ids] if module else []
+
+    def add_course(self, course_id: int, title: str, description: Optional[str], media_id: Optional[str]):
+        self.courses[course_id] = CourseEntry(course_id, title, description, media_id)
+        self.version += 1
+
+    def add_module(self, module_id: int, course_id: int, title: str, media_id: Optional[str] = None):
+        self.modules[module_id] = ModuleEntry(module_id, course_id, title, media_id)
+        course = self.courses.get(course_id)
+        if course:
+            self.courses[course_id] = course._replace(module_ids=course.module_ids + (module_id,))
+        self.version += 1
+
+    def add_task(self, task_id: int, module_id: int, title: str, content: str, file_id: Optional[str]):
+        self.tasks[task_id] = TaskEntry(task_id, module_id, title, content, file_id)
+        module = self.modules.get(module_id)
+        if module:
+            self.modules[module_id] = module._replace(task_ids=module.task_ids + (task_id,))
+        self.version += 1
+
+    def remove_course(self, course_id: int):
+        course = self.courses.pop(course_id, None)
+        if course:
+            for module_id in course.module_ids:
+                module = self.modules.pop(module_id, None)
+                for task_id in (module.task_ids if module else ()):
+                    self.tasks.pop(task_id, None)
+        self.version += 1
+
+
+catalog = CatalogCache()
+
+
+class KeyboardCache:
+    """Готовые InlineKeyboardMarkup по ключу (вид, аргументы, версия каталога).
+
+    При смене версии каталога старые клавиатуры отбрасываются целиком.
+    """
+
+    def __init__(self, catalog: CatalogCache):
+        self._catalog = catalog
+        self._markups = {}
+        self._version = catalog.version
+
+    def get(self, kind: str, args: tuple, build):
+        if self._version != self._catalog.version:
+            self._markups.clear()
+            self._version = self._catalog.version
+        key = (kind, args, self._version)
+        markup = self._markups.get(key)
+        if markup is None:
+            markup = self._markups[key] = build(*args)
+        return markup
+
+
+keyboard_cache = KeyboardCache(catalog)
+
+
+def cached_keyboard(kind: str):
+    """Декоратор для построителей клавиатур, зависящих только от каталога."""
+    def decorator(build):
+        @functools.wraps(build)
+        def wrapper(*args):
+            return keyboard_cache.get(kind, args, build)
+        return wrapper
+    return decorator
+
+### BLOCK 2.3: TELEGRAM DELIVERY ###
+class TokenBucket:
+    """Асинхронный token bucket: rate токенов в секунду, не больше capacity."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> bool:
+        """Неблокирующий вариант acquire: False, если токенов нет."""
+        self._refill(time.monotonic())
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def full(self) -> bool:
+        self._refill(time.monotonic())
+        return self._tokens >= self.capacity
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class SendRateLimiter:
+    """Глобальный лимит Bot API плюс минимальный интервал между сообщениями в один чат."""
+
+    def __init__(self, global_rate: float, chat_interval: float):
+        self.bucket = TokenBucket(global_rate, global_rate)
+        self.chat_interval = chat_interval
+        self._chat_next: Dict[int, float] = {}
+
+    def chat_delay(self, chat_id) -> float:
+        """Сколько ждать до отправки в чат; при нуле слот сразу резервируется."""
+        now = time.monotonic()
+        ready_at = self._chat_next.get(chat_id, 0.0)
+        if ready_at > now:
+            return ready_at - now
+        self._chat_next[chat_id] = now + self.chat_interval
+        if len(self._chat_next) > 10000:
+            self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+        return 0.0
+
+    def defer_chat(self, chat_id, seconds: float):
+        self._chat_next[chat_id] = max(self._chat_next.get(chat_id, 0.0), time.monotonic() + seconds)
+
+
+send_limiter = SendRateLimiter(
+    global_rate=float(os.getenv('SEND_RATE', '25')),
+    chat_interval=float(os.getenv('SEND_CHAT_INTERVAL', '1'))
+)
+
+
+_OUTBOX_WORKER = contextvars.ContextVar('outbox_worker', default=False)
+
+
+class _Outgoing:
+    __slots__ = ('method', 'future', 'enqueued_at', 'attempts')
+
+    def __init__(self, method: TelegramMethod, future: asyncio.Future):
+        self.method = method
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+class OutboundQueue:
+    """Центральная очередь исходящих запросов к Bot API.
+
+    Запросы в один чат уходят строго по порядку, разные чаты обслуживаются
+    параллельно workers задачами в рамках общего лимита SendRateLimiter.
+    RetryAfter приостанавливает отправку, сетевые и серверные ошибки
+    повторяются с экспоненциальной задержкой. Очередь ограничена max_size
+    запросами: send() ждет, пока освободится место. Ответы обработчиков
+    идут мимо очереди, но в пределах того же лимита (DirectSendLimitMiddleware).
+    """
+
+    def __init__(self, limiter: SendRateLimiter, workers: int = 8, max_size: int = 10000,
+                 max_attempts: int = 5, base_delay: float = 1.0):
+        self._limiter = limiter
+        self.workers = workers
+        self.max_size = max_size
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self._chats: Dict[Any, deque] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._tasks: List[asyncio.Task] = []
+        self.depth = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.latency_avg = 0.0
+        self.latency_max = 0.0
+
+    def _ensure_started(self):
+        if not self._tasks:
+            self._ready = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.max_size)
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    @staticmethod
+    def _consume(future: asyncio.Future):
+        # Ошибки доставки уже залогированы; помечаем их как полученные
+        if not future.cancelled():
+            future.exception()
+
+    async def send(self, method: TelegramMethod) -> asyncio.Future:
+        """Ставит запрос в очередь и возвращает future с результатом отправки."""
+        self._ensure_started()
+        await self._slots.acquire()
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(self._consume)
+        chat_id = method.chat_id
+        if isinstance(chat_id, str) and chat_id.lstrip('-').isdigit():
+            chat_id = int(chat_id)
+        queue_ = self._chats.get(chat_id)
+        if queue_ is None:
+            queue_ = self._chats[chat_id] = deque()
+            self._ready.put_nowait(chat_id)
+        queue_.append(_Outgoing(method, future))
+        self.depth += 1
+        return future
+
+    def _reschedule(self, chat_id, delay: float = 0.0):
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, chat_id)
+        else:
+            self._ready.put_nowait(chat_id)
+
+    def _finish(self, item: _Outgoing, result=None, error: Optional[BaseException] = None):
+        self.depth -= 1
+        self._slots.release()
+        latency = time.monotonic() - item.enqueued_at
+        OUTBOX_SECONDS.observe(latency)
+        self.latency_avg = latency if not self.sent else self.latency_avg * 0.9 + latency * 0.1
+        self.latency_max = max(self.latency_max, latency)
+        if item.future.done():
+            return
+        if error is not None:
+            self.failed += 1
+            item.future.set_exception(error)
+        else:
+            self.sent += 1
+            item.future.set_result(result)
+
+    async def _worker(self):
+        # Токен лимита worker берет сам, DirectSendLimitMiddleware его не трогает
+        _OUTBOX_WORKER.set(True)
+        while True:
+            chat_id = await self._ready.get()
+            queue_ = self._chats.get(chat_id)
+            if not queue_:
+                self._chats.pop(chat_id, None)
+                continue
+
+            delay = self._limiter.chat_delay(chat_id)
+            if delay > 0:
+                self._reschedule(chat_id, delay)
+                continue
+            await self._limiter.bucket.acquire()
+
+            item = queue_[0]
+            item.attempts += 1
+            try:
+                result = await bot(item.method)
+            except TelegramRetryAfter as e:
+                self.retried += 1
+                self._limiter.bucket.pause(e.retry_after)
+                self._reschedule(chat_id, e.retry_after)
+                continue
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if item.attempts < self.max_attempts:
+                    self.retried += 1
+                    backoff = self.base_delay * 2 ** (item.attempts - 1)
+                    logger.warning(f"Повтор отправки в {chat_id} через {backoff} с: {e}")
+                    self._limiter.defer_chat(chat_id, backoff)
+                    self._reschedule(chat_id, backoff)
+                    continue
+                queue_.popleft()
+                logger.error(f"Не удалось отправить в {chat_id}: {e}")
+                self._finish(item, error=e)
+            except Exception as e:
+                queue_.popleft()
+                logger.error(f"Ошибка отправки в {chat_id}: {e}")
+                self._finish(item, error=e)
+            else:
+                queue_.popleft()
+                self._finish(item, result=result)
+
+            if queue_:
+                self._reschedule(chat_id)
+            else:
+                self._chats.pop(chat_id, None)
+
+    def metrics(self) -> Dict[str, float]:
+        return {
+            "depth": self.depth,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "latency_avg": round(self.latency_avg, 3),
+            "latency_max": round(self.latency_max, 3),
+        }
+
+    async def close(self, timeout: float):
+        if not self._tasks:
+            return
+        deadline = time.monotonic() + timeout
+        while self.depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for queue_ in self._chats.values():
+            for item in queue_:
+                item.future.cancel()
+        self._chats.clear()
+        self.depth = 0
+
+
+outbox = OutboundQueue(
+    send_limiter,
+    workers=int(os.getenv('OUTBOX_WORKERS', '8')),
+    max_size=int(os.getenv('OUTBOX_MAX_SIZE', '10000')),
+    max_attempts=int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))
+)
+
+
+class DirectSendLimitMiddleware(BaseRequestMiddleware):
+    """Прямые отправки и правки сообщений расходуют тот же SEND_RATE, что и outbox.
+
+    Ответы обработчиков (message.answer*, edit_*) не ставятся в OutboundQueue:
+    они должны уйти по порядку с остальными действиями обработчика, а интервал
+    SEND_CHAT_INTERVAL задержал бы на секунду каждую следующую часть ответа.
+    Поэтому они берут токен из общего bucket перед запросом, а RetryAfter
+    на прямом запросе приостанавливает и очередь рассылок.
+    """
+
+    PREFIXES = ('Send', 'Edit', 'Copy', 'Forward')
+
+    def __init__(self, limiter: SendRateLimiter):
+        self._limiter = limiter
+
+    async def __call__(self, make_request, bot, method):
+        if _OUTBOX_WORKER.get() or not type(method).__name__.startswith(self.PREFIXES):
+            return await make_request(bot, method)
+        await self._limiter.bucket.acquire()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            self._limiter.bucket.pause(e.retry_after)
+            raise
+
+
+bot.session.middleware(DirectSendLimitMiddleware(send_limiter))
+
+
+class BroadcastEngine:
+    """Массовые рассылки с очередью получателей в БД.
+
+    Получатели обрабатываются пачками по batch_size с concurrency
+    одновременными отправками через OutboundQueue; результат каждой пачки
+    сохраняется сразу, поэтому после перезапуска рассылка продолжается
+    с неотправленных.
+    """
+
+    def __init__(self, database: AsyncDatabase, sender: OutboundQueue,
+                 concurrency: int = 10, batch_size: int = 50):
+        self._db = database
+        self._sender = sender
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self._tasks: Dict[int, asyncio.Task] = {}
+
+    async def create(self, text: str, user_ids, admin_chat_id: Optional[int] = None) -> int:
+        def _create(cursor):
+            cursor.execute(
+                "INSERT INTO broadcasts (text, admin_chat_id) VALUES (?, ?)",
+                (text, admin_chat_id)
+            )
+            broadcast_id = cursor.lastrowid
+            cursor.executemany(
+                "INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, user_id) VALUES (?, ?)",
+                ((broadcast_id, user_id) for user_id in user_ids)
+            )
+            return broadcast_id
+
+        return await self._db.transaction(_create)
+
+    def start(self, broadcast_id: int):
+        if broadcast_id not in self._tasks:
+            task = asyncio.create_task(self._run(broadcast_id))
+            self._tasks[broadcast_id] = task
+            task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def resume(self):
+        for row in await self._db.fetchall("SELECT broadcast_id FROM broadcasts WHERE status = 'running'"):
+            logger.info(f"Возобновляется рассылка #{row['broadcast_id']}")
+            self.start(row['broadcast_id'])
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _deliver(self, user_id: int, text: str) -> bool:
+        # Повторы и RetryAfter обрабатывает очередь отправки
+        try:
+            await (await self._sender.send(SendMessage(chat_id=user_id, text=text)))
+            return True
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            return False
+
+    async def _counts(self, broadcast_id: int):
+        rows = await self._db.fetchall(
+            "SELECT status, COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? GROUP BY status",
+            (broadcast_id,)
+        )
+        return {row[0]: row[1] for row in rows}
+
+    async def _report(self, job, counts, done: bool = False):
+        if not job['admin_chat_id']:
+            return
+        total = sum(counts.values())
+        text = (f"📢 Рассылка #{job['broadcast_id']}{' завершена' if done else ''}\n"
+                f"Отправлено: {counts.get('sent', 0)}/{total}\n"
+                f"Ошибок: {counts.get('failed', 0)}")
+        # Пока рассылка стоит (например, после RetryAfter), счетчики не меняются:
+        # повторная правка тем же текстом получила бы «message is not modified»
+        if text == job.get('progress_text'):
+            return
+        job['progress_text'] = text
+        try:
+            if job['progress_message_id']:
+                await self._sender.send(EditMessageText(
+                    text=text, chat_id=job['admin_chat_id'], message_id=job['progress_message_id']
+                ))
+            else:
+                message = await (await self._sender.send(
+                    SendMessage(chat_id=job['admin_chat_id'], text=text)
+                ))
+                await self._db.execute(
+                    "UPDATE broadcasts SET progress_message_id = ? WHERE broadcast_id = ?",
+                    (message.message_id, job['broadcast_id'])
+                )
+                job['progress_message_id'] = message.message_id
+        except Exception as e:
+            logger.error(f"Ошибка отчета о рассылке: {e}")
+
+    async def _run(self, broadcast_id: int):
+        row = await self._db.fetchone(
+            "SELECT broadcast_id, text, admin_chat_id, progress_message_id "
+            "FROM broadcasts WHERE broadcast_id = ?",
+            (broadcast_id,)
+        )
+        if not row:
+            return
+        job = dict(row)
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(user_id):
+            async with semaphore:
+                return user_id, await self._deliver(user_id, job['text'])
+
+        await self._report(job, await self._counts(broadcast_id))
+        last_report = time.monotonic()
+        last_user_id = 0
+        while True:
+            batch = await self._db.fetchall(
+                "SELECT user_id FROM broadcast_recipients "
+                "WHERE broadcast_id = ? AND status = 'pending' AND user_id > ? "
+                "ORDER BY user_id LIMIT ?",
+                (broadcast_id, last_user_id, self.batch_size)
+            )
+            if not batch:
+                break
+            last_user_id = batch[-1]['user_id']
+            results = await asyncio.gather(*(deliver(row['user_id']) for row in batch))
+
+            def _save(cursor):
+                cursor.executemany(
+                    "UPDATE broadcast_recipients SET status = ? WHERE broadcast_id = ? AND user_id = ?",
+                    (("sent" if ok else "failed", broadcast_id, user_id) for user_id, ok in results)
+                )
+
+            await self._db.transaction(_save)
+            if time.monotonic() - last_report > 3:
+                await self._report(job, await self._counts(broadcast_id))
+                last_report = time.monotonic()
+
+        await self._db.execute(
+            "UPDATE broadcasts SET status = 'done' WHERE broadcast_id = ?", (broadcast_id,)
+        )
+        await self._report(job, await self._counts(broadcast_id), done=True)
+
+
+broadcasts = BroadcastEngine(
+    db,
+    outbox,
+    concurrency=int(os.getenv('BROADCAST_CONCURRENCY', '10')),
+    batch_size=int(os.getenv('BROADCAST_BATCH_SIZE', '50'))
+)
+
+### BLOCK 2.4: CSV EXPORTS ###
+class CsvExporter:
+    """Фоновая выгрузка результатов запроса в CSV-файл.
+
+    Строки читаются из курсора пачками по fetch_size и сразу пишутся во
+    временный файл (при compress — через gzip) в потоке AsyncDatabase,
+    поэтому память не зависит от размера выборки. Готовый файл
+    отправляется документом через OutboundQueue и удаляется.
+    Одновременно — одна выгрузка на ключ.
+    """
+
+    def __init__(self, database: AsyncDatabase, sender: OutboundQueue, fetch_size: int = 500):
+        self._db = database
+        self._sender = sender
+        self.fetch_size = fetch_size
+        self._tasks: Dict[Any, asyncio.Task] = {}
+
+    def start(self, key, chat_id: int, filename: str, header: List[str],
+              sql: str, params=(), caption: Optional[str] = None, compress: bool = False) -> bool:
+        """Запускает выгрузку; False, если выгрузка с таким ключом уже идет."""
+        if key in self._tasks:
+            return False
+        if compress:
+            filename += ".gz"
+        task = asyncio.create_task(self._run(chat_id, filename, header, sql, params, caption, compress))
+        self._tasks[key] = task
+        task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        return True
+
+    def _batches(self, cursor, sql: str, params):
+        cursor.execute(sql, params)
+        while True:
+            batch = cursor.fetchmany(self.fetch_size)
+            if not batch:
+                return
+            yield batch
+
+    def _write(self, path: str, header: List[str], sql: str, params, compress: bool) -> int:
+        rows = 0
+        # utf-8-sig: BOM, чтобы Excel сам определил кодировку
+        opener = gzip.open if compress else open
+        with opener(path, "wt", newline="", encoding="utf-8-sig") as f, Database() as cursor:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            for batch in self._batches(cursor, sql, params):
+                writer.writerows(tuple(row) for row in batch)
+                rows += len(batch)
+        return rows
+
+    async def _run(self, chat_id: int, filename: str, header: List[str], sql: str, params,
+                   caption, compress: bool):
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(filename)[1])
+        os.close(fd)
+        try:
+            rows = await self._db.run(self._write, path, header, sql, params, compress)
+            await (await self._sender.send(SendDocument(
+                chat_id=chat_id,
+                document=FSInputFile(path, filename=filename),
+                caption=caption or f"📥 Выгрузка: {rows} строк"
+            )))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка выгрузки {filename}: {e}")
+            await self._sender.send(SendMessage(chat_id=chat_id, text="❌ Не удалось сформировать выгрузку"))
+        finally:
+            os.remove(path)
 
-# Загрузка переменных окружения
-load_dotenv()
-TOKEN = os.getenv('TOKEN')
-ADMIN_ID = os.getenv('ADMIN_ID')
-DATABASE_NAME = os.getenv('DATABASE_NAME', 'bot.db')
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-# Инициализация бота
-bot = Bot(token=TOKEN)
-dp = Dispatcher()
 
-# Настройка логгера
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-)
-logger = logging.getLogger(__name__)
+exports = CsvExporter(db, outbox)
 
-def adapt_datetime(dt):
-    return dt.isoformat()
+### BLOCK 2.5: REVIEWER POOL ###
+class ReviewerPool:
+    """Распределение решений между проверяющими.
 
-def convert_datimestamp(b):
-    return datetime.fromisoformat(b.decode())
+    Пул курса задается таблицей course_reviewers, иначе используется общий
+    REVIEWER_IDS. Назначенное решение закрепляется за проверяющим на
+    lease секунд (reviewer_id + lease_expires_at): проверить его может
+    только он, пока аренда не истекла. Фоновая задача передает решения
+    с истекшей арендой следующему проверяющему и назначает решения без
+    аренды (отправленные до пулов или при пустом пуле). Решение
+    присылается каждому проверяющему не больше одного раза (review_pushes),
+    чтобы непроверенное решение не рассылалось по кругу каждый период аренды.
+    """
 
-sqlite3.register_adapter(datetime, adapt_datetime)
-sqlite3.register_converter("timestamp", convert_datimestamp)
+    STRATEGIES = ('round_robin', 'least_pending', 'sticky')
 
-class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect(
-            DATABASE_NAME,
-            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
+    def __init__(self, database: AsyncDatabase, global_ids: List[int], strategy: str,
+                 lease: float, check_interval: float):
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Неизвестная стратегия назначения: {strategy}")
+        self._db = database
+        self.global_ids = global_ids
+        self.strategy = strategy
+        self.lease = lease
+        self.check_interval = check_interval
+        self._course_ids: Dict[int, List[int]] = {}
+        self._turns: Dict[tuple, int] = {}
+        self._task = None
+
+    def load(self, cursor):
+        pools = {}
+        for row in cursor.execute(
+            "SELECT course_id, reviewer_id FROM course_reviewers ORDER BY course_id, reviewer_id"
+        ):
+            pools.setdefault(row['course_id'], []).append(row['reviewer_id'])
+        self._course_ids = pools
+
+    def pool(self, course_id: Optional[int]) -> List[int]:
+        return self._course_ids.get(course_id) or self.global_ids
+
+    def is_reviewer(self, user_id: int) -> bool:
+        return (
+            str(user_id) == ADMIN_ID
+            or user_id in self.global_ids
+            or any(user_id in ids for ids in self._course_ids.values())
         )
-        self.conn.execute("PRAGMA foreign_keys = ON")
-        self.conn.row_factory = sqlite3.Row
-        self._init_tables()
-
-    def _init_tables(self):
-        with self.conn:
-            # Users table
-            self.conn.execute('''CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                full_name TEXT NOT NULL,
-                current_course INTEGER,
-                registered_at timestamp DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY(current_course) REFERENCES courses(course_id) ON DELETE SET NULL
-            )''')
-
-            # Courses table
-            self.conn.execute('''CREATE TABLE IF NOT EXISTS courses (
-                course_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT UNIQUE NOT NULL,
-                description TEXT,
-                media_id TEXT
-            )''')
-
-            # Modules table
-            self.conn.execute('''CREATE TABLE IF NOT EXISTS modules (
-                module_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                course_id INTEGER NOT NULL,
-                title TEXT NOT NULL,
-                media_id TEXT,
-                FOREIGN KEY(course_id) REFERENCES courses(course_id) ON DELETE CASCADE
-            )''')
-
-            # Tasks table
-            self.conn.execute('''CREATE TABLE IF NOT EXISTS tasks (
-                task_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                module_id INTEGER NOT NULL,
-                title TEXT NOT NULL,
-                content TEXT NOT NULL,
-                file_id TEXT,
-                FOREIGN KEY(module_id) REFERENCES modules(module_id) ON DELETE CASCADE
-            )''')
-
-            # Submissions table с улучшенными ограничениями
-            self.conn.execute('''CREATE TABLE IF NOT EXISTS submissions (
-                submission_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                task_id INTEGER NOT NULL,
-                status TEXT DEFAULT 'pending' CHECK(status IN ('pending', 'accepted', 'rejected')),
-                score INTEGER CHECK(score BETWEEN 0 AND 100),
-                submitted_at timestamp DEFAULT CURRENT_TIMESTAMP,
-                file_id TEXT,
-                content TEXT,
-                FOREIGN KEY(user_id) REFERENCES users(user_id) ON DELETE CASCADE,
-                FOREIGN KEY(task_id) REFERENCES tasks(task_id) ON DELETE CASCADE
-            )''')
 
-    def __enter__(self):
-        return self.conn.cursor()
-    
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if exc_type:
-            self.conn.rollback()
+    @staticmethod
+    def claim_clause() -> str:
+        """Условие «решение можно проверять этому проверяющему»; параметры: (reviewer_id, now)."""
+        return "(reviewer_id IS NULL OR reviewer_id = ? OR lease_expires_at < ?)"
+
+    def scope_clause(self, reviewer_id: int, task_column: str = "submissions.task_id") -> Tuple[str, tuple]:
+        """Условие «решение из курса, в пул которого входит проверяющий» и его параметры.
+
+        Без него проверяющий одного курса мог бы взять решение другого курса,
+        если оно не закреплено или аренда истекла.
+        """
+        if reviewer_id in self.global_ids:
+            # Общий пул проверяет все курсы, кроме курсов со своим пулом без него
+            courses = [course_id for course_id, ids in self._course_ids.items() if reviewer_id not in ids]
+            match = "NOT IN"
         else:
-            self.conn.commit()
-        self.conn.close()
+            courses = [course_id for course_id, ids in self._course_ids.items() if reviewer_id in ids]
+            match = "IN"
+        return (
+            f"EXISTS (SELECT 1 FROM tasks t_scope JOIN modules m_scope ON m_scope.module_id = t_scope.module_id "
+            f"WHERE t_scope.task_id = {task_column} "
+            f"AND m_scope.course_id {match} ({','.join('?' * len(courses))}))",
+            tuple(courses)
+        )
+
+    def _least_pending(self, cursor, candidates: List[int]) -> int:
+        counts = dict(cursor.execute(
+            f"SELECT reviewer_id, COUNT(*) FROM submissions "
+            f"WHERE status = 'pending' AND reviewer_id IN ({','.join('?' * len(candidates))}) "
+            f"GROUP BY reviewer_id",
+            candidates
+        ).fetchall())
+        return min(candidates, key=lambda reviewer_id: counts.get(reviewer_id, 0))
+
+    def choose(self, cursor, course_id: Optional[int], student_id: int,
+               exclude: Optional[int] = None) -> Optional[int]:
+        pool = self.pool(course_id)
+        candidates = [reviewer_id for reviewer_id in pool if reviewer_id != exclude] or pool
+        if not candidates:
+            return None
+        if self.strategy == 'round_robin':
+            key = tuple(candidates)
+            turn = self._turns.get(key, 0)
+            self._turns[key] = turn + 1
+            return candidates[turn % len(candidates)]
+        if self.strategy == 'sticky':
+            row = cursor.execute(
+                "SELECT reviewer_id FROM submissions "
+                "WHERE user_id = ? AND reviewer_id IS NOT NULL ORDER BY submission_id DESC LIMIT 1",
+                (student_id,)
+            ).fetchone()
+            if row and row['reviewer_id'] in candidates:
+                return row['reviewer_id']
+        return self._least_pending(cursor, candidates)
+
+    def assign(self, cursor, submission_id: int, course_id: Optional[int], student_id: int,
+               exclude: Optional[int] = None) -> Optional[int]:
+        """Назначает проверяющего в текущей транзакции записи."""
+        reviewer_id = self.choose(cursor, course_id, student_id, exclude)
+        if reviewer_id is not None:
+            cursor.execute(
+                "UPDATE submissions SET reviewer_id = ?, lease_expires_at = ? WHERE submission_id = ?",
+                (reviewer_id, time.time() + self.lease, submission_id)
+            )
+        return reviewer_id
+
+    @staticmethod
+    def mark_pushed(cursor, submission_id: int, reviewer_id: int) -> bool:
+        """Запоминает, что решение прислано проверяющему; False — уже присылалось."""
+        return cursor.execute(
+            "INSERT OR IGNORE INTO review_pushes (submission_id, reviewer_id) VALUES (?, ?)",
+            (submission_id, reviewer_id)
+        ).rowcount == 1
+
+    def claim(self, cursor, submission_id: int, reviewer_id: int) -> bool:
+        """Закрепляет решение за проверяющим (или продлевает аренду); False — занято другим или чужой курс."""
+        scope, scope_params = self.scope_clause(reviewer_id)
+        return cursor.execute(
+            f"UPDATE submissions SET reviewer_id = ?, lease_expires_at = ? "
+            f"WHERE submission_id = ? AND status = 'pending' AND {self.claim_clause()} AND {scope}",
+            (reviewer_id, time.time() + self.lease, submission_id, reviewer_id, time.time(), *scope_params)
+        ).rowcount == 1
+
+    def _reassign(self, cursor) -> List[tuple]:
+        expired = cursor.execute(
+            "SELECT s.submission_id, s.user_id, s.task_id, s.reviewer_id, m.course_id "
+            "FROM submissions s "
+            "JOIN tasks t ON t.task_id = s.task_id "
+            "JOIN modules m ON m.module_id = t.module_id "
+            "WHERE s.status = 'pending' AND (s.lease_expires_at < ? OR s.lease_expires_at IS NULL)",
+            (time.time(),)
+        ).fetchall()
+        moved = []
+        for row in expired:
+            reviewer_id = self.assign(
+                cursor, row['submission_id'], row['course_id'], row['user_id'], exclude=row['reviewer_id']
+            )
+            if reviewer_id is not None and reviewer_id != row['reviewer_id']:
+                # При REVIEW_PUSH=0 решения берут из очереди — переносим только аренду
+                push = REVIEW_PUSH and self.mark_pushed(cursor, row['submission_id'], reviewer_id)
+                moved.append((row['task_id'], row['user_id'], reviewer_id, push))
+        return moved
+
+    async def reassign_expired(self) -> int:
+        moved = await self._db.transaction(self._reassign)
+        for task_id, user_id, reviewer_id, push in moved:
+            if push:
+                await notify_admin(task_id, user_id, chat_id=reviewer_id)
+        if moved:
+            logger.info(f"Переназначено решений с истекшей арендой: {len(moved)}")
+        return len(moved)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                await self.reassign_expired()
+            except Exception as e:
+                logger.error(f"Ошибка переназначения решений: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def add(self, course_id: int, reviewer_id: int):
+        await self._db.execute(
+            "INSERT OR IGNORE INTO course_reviewers (course_id, reviewer_id) VALUES (?, ?)",
+            (course_id, reviewer_id)
+        )
+        ids = self._course_ids.setdefault(course_id, [])
+        if reviewer_id not in ids:
+            ids.append(reviewer_id)
+
+    async def remove(self, course_id: int, reviewer_id: int):
+        await self._db.execute(
+            "DELETE FROM course_reviewers WHERE course_id = ? AND reviewer_id = ?",
+            (course_id, reviewer_id)
+        )
+        ids = self._course_ids.get(course_id, [])
+        if reviewer_id in ids:
+            ids.remove(reviewer_id)
+        if not ids:
+            self._course_ids.pop(course_id, None)
+
+
+reviewers = ReviewerPool(
+    db,
+    global_ids=[int(x) for x in (REVIEWER_IDS or ADMIN_ID or "").split(",") if x.strip()],
+    strategy=os.getenv('REVIEW_STRATEGY', 'least_pending'),
+    lease=float(os.getenv('REVIEW_LEASE_SECONDS', '1800')),
+    check_interval=float(os.getenv('REVIEW_LEASE_CHECK', '60'))
+)
+
+### BLOCK 2.6: USER PROFILE CACHE ###
+class UserProfile(NamedTuple):
+    user_id: int
+    full_name: str
+    current_course: Optional[int]
+
+
+class UserProfileCache:
+    """LRU-кеш профилей пользователей с TTL.
+
+    Заполняется при первом обращении и обновляется сквозной записью
+    в обработчиках регистрации и выбора курса. None в кеше означает
+    «пользователь не зарегистрирован», чтобы /start для новых
+    пользователей тоже не ходил в SQLite повторно.
+    """
+
+    def __init__(self, database: AsyncDatabase, max_size: int, ttl: float):
+        self._db = database
+        self.max_size = max_size
+        self.ttl = ttl
+        # user_id → (профиль или None, момент истечения)
+        self._entries: "OrderedDict[int, Tuple[Optional[UserProfile], float]]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _store(self, user_id: int, profile: Optional[UserProfile]):
+        self._entries[user_id] = (profile, time.monotonic() + self.ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get(self, user_id: int) -> Optional[UserProfile]:
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[1] > time.monotonic():
+            self._entries.move_to_end(user_id)
+            PROFILE_CACHE.inc("hit")
+            return entry[0]
+
+        PROFILE_CACHE.inc("miss")
+        row = await self._db.fetchone(
+            "SELECT user_id, full_name, current_course FROM users WHERE user_id = ?", (user_id,)
+        )
+        profile = UserProfile(row['user_id'], row['full_name'], row['current_course']) if row else None
+        # Пока шло чтение, обработчик мог записать более свежий профиль
+        current = self._entries.get(user_id)
+        if current is not None and current[1] > time.monotonic() and current is not entry:
+            return current[0]
+        self._store(user_id, profile)
+        return profile
+
+    def put(self, profile: UserProfile):
+        self._store(profile.user_id, profile)
+
+    def set_course(self, user_id: int, course_id: Optional[int]):
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] is not None:
+            self._store(user_id, entry[0]._replace(current_course=course_id))
+
+    def clear_course(self, course_id: int):
+        """Повторяет ON DELETE SET NULL для закешированных профилей."""
+        for user_id, (profile, expires_at) in list(self._entries.items()):
+            if profile is not None and profile.current_course == course_id:
+                self._entries[user_id] = (profile._replace(current_course=None), expires_at)
+
+    def invalidate(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+profiles = UserProfileCache(db, PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+
+### BLOCK 2.7: CROSS-INSTANCE CACHE SYNC ###
+class CacheSync:
+    """Сбрасывает кеши процесса, если таблицы изменил другой экземпляр.
+
+    CatalogCache (а с ним KeyboardCache), пулы ReviewerPool и
+    UserProfileCache обновляются сквозной записью только в том процессе,
+    который пишет. Триггеры увеличивают версию в cache_versions при
+    любой записи в исходные таблицы; раз в interval секунд версии
+    сверяются с запомненными, и изменившийся кеш перечитывается из БД
+    (кеш профилей очищается целиком). Собственные записи тоже меняют
+    версию и приводят к лишней перезагрузке — поэтому с одним экземпляром
+    (interval=0) проверка не запускается, и кеши полагаются только на
+    сквозную запись.
+    """
+
+    def __init__(self, database: AsyncDatabase, interval: float):
+        self._db = database
+        self.interval = interval
+        self._versions: Dict[str, int] = {}
+        self._task = None
+
+    @staticmethod
+    def _read(cursor) -> Dict[str, int]:
+        return dict(cursor.execute("SELECT name, version FROM cache_versions").fetchall())
+
+    def load(self, cursor):
+        self._versions = self._read(cursor)
+
+    async def check(self) -> List[str]:
+        """Перечитывает устаревшие кеши; возвращает их имена."""
+        versions = await self._db.read(self._read)
+        changed = sorted(name for name, version in versions.items() if self._versions.get(name) != version)
+        if 'catalog' in changed:
+            await self._db.read(catalog.load)
+        if 'reviewers' in changed:
+            await self._db.read(reviewers.load)
+        if 'profiles' in changed:
+            profiles.clear()
+        self._versions = versions
+        return changed
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"Ошибка проверки версий кешей: {e}")
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+cache_sync = CacheSync(db, CACHE_SYNC_INTERVAL)
 
-def init_db():
-    # Инициализация уже выполнена в конструкторе Database
-    pass
 
 ### BLOCK 3: STATES AND KEYBOARDS ###
 class Form(StatesGroup):
@@ -139,29 +2278,208 @@ class AdminForm(StatesGroup):
     add_task_content = State()
     add_task_media = State()
     delete_course = State()
+    import_package = State()
 
-def main_menu():
+def _build_main_menu():
     builder = ReplyKeyboardBuilder()
     builder.button(text="📚 Выбрать курс")
     builder.button(text="🆘 Поддержка")
     builder.adjust(2)
     return builder.as_markup(resize_keyboard=True)
 
+# Статичные клавиатуры собираются один раз при импорте
+MAIN_MENU = _build_main_menu()
+CANCEL_KB = types.InlineKeyboardMarkup(inline_keyboard=[
+    [types.InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")]
+])
+
+def main_menu():
+    return MAIN_MENU
+
 def cancel_button():
-    return types.InlineKeyboardMarkup(inline_keyboard=[
-        [types.InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")]
-    ])
+    return CANCEL_KB
+
+
+### BLOCK 3.1: CALLBACK ROUTING ###
+class CourseCb(CallbackData, prefix="course"):
+    course_id: int
+
+class ModuleCb(CallbackData, prefix="module"):
+    module_id: int
+
+class TaskCb(CallbackData, prefix="task"):
+    task_id: int
+
+class BackToModulesCb(CallbackData, prefix="bmod"):
+    course_id: int
+
+class ReviewCb(CallbackData, prefix="review"):
+    action: str
+    task_id: int
+    user_id: int
+
+class DeleteCourseCb(CallbackData, prefix="delcourse"):
+    course_id: int
+
+class ConfirmDeleteCb(CallbackData, prefix="cdel"):
+    course_id: int
+
+class AddModuleCb(CallbackData, prefix="addmod"):
+    course_id: int
+
+class AddTaskCourseCb(CallbackData, prefix="addtask"):
+    course_id: int
+
+class AddTaskModuleCb(CallbackData, prefix="addtaskmod"):
+    module_id: int
+
+
+class ReviewQueueCb(CallbackData, prefix="rq"):
+    action: str
+    value: int
+
+class UsersPageCb(CallbackData, prefix="users"):
+    course_id: int  # 0 — все курсы
+    cursor: int     # user_id, от которого листаем (keyset)
+    forward: bool
+
+class UsersFilterCb(CallbackData, prefix="usersflt"):
+    pass
+
+class UsersExportCb(CallbackData, prefix="usersexp"):
+    course_id: int
+
+class SearchCb(CallbackData, prefix="search"):
+    page: int
+
+
+class CallbackRouter:
+    """Маршрутизация callback-запросов по префиксу за O(1).
+
+    Маршрут — это префикс CallbackData-фабрики или точная строка без
+    параметров. Данные разбираются один раз и передаются обработчику как
+    callback_data; из остальных данных апдейта передаются только те, что
+    есть в сигнатуре обработчика. Повторная регистрация префикса — ошибка.
+
+    deferred_ack=True разрешает подтвердить нажатие пустым ответом, если
+    обработчик работает дольше CALLBACK_ACK_DELAY (см. CallbackAckMiddleware).
+    Вместо True можно передать быструю проверку callback_data без обращения
+    к БД: если она не прошла, раннего подтверждения нет и подсказка об
+    ошибке из обработчика остается всплывающей.
+    """
+
+    # Кнопки, отправленные до перехода на CallbackData (старые уведомления админу)
+    _LEGACY_REVIEW = re.compile(r"^(accept|reject)_(\d+)_(\d+)$")
+
+    def __init__(self):
+        self._routes: Dict[str, tuple] = {}
+
+    def route(self, key, deferred_ack: Union[bool, Callable[[Any], bool]] = False):
+        factory = key if isinstance(key, type) and issubclass(key, CallbackData) else None
+        prefix = factory.__prefix__ if factory else key
+
+        def decorator(handler):
+            if prefix in self._routes:
+                raise RuntimeError(
+                    f"Callback '{prefix}' уже обрабатывается {self._routes[prefix][1].__name__}"
+                )
+            params = frozenset(inspect.signature(handler).parameters)
+            self._routes[prefix] = (factory, handler, params, deferred_ack)
+            return handler
+        return decorator
+
+    def _route(self, data: str):
+        route = self._routes.get(data.split(":", 1)[0])
+        if route is None:
+            legacy = self._LEGACY_REVIEW.match(data)
+            if not legacy:
+                return None, data
+            route = self._routes[ReviewCb.__prefix__]
+            data = ReviewCb(action=legacy[1], task_id=int(legacy[2]), user_id=int(legacy[3])).pack()
+        return route, data
+
+    def resolve(self, data: str):
+        route, data = self._route(data)
+        if route is None:
+            return None, None, None
+        factory, handler, params, _ = route
+        return handler, params, factory.unpack(data) if factory else None
+
+    def deferred_ack(self, data: str) -> bool:
+        route, data = self._route(data)
+        if route is None or not route[3]:
+            return False
+        factory, _, _, deferred_ack = route
+        if deferred_ack is True:
+            return True
+        try:
+            return bool(deferred_ack(factory.unpack(data) if factory else None))
+        except (TypeError, ValueError):
+            return False
+
+    def handler_name(self, data: str) -> str:
+        handler = self.resolve(data)[0]
+        return handler.__name__ if handler else "unknown_callback"
+
+    async def dispatch(self, callback: CallbackQuery, data: Dict[str, Any]):
+        handler, params, callback_data = self.resolve(callback.data or "")
+        if handler is None:
+            await callback.answer("⚠️ Кнопка устарела, откройте меню заново")
+            return
+        kwargs = {name: value for name, value in data.items() if name in params}
+        if "callback_data" in params:
+            kwargs["callback_data"] = callback_data
+        return await handler(callback, **kwargs)
+
+    def validate(self, dispatcher: Dispatcher):
+        """Проверка при запуске: все callback-обработчики идут через роутер."""
+        stray = [
+            handler.callback.__name__
+            for handler in dispatcher.callback_query.handlers
+            if handler.callback is not route_callback_query
+        ]
+        if stray:
+            raise RuntimeError(f"Callback-обработчики в обход CallbackRouter: {', '.join(stray)}")
+
+
+callbacks = CallbackRouter()
+
+
+@dp.callback_query()
+async def route_callback_query(callback: CallbackQuery, **data):
+    return await callbacks.dispatch(callback, data)
+
+
+### BLOCK 3.2: MESSAGE EDITS ###
+async def safe_edit_text(message: Message, text: str, reply_markup=None, **kwargs) -> bool:
+    """edit_text, который пропускает правку без изменений.
+
+    Повторное нажатие той же кнопки не тратит запрос к Bot API, а гонки
+    с «message is not modified» не превращаются в ошибки. Возвращает
+    True, если сообщение действительно изменено.
+    """
+    def dump(markup):
+        # Сравниваем по содержимому: у полученных из апдейта объектов есть контекст бота
+        return markup.model_dump(exclude_none=True) if markup is not None else None
+
+    if message.text == text and dump(message.reply_markup) == dump(reply_markup):
+        return False
+    try:
+        await message.edit_text(text, reply_markup=reply_markup, **kwargs)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+        return False
+    return True
 
 
 ### BLOCK 4: USER HANDLERS (FIXED) ###
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message, state: FSMContext):
-    with Database() as cursor:
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (message.from_user.id,))
-        user = cursor.fetchone()
-    
+    user = await profiles.get(message.from_user.id)
+
     if user:
-        await message.answer(f"Добро пожаловать, {user[1]}!", reply_markup=main_menu())
+        await message.answer(f"Добро пожаловать, {user.full_name}!", reply_markup=main_menu())
     else:
         await message.answer("📝 Давай познакомимся! Для начала регистрации введи свое ФИО. Это нужно, чтобы твой наставник мог оценивать задания и давать обратную связь. Напиши своё полное имя, фамилию и отчество::", reply_markup=types.ReplyKeyboardRemove())
         await state.set_state(Form.full_name)
@@ -173,14 +2491,15 @@ async def process_full_name(message: types.Message, state: FSMContext):
         return
     
     try:
-        with Database() as cursor:
-            cursor.execute(
-                "INSERT INTO users (user_id, full_name) VALUES (?, ?)",
-                (message.from_user.id, message.text)
-            )
+        await db.execute(
+            "INSERT INTO users (user_id, full_name) VALUES (?, ?)",
+            (message.from_user.id, message.text)
+        )
+        profiles.put(UserProfile(message.from_user.id, message.text, None))
         await message.answer("✅ Регистрация успешно завершена!", reply_markup=main_menu())
         await state.clear()
     except sqlite3.IntegrityError:
+        profiles.invalidate(message.from_user.id)
         await message.answer("❌ Этот пользователь уже зарегистрирован")
         await state.clear()
 
@@ -197,16 +2516,13 @@ async def handle_media(message: Message, state: FSMContext):
     return media_id
 
 ### BLOCK 5: COURSE HANDLERS (FIXED) ###
+@cached_keyboard("courses")
 def courses_kb():
-    with Database() as cursor:
-        cursor.execute("SELECT course_id, title FROM courses")
-        courses = cursor.fetchall()
-    
     builder = InlineKeyboardBuilder()
-    for course in courses:
+    for course in catalog.courses.values():
         builder.button(
-            text=f"📘 {course[1]}",
-            callback_data=f"course_{course[0]}"
+            text=f"📘 {course.title}",
+            callback_data=CourseCb(course_id=course.course_id).pack()
         )
     builder.button(text="❌ Отмена", callback_data="cancel")
     builder.adjust(1)
@@ -214,18 +2530,12 @@ def courses_kb():
 
 @dp.message(F.text == ("📚 Выбрать курс"))
 async def show_courses(message: types.Message):
-    with Database() as cursor:
-        cursor.execute(
-            "SELECT courses.title FROM users "
-            "LEFT JOIN courses ON users.current_course = courses.course_id "
-            "WHERE users.user_id = ?", 
-            (message.from_user.id,)
-        )
-        current_course = cursor.fetchone()
-    
+    user = await profiles.get(message.from_user.id)
+    current_course = catalog.courses.get(user.current_course) if user else None
+
     text = "В этом разделе ты можешь выбрать курс, в котором будут модули с заданиями. Выполняй их и отправляй админу на проверку! 🚀 \n\n"
-    if current_course and current_course[0]:
-        text += f"🎯 Текущий курс: {current_course[0]}\n\n"
+    if current_course:
+        text += f"🎯 Текущий курс: {current_course.title}\n\n"
     text += "👇 Выбери свой:"
     
     await message.answer(
@@ -236,15 +2546,13 @@ async def show_courses(message: types.Message):
         )
     )
 
-@dp.callback_query(F.data == ("select_course"))
+@callbacks.route("select_course")
+@callbacks.route("back_to_courses")
 async def select_course_handler(callback: types.CallbackQuery):
-    await callback.message.edit_text(
-        "📚 Доступные курсы:",
-        reply_markup=courses_kb()
-    )
+    await safe_edit_text(callback.message, "📚 Доступные курсы:", courses_kb())
 
 ### BLOCK 6: NAVIGATION AND CANCEL ###
-@dp.callback_query(F.data == "cancel")
+@callbacks.route("cancel")
 async def cancel_handler(callback: types.CallbackQuery, state: FSMContext):
     await state.clear()  # Очищаем состояние
     
@@ -264,92 +2572,35 @@ async def cancel_handler(callback: types.CallbackQuery, state: FSMContext):
             reply_markup=main_menu()
         )
 ### BLOCK 5.1: COURSE SELECTION FIX ###
-@dp.callback_query(F.data.startswith("course_"))
-async def select_course(callback: types.CallbackQuery):
+@callbacks.route(CourseCb, deferred_ack=True)
+async def select_course(callback: types.CallbackQuery, callback_data: CourseCb):
     try:
-        course_id = int(callback.data.split("_")[1])
+        course_id = callback_data.course_id
         user_id = callback.from_user.id
         
-        with Database() as cursor:
-            # Обновляем выбранный курс у пользователя
-            cursor.execute(
-                "UPDATE users SET current_course = ? WHERE user_id = ?",
-                (course_id, user_id)
-            )
-            
-            # Получаем данные курса
-            cursor.execute(
-                "SELECT title, media_id FROM courses WHERE course_id = ?",
-                (course_id,)
-            )
-            course = cursor.fetchone()
-        
+        course = catalog.courses.get(course_id)
         if not course:
             raise ValueError("Курс не найден")
-        
-        text = f"✅ Вы выбрали курс: {course[0]}\nВыберите модуль для решения заданий:"
-        kb = modules_kb(course_id)
-        
-        if course[1]:  # Если есть медиа
-            await callback.message.delete()
-            await callback.message.answer_photo(
-                course[1],
-                caption=text,
-                reply_markup=kb
-            )
-        else:
-            await callback.message.edit_text(
-                text,
-                reply_markup=kb
-            )
-            
-    except Exception as e:
-        logger.error(f"Error in select_course: {e}")
-        await callback.message.answer(
-            "❌ Произошла ошибка при выборе курса",
-            reply_markup=main_menu()
-        )
-
-    ### BLOCK 6: COURSE SELECTION HANDLERS ###
-@dp.callback_query(F.data == "select_course")
-async def select_course_handler(callback: types.CallbackQuery):
-    await callback.message.edit_text(
-        "📚 Доступные курсы:",
-        reply_markup=courses_kb()
-    )
 
-@dp.callback_query(F.data.startswith("course_"))
-async def select_course(callback: types.CallbackQuery):
-    try:
-        course_id = int(callback.data.split("_")[1])
-        user_id = callback.from_user.id
-        
-        with Database() as cursor:
-            cursor.execute(
-                "UPDATE users SET current_course = ? WHERE user_id = ?",
-                (course_id, user_id)
-            )
-            cursor.execute(
-                "SELECT title, media_id FROM courses WHERE course_id = ?",
-                (course_id,)
-            )
-            course = cursor.fetchone()
+        # Обновляем выбранный курс у пользователя
+        await db.execute(
+            "UPDATE users SET current_course = ? WHERE user_id = ?",
+            (course_id, user_id)
+        )
+        profiles.set_course(user_id, course_id)
         
-        text = f"✅ Вы выбрали курс: {course[0]}\nВыберите модуль:"
+        text = f"✅ Вы выбрали курс: {course.title}\nВыберите модуль для решения заданий:"
         kb = modules_kb(course_id)
         
-        if course[1]:  # Если есть медиа
+        if course.media_id:  # Если есть медиа
             await callback.message.delete()
             await callback.message.answer_photo(
-                course[1],
+                course.media_id,
                 caption=text,
                 reply_markup=kb
             )
         else:
-            await callback.message.edit_text(
-                text,
-                reply_markup=kb
-            )
+            await safe_edit_text(callback.message, text, kb)
             
     except Exception as e:
         logger.error(f"Error in select_course: {e}")
@@ -359,63 +2610,27 @@ async def select_course(callback: types.CallbackQuery):
         )
 
 ### BLOCK 6: MODULE SYSTEM FIX ###
-@dp.callback_query(F.data.startswith("module_"))
-async def module_selected(callback: types.CallbackQuery):
+@callbacks.route(ModuleCb)
+async def module_selected(callback: types.CallbackQuery, callback_data: ModuleCb):
     try:
-        # Исправленный парсинг module_id
-        module_id = int(callback.data.split("_")[1])
+        module_id = callback_data.module_id
         
-        with Database() as cursor:
-            # Получаем курс для модуля с проверкой существования
-            cursor.execute("SELECT course_id FROM modules WHERE module_id = ?", (module_id,))
-            course_data = cursor.fetchone()
-            
-            if not course_data:
-                await callback.answer("❌ Модуль не найден")
-                return
-                
-            course_id = course_data[0]
-            
-            # Получаем название модуля с проверкой
-            cursor.execute("SELECT title FROM modules WHERE module_id = ?", (module_id,))
-            module_data = cursor.fetchone()
-            
-            if not module_data:
-                await callback.answer("❌ Название модуля не найдено")
-                return
-                
-            module_title = module_data[0]
+        # Получаем курс и название модуля с проверкой существования
+        module = catalog.modules.get(module_id)
+        
+        if not module:
+            await callback.answer("❌ Модуль не найден")
+            return
             
-            # Получаем задания с проверкой
-            cursor.execute("SELECT task_id, title FROM tasks WHERE module_id = ?", (module_id,))
-            tasks = cursor.fetchall()
-
-        # Создаем уникальный идентификатор для callback
-        unique_id = random.randint(1000, 9999)
-        builder = InlineKeyboardBuilder()
+        module_title = module.title
         
-        if tasks:
-            for task in tasks:
-                builder.button(
-                    text=f"📝 {task[1]}", 
-                    callback_data=f"task_{task[0]}"
-                )
-        else:
+        if not module.task_ids:
             await callback.answer("ℹ️ В этом модуле пока нет заданий")
             return
-            
-        builder.button(
-            text="🔙 Назад к модулям", 
-            callback_data=f"back_to_modules_{course_id}_{unique_id}"
-        )
-        builder.adjust(1)
 
         # Редактируем сообщение с проверкой медиа
         try:
-            await callback.message.edit_text(
-                f"📂 Модуль: {module_title}\nВыберите задание:",
-                reply_markup=builder.as_markup()
-            )
+            await safe_edit_text(callback.message, f"📂 Модуль: {module_title}\nВыберите задание:", tasks_kb(module_id))
         except Exception as e:
             logger.error(f"Message edit error: {str(e)}")
             await callback.answer("⚠️ Ошибка отображения заданий")
@@ -425,35 +2640,23 @@ async def module_selected(callback: types.CallbackQuery):
         await callback.answer("❌ Ошибка загрузки модуля")
 
 ### BLOCK 6.1: BACK TO MODULES FIX ###
-@dp.callback_query(F.data.startswith("back_to_modules_"))
-async def back_to_modules(callback: CallbackQuery):
+@callbacks.route(BackToModulesCb)
+async def back_to_modules(callback: CallbackQuery, callback_data: BackToModulesCb):
     try:
-        # Исправленный парсинг course_id
-        parts = callback.data.split("_")
-        course_id = int(parts[3])  # Новый корректный индекс
+        course_id = callback_data.course_id
         
-        with Database() as cursor:
-            cursor.execute(
-                "SELECT title FROM courses WHERE course_id = ?", 
-                (course_id,)
-            )
-            course_data = cursor.fetchone()
+        course = catalog.courses.get(course_id)
+        
+        if not course:
+            await callback.answer("❌ Курс не найден")
+            return
             
-            if not course_data:
-                await callback.answer("❌ Курс не найден")
-                return
-                
-            course_title = course_data[0]
+        course_title = course.title
 
         # Получаем актуальную клавиатуру модулей
         kb = modules_kb(course_id)
         
-        try:
-            await callback.message.edit_text(
-                f"📚 Курс: {course_title}\nВыберите модуль:",
-                reply_markup=kb
-            )
-        except TelegramBadRequest:
+        if not await safe_edit_text(callback.message, f"📚 Курс: {course_title}\nВыберите модуль:", kb):
             await callback.answer("Список модулей актуален")
             
     except Exception as e:
@@ -461,22 +2664,34 @@ async def back_to_modules(callback: CallbackQuery):
         await callback.answer("⚠️ Произошла ошибка при загрузке")
 
 ### BLOCK 6.2: MODULES KEYBOARD FIX ###
+@cached_keyboard("tasks")
+def tasks_kb(module_id: int):
+    module = catalog.modules[module_id]
+    builder = InlineKeyboardBuilder()
+    for task in catalog.module_tasks(module_id):
+        builder.button(
+            text=f"📝 {task.title}", 
+            callback_data=TaskCb(task_id=task.task_id).pack()
+        )
+    builder.button(
+        text="🔙 Назад к модулям", 
+        callback_data=BackToModulesCb(course_id=module.course_id).pack()
+    )
+    builder.adjust(1)
+    return builder.as_markup()
+
+@cached_keyboard("modules")
 def modules_kb(course_id: int):
     try:
-        with Database() as cursor:
-            cursor.execute(
-                "SELECT module_id, title FROM modules WHERE course_id = ?",
-                (course_id,)
-            )
-            modules = cursor.fetchall()
+        modules = catalog.course_modules(course_id)
         
         builder = InlineKeyboardBuilder()
         
         if modules:
             for module in modules:
                 builder.button(
-                    text=f"📂 {module[1]}",
-                    callback_data=f"module_{module[0]}"
+                    text=f"📂 {module.title}",
+                    callback_data=ModuleCb(module_id=module.module_id).pack()
                 )
         else:
             # Возвращаем пустую клавиатуру если модулей нет
@@ -497,6 +2712,98 @@ def modules_kb(course_id: int):
         logger.error(f"Modules keyboard error: {str(e)}")
         return InlineKeyboardBuilder().as_markup()
 
+@callbacks.route("no_modules")
+async def no_modules_handler(callback: CallbackQuery):
+    await callback.answer("ℹ️ В этом курсе пока нет модулей")
+
+### BLOCK 6.3: CATALOG SEARCH ###
+def _fts_query(text: str) -> str:
+    """Запрос пользователя → запрос FTS5: все слова обязательны, последнее — как префикс."""
+    words = re.findall(r"\w+", text.lower())[:8]
+    if not words:
+        return ""
+    return " ".join([f'"{word}"' for word in words[:-1]] + [f'"{words[-1]}"*'])
+
+
+def _search_page(cursor, query: str, page: int, limit: int):
+    # bm25: совпадение в названии весит больше, чем в описании
+    rows = cursor.execute('''
+        SELECT rowid, snippet(catalog_fts, 1, '', '', '…', 8) AS snippet
+        FROM catalog_fts
+        WHERE catalog_fts MATCH ?
+        ORDER BY bm25(catalog_fts, 10.0, 1.0)
+        LIMIT ? OFFSET ?
+    ''', (query, limit + 1, page * limit)).fetchall()
+    return rows[:limit], len(rows) > limit
+
+
+def _search_hit(rowid: int):
+    """Кнопка и подпись для найденной записи; None, если ее уже нет в каталоге."""
+    ref_id, kind = divmod(rowid, 3)
+    if kind == 0 and ref_id in catalog.courses:
+        return "📘", catalog.courses[ref_id].title, CourseCb(course_id=ref_id)
+    if kind == 1 and ref_id in catalog.modules:
+        module = catalog.modules[ref_id]
+        course = catalog.courses.get(module.course_id)
+        return "📂", f"{course.title if course else '?'} / {module.title}", ModuleCb(module_id=ref_id)
+    if kind == 2 and ref_id in catalog.tasks:
+        return "📝", _task_path(ref_id), TaskCb(task_id=ref_id)
+    return None
+
+
+async def render_search(query: str, page: int = 0):
+    fts_query = _fts_query(query)
+    rows, has_more = (await db.read(_search_page, fts_query, page, SEARCH_PAGE_SIZE)) if fts_query else ([], False)
+
+    builder = InlineKeyboardBuilder()
+    text = f"🔎 Поиск: {query}\n\n"
+    shown = 0
+    for row in rows:
+        hit = _search_hit(row['rowid'])
+        if not hit:
+            continue
+        icon, title, callback_data = hit
+        shown += 1
+        text += f"{page * SEARCH_PAGE_SIZE + shown}. {icon} {title}\n"
+        if row['snippet']:
+            text += f"    {row['snippet']}\n"
+        builder.row(InlineKeyboardButton(text=f"{icon} {title}"[:64], callback_data=callback_data.pack()))
+    if not shown:
+        text += "Ничего не найдено" if page == 0 else "Больше результатов нет"
+
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=SearchCb(page=page - 1).pack()))
+    if has_more:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=SearchCb(page=page + 1).pack()))
+    if nav:
+        builder.row(*nav)
+    return text, builder.as_markup()
+
+
+@dp.message(Command("search"))
+async def search_command(message: Message, command: CommandObject, state: FSMContext):
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer("Использование: /search <слова из названия или описания>")
+        return
+
+    # Запрос хранится в данных FSM: в callback_data помещается только номер страницы
+    await state.update_data(search_query=query)
+    text, kb = await render_search(query)
+    await message.answer(text, reply_markup=kb)
+
+
+@callbacks.route(SearchCb)
+async def search_page(callback: CallbackQuery, callback_data: SearchCb, state: FSMContext):
+    query = (await state.get_data()).get('search_query')
+    if not query:
+        await callback.answer("⚠️ Поиск устарел, повторите /search")
+        return
+
+    text, kb = await render_search(query, callback_data.page)
+    await safe_edit_text(callback.message, text, kb)
+
 ### BLOCK 8.1: SUPPORT SYSTEM ###
 @dp.message(F.text == ("🆘 Поддержка"))
 async def support_request(message: types.Message):
@@ -511,37 +2818,31 @@ async def support_request(message: types.Message):
 class TaskStates(StatesGroup):
     waiting_for_solution = State()
 
-@dp.callback_query(F.data.startswith("task_"))
-async def task_selected(callback: types.CallbackQuery, state: FSMContext):
+@callbacks.route(TaskCb, deferred_ack=lambda data: data.task_id in catalog.tasks)
+async def task_selected(callback: types.CallbackQuery, callback_data: TaskCb, state: FSMContext):
     try:
-        task_id = int(callback.data.split("_")[1])
+        task_id = callback_data.task_id
         
-        with Database() as cursor:
-            # Получаем данные задания
-            cursor.execute(
-                "SELECT title, content, file_id FROM tasks WHERE task_id = ?",
-                (task_id,)
-            )
-            task = cursor.fetchone()
-            
-            if not task:
-                await callback.answer("❌ Задание не найдено")
-                return
+        # Получаем данные задания
+        task = catalog.tasks.get(task_id)
+        
+        if not task:
+            await callback.answer("❌ Задание не найдено")
+            return
 
-            # Проверяем предыдущие решения
-            cursor.execute(
-                "SELECT status, score FROM submissions "
-                "WHERE user_id = ? AND task_id = ?",
-                (callback.from_user.id, task_id)
-            )
-            submission = cursor.fetchone()
+        # Проверяем предыдущие решения
+        submission = await db.fetchone(
+            "SELECT status, score FROM submissions "
+            "WHERE user_id = ? AND task_id = ?",
+            (callback.from_user.id, task_id)
+        )
 
-        text = f"📝 Задание: {task['title']}\n\n{task['content']}"
+        text = f"📝 Задание: {task.title}\n\n{task.content}"
         
         # Отправляем файл задания, если есть
-        if task['file_id']:
+        if task.file_id:
             try:
-                await callback.message.answer_document(task['file_id'])
+                await callback.message.answer_document(task.file_id)
             except Exception as e:
                 logger.error(f"Ошибка отправки файла задания: {e}")
         
@@ -561,49 +2862,133 @@ async def task_selected(callback: types.CallbackQuery, state: FSMContext):
         logger.error(f"Ошибка выбора задания: {str(e)}", exc_info=True)
         await callback.answer("❌ Ошибка загрузки задания")
 
+class AlbumCollector:
+    """Склеивает сообщения одного альбома в одно решение.
+
+    Telegram присылает альбом отдельными сообщениями с общим media_group_id.
+    Сообщения копятся по ключу (user_id, media_group_id); обработчик
+    вызывается один раз — через delay секунд после последнего сообщения
+    или раньше, если от пользователя пришел другой апдейт (flush_user).
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._albums: Dict[tuple, List[Message]] = {}
+        self._timers: Dict[tuple, asyncio.TimerHandle] = {}
+        self._callbacks: Dict[tuple, Any] = {}
+        self._tasks: Dict[asyncio.Task, int] = {}
+
+    def add(self, message: Message, callback):
+        """Добавляет сообщение; callback(messages) вызывается для всего альбома.
+
+        Используется callback первой части альбома, поэтому данные, нужные
+        для сохранения, он должен захватить сразу, а не читать при вызове.
+        """
+        key = (message.from_user.id, message.media_group_id)
+        self._albums.setdefault(key, []).append(message)
+        self._callbacks.setdefault(key, callback)
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        self._timers[key] = asyncio.get_running_loop().call_later(self.delay, self._flush, key)
+
+    def pending(self, user_id: int) -> bool:
+        return any(key[0] == user_id for key in self._timers) or user_id in self._tasks.values()
+
+    def _flush(self, key):
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        messages = sorted(self._albums.pop(key), key=lambda m: m.message_id)
+        task = asyncio.create_task(self._callbacks.pop(key)(messages))
+        self._tasks[task] = key[0]
+        task.add_done_callback(lambda done: self._tasks.pop(done, None))
+
+    async def flush_user(self, user_id: int):
+        """Сохраняет альбомы пользователя, не дожидаясь таймеров."""
+        for key in [key for key in self._timers if key[0] == user_id]:
+            self._flush(key)
+        tasks = [task for task, owner in self._tasks.items() if owner == user_id]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def close(self):
+        # Недособранные альбомы сохраняем сразу, не дожидаясь таймеров
+        for key in list(self._timers):
+            self._flush(key)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+albums = AlbumCollector(delay=float(os.getenv('ALBUM_DEBOUNCE', '1.0')))
+
+
+def message_files(message: Message) -> List[str]:
+    if message.document:
+        return [f"doc:{message.document.file_id}"]
+    if message.photo:
+        return [f"photo:{message.photo[-1].file_id}"]
+    return []
+
+
 @dp.message(TaskStates.waiting_for_solution, F.content_type.in_({'text', 'document', 'photo'}))
 async def process_solution(message: Message, state: FSMContext):
     data = await state.get_data()
     task_id = data['task_id']
+    if message.media_group_id:
+        # Задание запоминаем по первой части: к моменту сборки альбома
+        # состояние уже может смениться следующим сообщением пользователя
+        async def _album_done(messages: List[Message]):
+            try:
+                file_ids = [file for part in messages for file in message_files(part)]
+                caption = next((part.caption for part in messages if part.caption), None)
+                await save_solution(messages[0], state, task_id, file_ids, caption)
+            except Exception as e:
+                logger.error(f"Ошибка сохранения альбома: {e}", exc_info=True)
+
+        albums.add(message, _album_done)
+        return
+
+    await save_solution(message, state, task_id, message_files(message), message.text or message.caption)
+
+
+async def save_solution(message: Message, state: FSMContext, task_id: int,
+                        file_ids: List[str], content: Optional[str]):
     user_id = message.from_user.id
+    task = catalog.tasks.get(task_id)
+    module = catalog.modules.get(task.module_id) if task else None
+    course_id = module.course_id if module else None
     
     try:
-        file_ids = []
-        content = None
-        
-        # Обрабатываем разные типы контента
-        if message.content_type == 'text':
-            content = message.text
-        elif message.document:
-            file_ids.append(f"doc:{message.document.file_id}")
-        elif message.photo:
-            file_ids.append(f"photo:{message.photo[-1].file_id}")
-
-        # Сохраняем решение в БД
-        with Database() as cursor:
-            cursor.execute("BEGIN TRANSACTION")
-            
+        # Сохраняем решение в БД и сразу назначаем проверяющего
+        def _save(cursor):
             # Проверка на существующее решение
             cursor.execute(
                 "SELECT 1 FROM submissions WHERE user_id = ? AND task_id = ?",
                 (user_id, task_id)
             )
             if cursor.fetchone():
-                await message.answer("❌ Вы уже отправляли решение для этого задания!")
-                cursor.execute("ROLLBACK")
-                return
+                return False, None
 
             # Вставляем новую запись
-            cursor.execute(
+            submission_id = cursor.execute(
                 """INSERT INTO submissions 
                 (user_id, task_id, submitted_at, file_id, content)
                 VALUES (?, ?, ?, ?, ?)""",
                 (user_id, task_id, datetime.now().isoformat(), ",".join(file_ids), content)
-            )
-            cursor.execute("COMMIT")
+            ).lastrowid
+            reviewer_id = reviewers.assign(cursor, submission_id, course_id, user_id)
+            if REVIEW_PUSH and reviewer_id is not None:
+                reviewers.mark_pushed(cursor, submission_id, reviewer_id)
+            return True, reviewer_id
+
+        saved, reviewer_id = await db.transaction(_save)
+        if not saved:
+            await message.answer("❌ Вы уже отправляли решение для этого задания!")
+            return
         
-        await message.answer("✅ Решение отправлено на проверку!")
-        await notify_admin(task_id, user_id)
+        files_note = f" ({len(file_ids)} файлов)" if len(file_ids) > 1 else ""
+        await message.answer(f"✅ Решение отправлено на проверку!{files_note}")
+        if REVIEW_PUSH:
+            await notify_admin(task_id, user_id, chat_id=reviewer_id)
 
     except sqlite3.IntegrityError as e:
         logger.error(f"Ошибка целостности данных: {str(e)}")
@@ -614,125 +2999,145 @@ async def process_solution(message: Message, state: FSMContext):
     finally:
         await state.clear()
 
-async def notify_admin(task_id: int, user_id: int):
+async def notify_admin(task_id: int, user_id: int, chat_id: Optional[int] = None):
+    chat_id = chat_id or ADMIN_ID
     try:
-        if not ADMIN_ID:
+        if not chat_id:
             logger.error("ADMIN_ID не установлен!")
             return
 
-        with Database() as cursor:
-            # Получаем данные для уведомления
-            cursor.execute(
-                """SELECT s.content, s.file_id, u.full_name, t.title 
-                FROM submissions s
-                JOIN users u ON s.user_id = u.user_id
-                JOIN tasks t ON s.task_id = t.task_id
-                WHERE s.task_id = ? AND s.user_id = ?""",
-                (task_id, user_id)
-            )
-            submission = cursor.fetchone()
+        # Получаем данные для уведомления
+        submission = await db.fetchone(
+            """SELECT s.content, s.file_id, u.full_name, t.title 
+            FROM submissions s
+            JOIN users u ON s.user_id = u.user_id
+            JOIN tasks t ON s.task_id = t.task_id
+            WHERE s.task_id = ? AND s.user_id = ?""",
+            (task_id, user_id)
+        )
 
-            if not submission:
-                logger.error(f"Данные не найдены: task_id={task_id}, user_id={user_id}")
-                return
+        if not submission:
+            logger.error(f"Данные не найдены: task_id={task_id}, user_id={user_id}")
+            return
 
-            text = (f"📬 Новое решение!\n\n"
-                    f"Студент: {submission['full_name']}\n"
-                    f"Задание: {submission['title']}\n\n"
-                    f"Текст: {submission['content'] or 'Отсутствует'}")
-
-            admin_kb = InlineKeyboardBuilder()
-            admin_kb.button(text="✅ Принять", callback_data=f"accept_{task_id}_{user_id}")
-            admin_kb.button(text="❌ Вернуть", callback_data=f"reject_{task_id}_{user_id}")
-
-            # Обработка файлов
-            if submission['file_id']:
-                files = submission['file_id'].split(',')
-                media = MediaGroupBuilder()
-                
-                for idx, file in enumerate(files):
-                    file_type, file_id = file.split(":", 1)
-                    if idx == 0:  # Первый файл с кнопками
-                        if file_type == "doc":
-                            await bot.send_document(
-                                ADMIN_ID, 
-                                document=file_id, 
-                                caption=text,
-                                reply_markup=admin_kb.as_markup()
-                            )
-                        elif file_type == "photo":
-                            await bot.send_photo(
-                                ADMIN_ID,
-                                photo=file_id,
-                                caption=text,
-                                reply_markup=admin_kb.as_markup()
-                            )
-                    else:  # Остальные файлы в медиагруппе
+        text = (f"📬 Новое решение!\n\n"
+                f"Студент: {submission['full_name']}\n"
+                f"Задание: {submission['title']}\n\n"
+                f"Текст: {submission['content'] or 'Отсутствует'}")
+
+        admin_kb = InlineKeyboardBuilder()
+        admin_kb.button(
+            text="✅ Принять",
+            callback_data=ReviewCb(action="accept", task_id=task_id, user_id=user_id).pack()
+        )
+        admin_kb.button(
+            text="❌ Вернуть",
+            callback_data=ReviewCb(action="reject", task_id=task_id, user_id=user_id).pack()
+        )
+
+        # Обработка файлов
+        files = [file.split(":", 1) for file in (submission['file_id'] or "").split(",") if file]
+        if len(files) == 1:
+            # Один файл — одно сообщение с подписью и кнопками
+            file_type, file_id = files[0]
+            method = SendDocument if file_type == "doc" else SendPhoto
+            await outbox.send(method(
+                chat_id=chat_id,
+                **{"document" if file_type == "doc" else "photo": file_id},
+                caption=text,
+                reply_markup=admin_kb.as_markup()
+            ))
+        elif files:
+            # Альбомы: фото и документы нельзя смешивать, не больше 10 в группе;
+            # кнопки к альбому не прикрепить — они идут отдельным сообщением
+            for file_type in ("photo", "doc"):
+                group = [file_id for kind, file_id in files if kind == file_type]
+                for start in range(0, len(group), 10):
+                    chunk = group[start:start + 10]
+                    if len(chunk) == 1:
+                        method = SendDocument if file_type == "doc" else SendPhoto
+                        await outbox.send(method(
+                            chat_id=chat_id, **{"document" if file_type == "doc" else "photo": chunk[0]}
+                        ))
+                        continue
+                    media = MediaGroupBuilder()
+                    for file_id in chunk:
                         if file_type == "doc":
-                            media.add_document(document=file_id)
-                        elif file_type == "photo":
-                            media.add_photo(photo=file_id)
-                
-                if len(files) > 1:
-                    await bot.send_media_group(ADMIN_ID, media=media.build())
-            else:
-                await bot.send_message(
-                    ADMIN_ID,
-                    text,
-                    reply_markup=admin_kb.as_markup()
-                )
+                            media.add_document(media=file_id)
+                        else:
+                            media.add_photo(media=file_id)
+                    await outbox.send(SendMediaGroup(chat_id=chat_id, media=media.build()))
+            await outbox.send(SendMessage(
+                chat_id=chat_id,
+                text=text,
+                reply_markup=admin_kb.as_markup()
+            ))
+        else:
+            await outbox.send(SendMessage(
+                chat_id=chat_id,
+                text=text,
+                reply_markup=admin_kb.as_markup()
+            ))
 
     except Exception as e:
         logger.error(f"Ошибка уведомления: {str(e)}", exc_info=True)
-        await bot.send_message(
-            ADMIN_ID,
-            f"⚠️ Ошибка обработки решения\nTask: {task_id}\nUser: {user_id}"
-        )
+        await outbox.send(SendMessage(
+            chat_id=chat_id,
+            text=f"⚠️ Ошибка обработки решения\nTask: {task_id}\nUser: {user_id}"
+        ))
 
-@dp.callback_query(F.data.startswith("accept_") | F.data.startswith("reject_"))
-async def handle_submission_review(callback: types.CallbackQuery):
+@callbacks.route(ReviewCb)
+async def handle_submission_review(callback: types.CallbackQuery, callback_data: ReviewCb):
+    if not reviewers.is_reviewer(callback.from_user.id):
+        return
     try:
-        parts = callback.data.split('_')
-        if len(parts) != 3:
+        action = callback_data.action
+        task_id = callback_data.task_id
+        user_id = callback_data.user_id
+        if action not in ("accept", "reject"):
             await callback.answer("❌ Неверный формат данных")
             return
-            
-        action, task_id_str, user_id_str = parts
-        
-        try:
-            task_id = int(task_id_str)
-            user_id = int(user_id_str)
-        except ValueError:
-            await callback.answer("❌ Ошибка в данных")
-            return
 
         new_status = "accepted" if action == "accept" else "rejected"
+        reviewer_id = _review_scope(callback.from_user.id)
 
-        with Database() as cursor:
-            # Обновляем статус решения
-            cursor.execute(
-                "UPDATE submissions SET status = ? WHERE task_id = ? AND user_id = ?",
-                (new_status, task_id, user_id)
-            )
+        def _review(cursor):
+            # Обновляем статус решения; проверяющий не может перехватить чужое закрепленное
+            # решение или решение курса, в пул которого он не входит
+            if reviewer_id is None:
+                cursor.execute(
+                    "UPDATE submissions SET status = ? WHERE task_id = ? AND user_id = ?",
+                    (new_status, task_id, user_id)
+                )
+            else:
+                scope, scope_params = reviewers.scope_clause(reviewer_id)
+                if cursor.execute(
+                    f"UPDATE submissions SET status = ? "
+                    f"WHERE task_id = ? AND user_id = ? AND status = 'pending' "
+                    f"AND {reviewers.claim_clause()} AND {scope}",
+                    (new_status, task_id, user_id, reviewer_id, time.time(), *scope_params)
+                ).rowcount == 0:
+                    return None
             
             # Получаем данные для уведомления
             cursor.execute(
                 "SELECT title FROM tasks WHERE task_id = ?",
                 (task_id,)
             )
-            task_title = cursor.fetchone()['title']
+            return cursor.fetchone()['title']
+
+        task_title = await db.transaction(_review)
+        if task_title is None:
+            await callback.answer("⚠️ Решение уже проверено или закреплено за другим проверяющим")
+            await callback.message.edit_reply_markup(reply_markup=None)
+            return
 
         # Уведомляем пользователя
         user_message = (
             f"📢 Ваше решение по заданию \"{task_title}\" "
             f"{'принято ✅' if action == 'accept' else 'отклонено ❌'}."
         )
-        try:
-            await bot.send_message(user_id, user_message)
-        except exceptions.TelegramForbiddenError:
-            logger.error(f"Пользователь {user_id} заблокировал бота")
-        except Exception as e:
-            logger.error(f"Ошибка уведомления: {e}")
+        await outbox.send(SendMessage(chat_id=user_id, text=user_message))
 
         await callback.answer("✅ Статус обновлен!")
         await callback.message.edit_reply_markup(reply_markup=None)
@@ -741,77 +3146,6 @@ async def handle_submission_review(callback: types.CallbackQuery):
         logger.error(f"Ошибка обработки решения: {str(e)}", exc_info=True)
         await callback.answer("❌ Ошибка обновления статуса")
 
-### BLOCK 10: ADMIN TASK REVIEW ###
-@dp.callback_query(F.data.startswith("accept_"))
-async def accept_solution(callback: types.CallbackQuery):
-    _, task_id, user_id = map(int, callback.data.split("_"))
-    
-    with Database() as cursor:
-        cursor.execute(
-            "UPDATE submissions SET status = 'accepted', score = 5 "
-            "WHERE task_id = ? AND user_id = ?",
-            (task_id, user_id)
-        )
-    
-    await callback.message.edit_text("✅ Решение принято")
-    await bot.send_message(
-        user_id,
-        "🎉 Ваше решение принято! Оценка: 5/5\nМожете переходить к следующему заданию!"
-    )
-
-@dp.callback_query(F.data.startswith("reject_"))
-async def reject_solution(callback: types.CallbackQuery):
-    _, task_id, user_id = map(int, callback.data.split("_"))
-    
-    with Database() as cursor:
-        cursor.execute(
-            "UPDATE submissions SET status = 'rejected' "
-            "WHERE task_id = ? AND user_id = ?",
-            (task_id, user_id)
-        )
-    
-    await callback.message.edit_text("🔄 Решение возвращено")
-    await bot.send_message(
-        user_id,
-        "⚠️ Решение требует доработки. Пожалуйста, пересмотрите задание."
-    )
-
-        ### BLOCK 10: ADMIN TASK REVIEW ###
-@dp.callback_query(F.data.startswith("accept_"))
-async def accept_solution(callback: types.CallbackQuery):
-    _, task_id, user_id = callback.data.split("_")
-    
-    with Database() as cursor:
-        cursor.execute(
-            "UPDATE submissions SET status = 'accepted', score = 5 "
-            "WHERE task_id = ? AND user_id = ?",
-            (int(task_id), int(user_id))
-        )
-    
-    await callback.message.edit_text("✅ Решение принято")
-    await bot.send_message(
-        user_id,
-        "🎉 Ваше решение принято! Оценка: 5/5\n"
-        "Можете переходить к следующему заданию!"
-    )
-
-@dp.callback_query(F.data.startswith("reject_"))
-async def reject_solution(callback: types.CallbackQuery):
-    _, task_id, user_id = callback.data.split("_")
-    
-    with Database() as cursor:
-        cursor.execute(
-            "UPDATE submissions SET status = 'rejected' "
-            "WHERE task_id = ? AND user_id = ?",
-            (int(task_id), int(user_id))
-        )
-    
-    await callback.message.edit_text("🔄 Решение возвращено на доработку")
-    await bot.send_message(
-        user_id,
-        "⚠️ Решение требует доработки. Пожалуйста, пересмотрите задание и отправьте снова."
-    )
-
     ### BLOCK 11: ADMIN PANEL ###
 ADMIN_COMMANDS = [
     ("📊 Статистика", "stats"),
@@ -820,26 +3154,23 @@ ADMIN_COMMANDS = [
     ("➕ Добавить модуль", "add_module"),
     ("📌 Добавить задание", "add_task"),
     ("👥 Пользователи", "list_users"),
+    ("📋 Очередь проверки", "review_queue"),
     ("🔙 В главное меню", "main_menu")
 ]
 
 
 ### BLOCK 11: ADMIN PANEL ###
-def admin_menu():
+def _build_admin_menu():
     builder = ReplyKeyboardBuilder()
     for text, _ in ADMIN_COMMANDS:
         builder.button(text=text)
-    builder.adjust(2, 2, 1)
+    builder.adjust(2)
     return builder.as_markup(resize_keyboard=True)
 
-@dp.callback_query(F.data == "cancel")
-async def admin_cancel_handler(callback: types.CallbackQuery, state: FSMContext):
-    await state.clear()
-    await callback.message.edit_text("❌ Действие отменено")
-    await callback.message.answer(
-        "Админ-меню:",
-        reply_markup=admin_menu()
-    )
+ADMIN_MENU = _build_admin_menu()
+
+def admin_menu():
+    return ADMIN_MENU
 
 @dp.message(F.text == "🔙 В главное меню")
 async def back_to_main_menu(message: types.Message):
@@ -848,54 +3179,241 @@ async def back_to_main_menu(message: types.Message):
         reply_markup=main_menu()
     )
 
+### BLOCK 11.2: USER BROWSER ###
+def _users_page(cursor, course_id: int, after: int, forward: bool, limit: int):
+    """Страница пользователей по ключу user_id (keyset): без OFFSET и полного GROUP BY."""
+    where = ["user_id > ?" if forward else "user_id < ?"]
+    params = [after]
+    if course_id:
+        where.append("current_course = ?")
+        params.append(course_id)
+    rows = cursor.execute(f'''
+        SELECT u.user_id, u.full_name, u.current_course,
+               (SELECT COUNT(*) FROM submissions s WHERE s.user_id = u.user_id)
+        FROM users u
+        WHERE {" AND ".join(where)}
+        ORDER BY u.user_id {"ASC" if forward else "DESC"}
+        LIMIT ?
+    ''', (*params, limit + 1)).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not forward:
+        rows.reverse()
+    return rows, has_more
+
+
+async def render_users_page(course_id: int = 0, after: int = 0, forward: bool = True):
+    rows, has_more = await db.read(_users_page, course_id, after, forward, USERS_PAGE_SIZE)
+    course = catalog.courses.get(course_id)
+
+    response = "📊 Список пользователей"
+    response += f" курса «{course.title}»:\n\n" if course else ":\n\n"
+    if not rows:
+        response += "Пользователей нет"
+    for user_id, full_name, current_course, submitted in rows:
+        entry = catalog.courses.get(current_course)
+        response += f"👤 {full_name} ({user_id})\n"
+        response += f"Курс: {entry.title if entry else 'не выбран'}\n"
+        response += f"Отправлено решений: {submitted}\n\n"
+
+    # Назад листать можно, если пришли вперед не с начала; вперед — если пришли назад
+    has_prev = has_more if not forward else after > 0
+    has_next = has_more if forward else True
+    builder = InlineKeyboardBuilder()
+    nav = []
+    if rows and has_prev:
+        nav.append(InlineKeyboardButton(
+            text="⬅️", callback_data=UsersPageCb(course_id=course_id, cursor=rows[0][0], forward=False).pack()
+        ))
+    if rows and has_next:
+        nav.append(InlineKeyboardButton(
+            text="➡️", callback_data=UsersPageCb(course_id=course_id, cursor=rows[-1][0], forward=True).pack()
+        ))
+    if nav:
+        builder.row(*nav)
+    builder.row(
+        InlineKeyboardButton(text="🔎 Курс", callback_data=UsersFilterCb().pack()),
+        InlineKeyboardButton(text="📥 CSV", callback_data=UsersExportCb(course_id=course_id).pack())
+    )
+    return response, builder.as_markup()
+
+
 @dp.message(F.text == "👥 Пользователи")
 async def list_users(message: types.Message):
     if message.from_user.id != int(ADMIN_ID):
         return
-    
-    with Database() as cursor:
-        cursor.execute('''
-            SELECT u.user_id, u.full_name, c.title, COUNT(s.task_id) 
-            FROM users u
-            LEFT JOIN courses c ON u.current_course = c.course_id
-            LEFT JOIN submissions s ON u.user_id = s.user_id
-            GROUP BY u.user_id
-        ''')
-        users = cursor.fetchall()
-    
-    response = "📊 Список пользователей:\n\n"
-    for user in users:
-        response += f"👤 {user[1]} ({user[0]})\n"
-        response += f"Курс: {user[2] or 'не выбран'}\n"
-        response += f"Решено заданий: {user[3]}\n\n"
-    
-    await message.answer(response)
+
+    text, kb = await render_users_page()
+    await message.answer(text, reply_markup=kb)
+
+
+@callbacks.route(UsersPageCb)
+async def users_page(callback: CallbackQuery, callback_data: UsersPageCb):
+    if callback.from_user.id != int(ADMIN_ID):
+        return
+
+    text, kb = await render_users_page(callback_data.course_id, callback_data.cursor, callback_data.forward)
+    await safe_edit_text(callback.message, text, kb)
+    await callback.answer()
+
+
+@callbacks.route(UsersFilterCb)
+async def users_filter(callback: CallbackQuery):
+    if callback.from_user.id != int(ADMIN_ID):
+        return
+
+    builder = InlineKeyboardBuilder()
+    builder.button(text="👥 Все пользователи", callback_data=UsersPageCb(course_id=0, cursor=0, forward=True))
+    for course in catalog.courses.values():
+        builder.button(
+            text=f"📚 {course.title}",
+            callback_data=UsersPageCb(course_id=course.course_id, cursor=0, forward=True)
+        )
+    builder.adjust(1)
+    await callback.message.edit_text("Выберите курс:", reply_markup=builder.as_markup())
+    await callback.answer()
+
+
+@callbacks.route(UsersExportCb)
+async def users_export(callback: CallbackQuery, callback_data: UsersExportCb):
+    if callback.from_user.id != int(ADMIN_ID):
+        return
+
+    course_id = callback_data.course_id
+    sql = '''
+        SELECT u.user_id, u.full_name, c.title, u.registered_at,
+               (SELECT COUNT(*) FROM submissions s WHERE s.user_id = u.user_id),
+               (SELECT COUNT(*) FROM submissions s WHERE s.user_id = u.user_id AND s.status = 'accepted')
+        FROM users u
+        LEFT JOIN courses c ON c.course_id = u.current_course
+    '''
+    params = ()
+    if course_id:
+        sql += " WHERE u.current_course = ?"
+        params = (course_id,)
+    sql += " ORDER BY u.user_id"
+
+    started = exports.start(
+        ("users", callback.from_user.id),
+        callback.from_user.id,
+        f"users_{course_id}.csv" if course_id else "users.csv",
+        ["user_id", "full_name", "course", "registered_at", "submissions", "accepted"],
+        sql,
+        params
+    )
+    await callback.answer("⏳ Выгрузка готовится..." if started else "⏳ Выгрузка уже идет")
+
+
+### BLOCK 11.3: SUBMISSIONS EXPORT ###
+SUBMISSIONS_EXPORT_USAGE = (
+    "Использование: /export_submissions [course=ID] [module=ID] "
+    "[status=pending|accepted|rejected] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД]"
+)
+
+
+def build_submissions_export(args: Optional[str]) -> Tuple[str, tuple]:
+    """Собирает запрос выгрузки по фильтрам вида key=value; ValueError при ошибке."""
+    filters = {}
+    for token in (args or "").split():
+        key, sep, value = token.partition("=")
+        if not sep or key not in ("course", "module", "status", "from", "to"):
+            raise ValueError(token)
+        filters[key] = value
+
+    where, params = [], []
+    if "course" in filters:
+        where.append("m.course_id = ?")
+        params.append(int(filters["course"]))
+    if "module" in filters:
+        where.append("t.module_id = ?")
+        params.append(int(filters["module"]))
+    if "status" in filters:
+        if filters["status"] not in ("pending", "accepted", "rejected"):
+            raise ValueError(filters["status"])
+        where.append("s.status = ?")
+        params.append(filters["status"])
+    if "from" in filters:
+        where.append("s.submitted_at >= ?")
+        params.append(datetime.strptime(filters["from"], "%Y-%m-%d").date().isoformat())
+    if "to" in filters:
+        # Граница включительно: все решения до начала следующего дня
+        day = datetime.strptime(filters["to"], "%Y-%m-%d") + timedelta(days=1)
+        where.append("s.submitted_at < ?")
+        params.append(day.date().isoformat())
+
+    sql = '''
+        SELECT s.submission_id, s.user_id, u.full_name, c.title, m.title, t.title,
+               s.status, s.score, s.submitted_at, s.content, s.file_id
+        FROM submissions s
+        JOIN users u ON u.user_id = s.user_id
+        JOIN tasks t ON t.task_id = s.task_id
+        JOIN modules m ON m.module_id = t.module_id
+        JOIN courses c ON c.course_id = m.course_id
+    '''
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY s.submission_id"
+    return sql, tuple(params)
+
+
+@dp.message(Command("export_submissions"))
+async def export_submissions_command(message: types.Message, command: CommandObject):
+    if message.from_user.id != int(ADMIN_ID):
+        return
+
+    try:
+        sql, params = build_submissions_export(command.args)
+    except ValueError:
+        await message.answer(SUBMISSIONS_EXPORT_USAGE)
+        return
+
+    started = exports.start(
+        ("submissions", message.from_user.id),
+        message.chat.id,
+        f"submissions_{datetime.now():%Y%m%d_%H%M}.csv",
+        ["submission_id", "user_id", "full_name", "course", "module", "task",
+         "status", "score", "submitted_at", "content", "file_id"],
+        sql,
+        params,
+        compress=True
+    )
+    await message.answer("⏳ Выгрузка готовится..." if started else "⏳ Выгрузка уже идет")
 
 @dp.message(F.text == "📊 Статистика")
 async def show_stats(message: types.Message):
     if message.from_user.id != int(ADMIN_ID):
         return
     
-    with Database() as cursor:
-        cursor.execute('''
-            SELECT c.title, COUNT(DISTINCT m.module_id), COUNT(DISTINCT t.task_id), COUNT(s.submission_id)
-            FROM courses c
-            LEFT JOIN modules m ON c.course_id = m.course_id
-            LEFT JOIN tasks t ON m.module_id = t.module_id
-            LEFT JOIN submissions s ON t.task_id = s.task_id
-            GROUP BY c.course_id
-        ''')
-        stats = cursor.fetchall()
+    # Счетчики поддерживаются триггерами (course_stats), чтение — O(курсов)
+    stats = await db.fetchall('''
+        SELECT c.title, s.modules, s.tasks, s.submissions, s.accepted, s.rejected, s.pending
+        FROM course_stats s
+        JOIN courses c ON c.course_id = s.course_id
+        ORDER BY c.course_id
+    ''')
     
     response = "📈 Статистика по курсам:\n\n"
     for stat in stats:
         response += f"📚 {stat[0]}\n"
         response += f"Модулей: {stat[1]}\n"
         response += f"Заданий: {stat[2]}\n"
-        response += f"Решений: {stat[3]}\n\n"
+        response += f"Решений: {stat[3]} (✅ {stat[4]} / ❌ {stat[5]} / ⏳ {stat[6]})\n\n"
     
     await message.answer(response)
 
+
+@dp.message(Command("rebuild_stats"))
+async def rebuild_stats_command(message: types.Message):
+    if message.from_user.id != int(ADMIN_ID):
+        return
+
+    try:
+        courses = await db.transaction(rebuild_stats)
+        await message.answer(f"✅ Статистика пересчитана ({courses} курсов)")
+    except Exception as e:
+        logger.error(f"Ошибка пересчета статистики: {e}")
+        await message.answer("❌ Не удалось пересчитать статистику")
+
 @dp.message(Command("admin"))
 async def admin_command(message: types.Message):
     if message.from_user.id != int(ADMIN_ID):
@@ -903,9 +3421,8 @@ async def admin_command(message: types.Message):
         return
     
     try:
-        with Database() as cursor:
-            cursor.execute("SELECT 1 FROM courses LIMIT 1")
-            
+        await db.fetchone("SELECT 1 FROM courses LIMIT 1")
+
         await message.answer(
             "🛠 Панель администратора:",
             reply_markup=admin_menu()
@@ -917,6 +3434,412 @@ async def admin_command(message: types.Message):
         logger.error(f"Admin panel error: {e}")
         await message.answer("❌ Не удалось загрузить админ-панель")
 
+@dp.message(Command("broadcast"))
+async def broadcast_command(message: types.Message, command: CommandObject):
+    if message.from_user.id != int(ADMIN_ID):
+        return
+    if not command.args:
+        await message.answer("Использование: /broadcast текст сообщения")
+        return
+
+    users = await db.fetchall("SELECT user_id FROM users")
+    broadcast_id = await broadcasts.create(
+        command.args, [row['user_id'] for row in users], admin_chat_id=message.chat.id
+    )
+    broadcasts.start(broadcast_id)
+
+### BLOCK 11.4: REVIEW QUEUE ###
+def _review_filter(task_ids: Optional[List[int]], reviewer_id: Optional[int]) -> Tuple[List[str], list]:
+    """Условия очереди: pending, фильтр по заданиям и, с reviewer_id, решения его курсов, доступные ему."""
+    where, params = ["s.status = 'pending'"], []
+    if task_ids is not None:
+        where.append(f"s.task_id IN ({','.join('?' * len(task_ids))})")
+        params.extend(task_ids)
+    if reviewer_id is not None:
+        scope, scope_params = reviewers.scope_clause(reviewer_id, "s.task_id")
+        where += [reviewers.claim_clause(), scope]
+        params.extend((reviewer_id, time.time(), *scope_params))
+    return where, params
+
+
+def _review_page(cursor, task_ids: Optional[List[int]], after: int, forward: bool, limit: int,
+                 reviewer_id: Optional[int] = None):
+    """Страница решений в статусе pending по ключу submission_id (индекс ix_submissions_status).
+
+    С reviewer_id показываются только решения его курсов, доступные этому проверяющему.
+    """
+    where, params = _review_filter(task_ids, reviewer_id)
+    where.append("s.submission_id > ?" if forward else "s.submission_id < ?")
+    params.append(after)
+    rows = cursor.execute(f'''
+        SELECT s.submission_id, s.user_id, s.task_id, s.submitted_at, s.content, s.file_id, u.full_name
+        FROM submissions s
+        JOIN users u ON u.user_id = s.user_id
+        WHERE {" AND ".join(where)}
+        ORDER BY s.submission_id {"ASC" if forward else "DESC"}
+        LIMIT ?
+    ''', (*params, limit + 1)).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not forward:
+        rows.reverse()
+    return rows, has_more
+
+
+def _reviewer_pending_count(cursor, task_ids: Optional[List[int]], reviewer_id: int) -> int:
+    # Проверяющему — только то, что он может взять, с теми же условиями, что и страница
+    where, params = _review_filter(task_ids, reviewer_id)
+    return cursor.execute(
+        f"SELECT COUNT(*) FROM submissions s WHERE {' AND '.join(where)}", params
+    ).fetchone()[0]
+
+
+def _pending_count(cursor, course_id: int, task_id: int) -> int:
+    # Счетчики из materialized-статистики, без COUNT по submissions (вид администратора)
+    if task_id:
+        row = cursor.execute("SELECT pending FROM task_stats WHERE task_id = ?", (task_id,)).fetchone()
+    elif course_id:
+        row = cursor.execute("SELECT pending FROM course_stats WHERE course_id = ?", (course_id,)).fetchone()
+    else:
+        row = cursor.execute("SELECT SUM(pending) FROM course_stats").fetchone()
+    return (row[0] if row else 0) or 0
+
+
+def _queue_task_ids(course_id: int, task_id: int) -> Optional[List[int]]:
+    if task_id:
+        return [task_id]
+    if course_id:
+        return [task.task_id for module in catalog.course_modules(course_id)
+                for task in catalog.module_tasks(module.module_id)]
+    return None
+
+
+def _task_path(task_id: int) -> str:
+    task = catalog.tasks.get(task_id)
+    module = catalog.modules.get(task.module_id) if task else None
+    course = catalog.courses.get(module.course_id) if module else None
+    if not task:
+        return f"задание #{task_id}"
+    return f"{course.title if course else '?'} / {task.title}"
+
+
+def _review_scope(user_id: int) -> Optional[int]:
+    """None для администратора (видит всю очередь), иначе id проверяющего."""
+    return None if str(user_id) == ADMIN_ID else user_id
+
+
+async def render_review_queue(state: FSMContext, after: Optional[int] = None, forward: bool = True,
+                              reviewer_id: Optional[int] = None):
+    """Показывает страницу очереди; фильтр, позиция и выбранные решения хранятся в данных FSM."""
+    data = await state.get_data()
+    course_id = data.get('review_course', 0)
+    task_id = data.get('review_task', 0)
+    selected = set(data.get('review_selected', []))
+    if after is None:
+        after = data.get('review_after', 0)
+
+    task_ids = _queue_task_ids(course_id, task_id)
+    if task_ids == []:
+        rows, has_more = [], False
+    else:
+        rows, has_more = await db.read(_review_page, task_ids, after, forward, REVIEW_PAGE_SIZE, reviewer_id)
+    if reviewer_id is None:
+        pending = await db.read(_pending_count, course_id, task_id)
+    elif task_ids == []:
+        pending = 0
+    else:
+        pending = await db.read(_reviewer_pending_count, task_ids, reviewer_id)
+    # Запоминаем начало текущей страницы, чтобы перерисовывать ее после действий
+    await state.update_data(review_after=rows[0]['submission_id'] - 1 if rows else 0)
+
+    if task_id:
+        scope = _task_path(task_id)
+    elif course_id in catalog.courses:
+        scope = catalog.courses[course_id].title
+    else:
+        scope = "все курсы"
+    text = f"📋 Очередь проверки ({scope}): {pending} ожидают\n"
+    text += f"Выбрано: {len(selected)}\n\n" if selected else "\n"
+    if not rows:
+        text += "Нет решений на проверке 🎉"
+
+    builder = InlineKeyboardBuilder()
+    toggles = []
+    for n, row in enumerate(rows, 1):
+        mark = "☑️" if row['submission_id'] in selected else "▫️"
+        files = len([f for f in (row['file_id'] or "").split(",") if f])
+        preview = (row['content'] or "").replace("\n", " ")
+        preview = preview[:60] + "…" if len(preview) > 60 else preview
+        text += f"{n}. {mark} {row['full_name']} — {_task_path(row['task_id'])}\n"
+        text += f"    {preview or '—'}{f' 📎{files}' if files else ''}\n"
+        toggles.append(InlineKeyboardButton(
+            text=f"{mark}{n}",
+            callback_data=ReviewQueueCb(action="toggle", value=row['submission_id']).pack()
+        ))
+        toggles.append(InlineKeyboardButton(
+            text=f"👁{n}",
+            callback_data=ReviewQueueCb(action="view", value=row['submission_id']).pack()
+        ))
+    for i in range(0, len(toggles), 4):
+        builder.row(*toggles[i:i + 4])
+
+    if rows:
+        builder.row(
+            InlineKeyboardButton(text="☑️ Все", callback_data=ReviewQueueCb(action="all", value=0).pack()),
+            InlineKeyboardButton(text="▫️ Сброс", callback_data=ReviewQueueCb(action="none", value=0).pack())
+        )
+    if selected:
+        builder.row(
+            InlineKeyboardButton(text="✅ Принять", callback_data=ReviewQueueCb(action="accept", value=0).pack()),
+            InlineKeyboardButton(text="❌ Вернуть", callback_data=ReviewQueueCb(action="reject", value=0).pack())
+        )
+    nav = []
+    has_prev = has_more if not forward else after > 0
+    has_next = has_more if forward else True
+    if rows and has_prev:
+        nav.append(InlineKeyboardButton(
+            text="⬅️", callback_data=ReviewQueueCb(action="prev", value=rows[0]['submission_id']).pack()
+        ))
+    if rows and has_next:
+        nav.append(InlineKeyboardButton(
+            text="➡️", callback_data=ReviewQueueCb(action="next", value=rows[-1]['submission_id']).pack()
+        ))
+    if nav:
+        builder.row(*nav)
+    builder.row(
+        InlineKeyboardButton(text="🔎 Фильтр", callback_data=ReviewQueueCb(action="filter", value=0).pack()),
+        InlineKeyboardButton(text="🔄", callback_data=ReviewQueueCb(action="refresh", value=0).pack())
+    )
+    return text, builder.as_markup()
+
+
+def review_filter_kb(course_id: int = 0):
+    """Курсы (или задания выбранного курса) с числом решений на проверке."""
+    builder = InlineKeyboardBuilder()
+    if course_id:
+        builder.button(
+            text="Все задания курса", callback_data=ReviewQueueCb(action="course", value=course_id)
+        )
+        for module in catalog.course_modules(course_id):
+            for task in catalog.module_tasks(module.module_id):
+                builder.button(
+                    text=f"{module.title} / {task.title}",
+                    callback_data=ReviewQueueCb(action="task", value=task.task_id)
+                )
+    else:
+        builder.button(text="Все курсы", callback_data=ReviewQueueCb(action="course", value=0))
+        for course in catalog.courses.values():
+            builder.button(
+                text=course.title, callback_data=ReviewQueueCb(action="tasks", value=course.course_id)
+            )
+    builder.adjust(1)
+    return builder.as_markup()
+
+
+def _apply_reviews(cursor, submission_ids: List[int], status: str, reviewer_id: Optional[int] = None):
+    """Меняет статус выбранных решений одной транзакцией; возвращает [(user_id, название задания)].
+
+    Решения, закрепленные за другим проверяющим или из чужих курсов, пропускаются.
+    """
+    placeholders = ",".join("?" * len(submission_ids))
+    select_claim, update_claim, claim_params = "", "", ()
+    if reviewer_id is not None:
+        # В SELECT таблица submissions названа s, поэтому условие строится с псевдонимом
+        select_scope, scope_params = reviewers.scope_clause(reviewer_id, "s.task_id")
+        update_scope, _ = reviewers.scope_clause(reviewer_id)
+        select_claim = f" AND {reviewers.claim_clause()} AND {select_scope}"
+        update_claim = f" AND {reviewers.claim_clause()} AND {update_scope}"
+        claim_params = (reviewer_id, time.time(), *scope_params)
+    reviewed = cursor.execute(f'''
+        SELECT s.user_id, t.title
+        FROM submissions s
+        JOIN tasks t ON t.task_id = s.task_id
+        WHERE s.submission_id IN ({placeholders}) AND s.status = 'pending'{select_claim}
+    ''', (*submission_ids, *claim_params)).fetchall()
+    cursor.execute(
+        f"UPDATE submissions SET status = ? "
+        f"WHERE submission_id IN ({placeholders}) AND status = 'pending'{update_claim}",
+        (status, *submission_ids, *claim_params)
+    )
+    return [(row['user_id'], row['title']) for row in reviewed]
+
+
+async def notify_reviewed(reviewed: List[tuple], accepted: bool):
+    """Одно сообщение студенту на все его проверенные решения."""
+    by_user: Dict[int, List[str]] = {}
+    for user_id, title in reviewed:
+        by_user.setdefault(user_id, []).append(title)
+    verdict = "принято ✅" if accepted else "отклонено ❌"
+    for user_id, titles in by_user.items():
+        if len(titles) == 1:
+            text = f"📢 Ваше решение по заданию \"{titles[0]}\" {verdict}."
+        else:
+            text = f"📢 Проверены ваши решения — {verdict}:\n" + "\n".join(f"• {title}" for title in titles)
+        await outbox.send(SendMessage(chat_id=user_id, text=text))
+
+
+@dp.message(F.text == "📋 Очередь проверки")
+@dp.message(Command("queue"))
+async def review_queue(message: Message, state: FSMContext):
+    if not reviewers.is_reviewer(message.from_user.id):
+        return
+
+    text, kb = await render_review_queue(state, after=0, reviewer_id=_review_scope(message.from_user.id))
+    await message.answer(text, reply_markup=kb)
+
+
+@callbacks.route(ReviewQueueCb)
+async def review_queue_action(callback: CallbackQuery, callback_data: ReviewQueueCb, state: FSMContext):
+    if not reviewers.is_reviewer(callback.from_user.id):
+        return
+
+    action, value = callback_data.action, callback_data.value
+    reviewer_id = _review_scope(callback.from_user.id)
+    data = await state.get_data()
+    selected = list(data.get('review_selected', []))
+    after, forward, toast = None, True, None
+
+    if action == "view":
+        # Открытие решения закрепляет его за проверяющим на время аренды
+        if reviewer_id is not None and not await db.transaction(reviewers.claim, value, reviewer_id):
+            await callback.answer("⚠️ Решение уже проверено или закреплено за другим проверяющим")
+            return
+        row = await db.fetchone("SELECT task_id, user_id FROM submissions WHERE submission_id = ?", (value,))
+        if row:
+            await notify_admin(row['task_id'], row['user_id'], chat_id=callback.message.chat.id)
+        await callback.answer()
+        return
+    if action == "filter":
+        await callback.message.edit_text("Фильтр очереди:", reply_markup=review_filter_kb())
+        await callback.answer()
+        return
+    if action == "tasks":
+        await callback.message.edit_text("Фильтр очереди:", reply_markup=review_filter_kb(value))
+        await callback.answer()
+        return
+
+    if action == "toggle":
+        if value in selected:
+            selected.remove(value)
+        else:
+            selected.append(value)
+    elif action in ("all", "none"):
+        rows, _ = await db.read(
+            _review_page,
+            _queue_task_ids(data.get('review_course', 0), data.get('review_task', 0)),
+            data.get('review_after', 0), True, REVIEW_PAGE_SIZE, reviewer_id
+        )
+        page = [row['submission_id'] for row in rows]
+        selected = [sid for sid in selected if sid not in page]
+        if action == "all":
+            selected += page
+    elif action in ("accept", "reject"):
+        if not selected:
+            await callback.answer("Ничего не выбрано")
+            return
+        reviewed = await db.transaction(
+            _apply_reviews, selected, "accepted" if action == "accept" else "rejected", reviewer_id
+        )
+        toast = f"{'✅ Принято' if action == 'accept' else '❌ Возвращено'}: {len(reviewed)}"
+        if len(reviewed) < len(selected):
+            toast += f", пропущено: {len(selected) - len(reviewed)}"
+        # Итог показываем до уведомлений и перерисовки очереди
+        await callback.answer(toast)
+        toast = None
+        await notify_reviewed(reviewed, action == "accept")
+        selected = []
+    elif action in ("next", "prev"):
+        after, forward = (value, True) if action == "next" else (value, False)
+    elif action == "course":
+        await state.update_data(review_course=value, review_task=0, review_after=0)
+        selected = []
+    elif action == "task":
+        task = catalog.tasks.get(value)
+        module = catalog.modules.get(task.module_id) if task else None
+        await state.update_data(review_course=module.course_id if module else 0, review_task=value, review_after=0)
+        selected = []
+
+    await state.update_data(review_selected=selected)
+    text, kb = await render_review_queue(state, after, forward, reviewer_id)
+    await safe_edit_text(callback.message, text, kb)
+    if toast is not None:
+        await callback.answer(toast)
+
+
+@dp.message(Command("reviewers"))
+async def list_reviewers(message: Message):
+    if message.from_user.id != int(ADMIN_ID):
+        return
+
+    def _load(cursor):
+        return cursor.execute('''
+            SELECT reviewer_id, COUNT(*) AS pending
+            FROM submissions
+            WHERE status = 'pending' AND reviewer_id IS NOT NULL
+            GROUP BY reviewer_id
+        ''').fetchall()
+
+    pending = {row['reviewer_id']: row['pending'] for row in await db.read(_load)}
+    text = f"👥 Проверяющие (стратегия: {reviewers.strategy})\n\n"
+    text += "Общий пул: " + (", ".join(
+        f"{reviewer_id} ({pending.get(reviewer_id, 0)})" for reviewer_id in reviewers.global_ids
+    ) or "—") + "\n"
+    for course in catalog.courses.values():
+        ids = reviewers.pool(course.course_id)
+        if ids is not reviewers.global_ids:
+            text += f"{course.title}: " + ", ".join(
+                f"{reviewer_id} ({pending.get(reviewer_id, 0)})" for reviewer_id in ids
+            ) + "\n"
+    text += "\n/add_reviewer <course_id> <user_id>\n/remove_reviewer <course_id> <user_id>"
+    await message.answer(text)
+
+
+def _reviewer_args(command: CommandObject) -> Optional[Tuple[int, int]]:
+    parts = (command.args or "").split()
+    if len(parts) != 2 or not all(part.isdigit() for part in parts):
+        return None
+    return int(parts[0]), int(parts[1])
+
+
+@dp.message(Command("add_reviewer"))
+async def add_reviewer(message: Message, command: CommandObject):
+    if message.from_user.id != int(ADMIN_ID):
+        return
+
+    args = _reviewer_args(command)
+    if not args:
+        await message.answer("Использование: /add_reviewer <course_id> <user_id>")
+        return
+    course_id, reviewer_id = args
+    if course_id not in catalog.courses:
+        await message.answer("❌ Курс не найден")
+        return
+    await reviewers.add(course_id, reviewer_id)
+    await message.answer(f"✅ {reviewer_id} проверяет курс «{catalog.courses[course_id].title}»")
+
+
+@dp.message(Command("remove_reviewer"))
+async def remove_reviewer(message: Message, command: CommandObject):
+    if message.from_user.id != int(ADMIN_ID):
+        return
+
+    args = _reviewer_args(command)
+    if not args:
+        await message.answer("Использование: /remove_reviewer <course_id> <user_id>")
+        return
+    course_id, reviewer_id = args
+    await reviewers.remove(course_id, reviewer_id)
+    # Закрепленные решения освобождаются и уходят другим при следующей проверке аренды
+    await db.execute('''
+        UPDATE submissions SET lease_expires_at = 0
+        WHERE status = 'pending' AND reviewer_id = ? AND task_id IN (
+            SELECT t.task_id FROM tasks t JOIN modules m ON m.module_id = t.module_id
+            WHERE m.course_id = ?
+        )
+    ''', (reviewer_id, course_id))
+    await message.answer(f"✅ {reviewer_id} больше не проверяет курс #{course_id}")
+
+
     ### BLOCK 12: COURSE CREATION ###
 @dp.message(F.text == "📝 Добавить курс")
 async def add_course_start(message: types.Message, state: FSMContext):
@@ -946,12 +3869,12 @@ async def process_course_media(message: types.Message, state: FSMContext):
     media_id = await handle_media(message, state)
     data = await state.get_data()
     
-    try:
-        with Database() as cursor:
-            cursor.execute(
-                "INSERT INTO courses (title, description, media_id) VALUES (?, ?, ?)",
-                (data['title'], data['description'], media_id)
-            )
+    try:
+        course_id = await db.execute(
+            "INSERT INTO courses (title, description, media_id) VALUES (?, ?, ?)",
+            (data['title'], data['description'], media_id)
+        )
+        catalog.add_course(course_id, data['title'], data['description'], media_id)
         
         await message.answer(
             f"✅ Курс '{data['title']}' успешно создан!",
@@ -967,11 +3890,11 @@ async def process_course_media(message: types.Message, state: FSMContext):
 async def skip_course_media(message: types.Message, state: FSMContext):
     data = await state.get_data()
     
-    with Database() as cursor:
-        cursor.execute(
-            "INSERT INTO courses (title, description) VALUES (?, ?)",
-            (data['title'], data['description'])
-        )
+    course_id = await db.execute(
+        "INSERT INTO courses (title, description) VALUES (?, ?)",
+        (data['title'], data['description'])
+    )
+    catalog.add_course(course_id, data['title'], data['description'], None)
     
     await message.answer(
         f"✅ Курс '{data['title']}' создан без медиа!",
@@ -980,16 +3903,13 @@ async def skip_course_media(message: types.Message, state: FSMContext):
     await state.clear()
 
 ### BLOCK 11.1: COURSE DELETION SYSTEM ###
+@cached_keyboard("delete_courses")
 def delete_courses_kb():
-    with Database() as cursor:
-        cursor.execute("SELECT course_id, title FROM courses")
-        courses = cursor.fetchall()
-    
     builder = InlineKeyboardBuilder()
-    for course in courses:
+    for course in catalog.courses.values():
         builder.button(
-            text=f"❌ {course['title']}",
-            callback_data=f"delete_course_{course['course_id']}"
+            text=f"❌ {course.title}",
+            callback_data=DeleteCourseCb(course_id=course.course_id).pack()
         )
     builder.button(text="🔙 Отмена", callback_data="cancel")
     builder.adjust(1)
@@ -1000,31 +3920,31 @@ async def delete_course_start(message: Message):
     if message.from_user.id != int(ADMIN_ID):
         return
     
-    with Database() as cursor:
-        cursor.execute("SELECT COUNT(*) FROM courses")
-        if cursor.fetchone()[0] == 0:
-            return await message.answer("❌ Нет доступных курсов для удаления")
+    if not catalog.courses:
+        return await message.answer("❌ Нет доступных курсов для удаления")
     
     await message.answer(
         "📛 Выберите курс для удаления:",
         reply_markup=delete_courses_kb()
     )
 
-@dp.callback_query(F.data.startswith("delete_course_"))
-async def confirm_course_deletion(callback: CallbackQuery, state: FSMContext):
-    course_id = int(callback.data.split("_")[2])
+@callbacks.route(DeleteCourseCb)
+async def confirm_course_deletion(callback: CallbackQuery, callback_data: DeleteCourseCb, state: FSMContext):
+    if callback.from_user.id != int(ADMIN_ID):
+        return
+    course_id = callback_data.course_id
     
-    with Database() as cursor:
-        cursor.execute(
-            "SELECT title FROM courses WHERE course_id = ?",
-            (course_id,)
-        )
-        course_title = cursor.fetchone()[0]
+    # Кнопка могла остаться от уже удаленного курса
+    course = catalog.courses.get(course_id)
+    if not course:
+        await callback.answer("❌ Курс не найден")
+        return
+    course_title = course.title
     
     await state.update_data(course_id=course_id)
     
     confirm_kb = InlineKeyboardBuilder()
-    confirm_kb.button(text="⚠️ УДАЛИТЬ", callback_data=f"confirm_delete_{course_id}")
+    confirm_kb.button(text="⚠️ УДАЛИТЬ", callback_data=ConfirmDeleteCb(course_id=course_id).pack())
     confirm_kb.button(text="❌ Отмена", callback_data="cancel")
     
     await callback.message.edit_text(
@@ -1035,24 +3955,50 @@ async def confirm_course_deletion(callback: CallbackQuery, state: FSMContext):
     )
     await state.set_state(AdminForm.delete_course)
 
-@dp.callback_query(F.data.startswith("confirm_delete_"))
-async def execute_course_deletion(callback: CallbackQuery, state: FSMContext):
-    course_id = int(callback.data.split("_")[2])
+@callbacks.route(ConfirmDeleteCb, deferred_ack=lambda data: data.course_id in catalog.courses)
+async def execute_course_deletion(callback: CallbackQuery, callback_data: ConfirmDeleteCb, state: FSMContext):
+    if callback.from_user.id != int(ADMIN_ID):
+        return
+    course_id = callback_data.course_id
+    # Проверка до транзакции: подсказка должна уйти раньше любой долгой работы
+    if course_id not in catalog.courses:
+        await state.clear()
+        await callback.answer("❌ Курс не найден")
+        return
     
     try:
-        with Database() as cursor:
+        def _delete(cursor):
             # Получаем название перед удалением для отчета
             cursor.execute(
                 "SELECT title FROM courses WHERE course_id = ?",
                 (course_id,)
             )
-            course_title = cursor.fetchone()[0]
+            row = cursor.fetchone()
+            if row is None:
+                return None, []
+            title = row[0]
+
+            # Студентов курса выбираем до удаления: ON DELETE SET NULL сбросит current_course
+            cursor.execute(
+                "SELECT user_id FROM users WHERE current_course = ?",
+                (course_id,)
+            )
+            user_ids = [row[0] for row in cursor.fetchall()]
             
             # Удаляем курс
             cursor.execute(
                 "DELETE FROM courses WHERE course_id = ?",
                 (course_id,)
             )
+            return title, user_ids
+
+        course_title, user_ids = await db.transaction(_delete)
+        if course_title is None:
+            await state.clear()
+            await callback.answer("❌ Курс не найден")
+            return
+        catalog.remove_course(course_id)
+        profiles.clear_course(course_id)
         
         # Очищаем состояние
         await state.clear()
@@ -1063,23 +4009,15 @@ async def execute_course_deletion(callback: CallbackQuery, state: FSMContext):
             f"Все связанные модули и задания также были удалены."
         )
         
-        # Уведомляем пользователей
-        with Database() as cursor:
-            cursor.execute(
-                "SELECT user_id FROM users WHERE current_course = ?",
-                (course_id,)
+        # Уведомляем пользователей фоновой рассылкой
+        if user_ids:
+            broadcast_id = await broadcasts.create(
+                f"📢 Курс '{course_title}' был удален администратором. "
+                f"Пожалуйста, выберите новый курс.",
+                user_ids,
+                admin_chat_id=callback.from_user.id
             )
-            users = cursor.fetchall()
-            
-            for user in users:
-                try:
-                    await bot.send_message(
-                        user['user_id'],
-                        f"📢 Курс '{course_title}' был удален администратором. "
-                        f"Пожалуйста, выберите новый курс."
-                    )
-                except Exception as e:
-                    logger.error(f"Ошибка уведомления пользователя {user['user_id']}: {e}")
+            broadcasts.start(broadcast_id)
 
     except Exception as e:
         logger.error(f"Ошибка удаления курса: {str(e)}")
@@ -1088,16 +4026,13 @@ async def execute_course_deletion(callback: CallbackQuery, state: FSMContext):
         await state.clear()
 
     ### BLOCK 13: MODULE MANAGEMENT ###
+@cached_keyboard("courses_for_modules")
 def courses_for_modules_kb():
-    with Database() as cursor:
-        cursor.execute("SELECT course_id, title FROM courses")
-        courses = cursor.fetchall()
-    
     builder = InlineKeyboardBuilder()
-    for course in courses:
+    for course in catalog.courses.values():
         builder.button(
-            text=course[1],
-            callback_data=f"addmod_{course[0]}"
+            text=course.title,
+            callback_data=AddModuleCb(course_id=course.course_id).pack()
         )
     builder.button(text="❌ Отмена", callback_data="cancel")
     builder.adjust(1)
@@ -1113,9 +4048,9 @@ async def add_module_start(message: types.Message, state: FSMContext):
         reply_markup=courses_for_modules_kb()
     )
 
-@dp.callback_query(F.data.startswith("addmod_"))
-async def select_course_for_module(callback: types.CallbackQuery, state: FSMContext):
-    course_id = int(callback.data.split("_")[1])
+@callbacks.route(AddModuleCb)
+async def select_course_for_module(callback: types.CallbackQuery, callback_data: AddModuleCb, state: FSMContext):
+    course_id = callback_data.course_id
     await state.update_data(course_id=course_id)
     await callback.message.answer("Введите название модуля:")
     await state.set_state(AdminForm.add_module_title)
@@ -1125,11 +4060,11 @@ async def process_module_title(message: types.Message, state: FSMContext):
     data = await state.get_data()
     
     try:
-        with Database() as cursor:
-            cursor.execute(
-                "INSERT INTO modules (course_id, title) VALUES (?, ?)",
-                (data['course_id'], message.text)
-            )
+        module_id = await db.execute(
+            "INSERT INTO modules (course_id, title) VALUES (?, ?)",
+            (data['course_id'], message.text)
+        )
+        catalog.add_module(module_id, data['course_id'], message.text)
         
         await message.answer(
             f"✅ Модуль '{message.text}' успешно добавлен!",
@@ -1142,34 +4077,25 @@ async def process_module_title(message: types.Message, state: FSMContext):
     
     await state.clear()
 
+@cached_keyboard("courses_for_tasks")
 def courses_for_tasks_kb():
-    with Database() as cursor:
-        cursor.execute("SELECT course_id, title FROM courses")
-        courses = cursor.fetchall()
-    
     builder = InlineKeyboardBuilder()
-    for course in courses:
+    for course in catalog.courses.values():
         builder.button(
-            text=course[1],
-            callback_data=f"addtask_{course[0]}"
+            text=course.title,
+            callback_data=AddTaskCourseCb(course_id=course.course_id).pack()
         )
     builder.button(text="❌ Отмена", callback_data="cancel")
     builder.adjust(1)
     return builder.as_markup()
 
+@cached_keyboard("modules_for_tasks")
 def modules_for_tasks_kb(course_id: int):
-    with Database() as cursor:
-        cursor.execute(
-            "SELECT module_id, title FROM modules WHERE course_id = ?",
-            (course_id,)
-        )
-        modules = cursor.fetchall()
-    
     builder = InlineKeyboardBuilder()
-    for module in modules:
+    for module in catalog.course_modules(course_id):
         builder.button(
-            text=module[1],
-            callback_data=f"adm_mod_{module[0]}"  # Changed prefix
+            text=module.title,
+            callback_data=AddTaskModuleCb(module_id=module.module_id).pack()
         )
     builder.button(text="🔙 Назад", callback_data="back_to_tasks_menu")
     builder.adjust(1)
@@ -1184,24 +4110,19 @@ async def add_task_start(message: Message):
         reply_markup=courses_for_tasks_kb()
     )
 
-@dp.callback_query(F.data.startswith("addtask_"))
-async def select_course_handler(callback: CallbackQuery, state: FSMContext):
+@callbacks.route(AddTaskCourseCb)
+async def select_task_course_handler(callback: CallbackQuery, callback_data: AddTaskCourseCb, state: FSMContext):
     if callback.from_user.id != int(ADMIN_ID):
         return
     
     try:
-        course_id = int(callback.data.split("_")[1])
+        course_id = callback_data.course_id
         await state.update_data(course_id=course_id)
         
         # Проверка наличия модулей
-        with Database() as cursor:
-            cursor.execute(
-                "SELECT COUNT(*) FROM modules WHERE course_id = ?",
-                (course_id,)
-            )
-            if cursor.fetchone()[0] == 0:
-                await callback.answer("❌ В курсе нет модулей!")
-                return await callback.message.answer("Сначала создайте модуль в этом курсе")
+        if not catalog.course_modules(course_id):
+            await callback.answer("❌ В курсе нет модулей!")
+            return await callback.message.answer("Сначала создайте модуль в этом курсе")
 
         await callback.message.edit_text(
             "Выберите модуль:",
@@ -1212,21 +4133,16 @@ async def select_course_handler(callback: CallbackQuery, state: FSMContext):
         logger.error(f"Course select error: {str(e)}")
         await callback.answer("⚠️ Ошибка выбора курса")
 
-@dp.callback_query(F.data.startswith("adm_mod_"))
-async def select_module_handler(callback: CallbackQuery, state: FSMContext):
+@callbacks.route(AddTaskModuleCb)
+async def select_module_handler(callback: CallbackQuery, callback_data: AddTaskModuleCb, state: FSMContext):
     if callback.from_user.id != int(ADMIN_ID):
         return
     
     try:
-        module_id = int(callback.data.split("_")[2])  # New index
+        module_id = callback_data.module_id
         await state.update_data(module_id=module_id)
         
-        with Database() as cursor:
-            cursor.execute(
-                "SELECT title FROM modules WHERE module_id = ?",
-                (module_id,)
-            )
-            module_title = cursor.fetchone()[0]
+        module_title = catalog.modules[module_id].title
 
         await callback.message.answer(
             f"📌 Создание задания для модуля: {module_title}\n"
@@ -1239,25 +4155,11 @@ async def select_module_handler(callback: CallbackQuery, state: FSMContext):
         logger.error(f"Module select error: {str(e)}")
         await callback.answer("⚠️ Ошибка выбора модуля")
 
-@dp.callback_query(F.data == "back_to_tasks_menu")
+@callbacks.route("back_to_tasks_menu")
 async def back_to_tasks_handler(callback: CallbackQuery):
-    try:
-        await callback.message.edit_text(
-            "Выберите курс:",
-            reply_markup=courses_for_tasks_kb()
-        )
-    except TelegramBadRequest:
+    if not await safe_edit_text(callback.message, "Выберите курс:", courses_for_tasks_kb()):
         await callback.answer("Список курсов не изменился")
 
-@dp.callback_query(F.data.startswith("admin_module_"))
-async def select_module_for_task(callback: CallbackQuery, state: FSMContext):
-    if callback.from_user.id != int(ADMIN_ID):
-        return
-    module_id = int(callback.data.split("_")[-1])
-    await state.update_data(module_id=module_id)
-    await callback.message.answer("Введите название задания:")
-    await state.set_state(AdminForm.add_task_title)
-
 @dp.message(AdminForm.add_task_title)
 async def process_task_title(message: Message, state: FSMContext):
     await state.update_data(title=message.text)
@@ -1284,22 +4186,1006 @@ async def skip_task_media(message: Message, state: FSMContext):
 async def finalize_task(message: Message, state: FSMContext):
     data = await state.get_data()
     try:
-        with Database() as cursor:
-            cursor.execute(
-                "INSERT INTO tasks (module_id, title, content, file_id) VALUES (?, ?, ?, ?)",
-                (data['module_id'], data['title'], data['content'], data.get('file_id')))
+        task_id = await db.execute(
+            "INSERT INTO tasks (module_id, title, content, file_id) VALUES (?, ?, ?, ?)",
+            (data['module_id'], data['title'], data['content'], data.get('file_id')))
+        catalog.add_task(task_id, data['module_id'], data['title'], data['content'], data.get('file_id'))
         await message.answer("✅ Задание создано!", reply_markup=admin_menu())
     except Exception as e:
         await message.answer(f"❌ Ошибка: {str(e)}")
     await state.clear()
 
+### BLOCK 13.1: COURSE IMPORT ###
+class PackageError(ValueError):
+    """Ошибка разбора или проверки пакета курса."""
+
+
+_KEEP = object()  # поле (медиа, описание) не указано в пакете — оставляем текущее
+IMPORT_MAX_BYTES = 50 * 1024 * 1024
+PHOTO_MEDIA = 'photo'     # обложки курсов и модулей показываются как фото
+DOCUMENT_MEDIA = 'document'  # материалы заданий — документом
+
+
+def _load_manifest(name: str, raw: bytes):
+    if name.endswith('.json'):
+        return json.loads(raw.decode('utf-8-sig'))
+    return yaml.safe_load(raw)
+
+
+def parse_course_package(filename: str, raw: bytes):
+    """Разбирает JSON/YAML/ZIP-пакет и возвращает (курсы, файлы медиа из архива).
+
+    Формат: {"courses": [{"title", "description", "media",
+    "modules": [{"title", "media", "tasks": [{"title", "content", "media"}]}]}]}.
+    media — путь к файлу внутри ZIP или готовый file_id. Если description
+    или media не указаны, при обновлении остаются текущие значения; null
+    их очищает.
+    """
+    name = filename.lower()
+    files: Dict[str, bytes] = {}
+    try:
+        if name.endswith('.zip'):
+            archive = zipfile.ZipFile(io.BytesIO(raw))
+            if sum(info.file_size for info in archive.infolist()) > IMPORT_MAX_BYTES:
+                raise PackageError("Архив слишком большой")
+            manifests = sorted(
+                (n for n in archive.namelist() if n.lower().endswith(('.json', '.yaml', '.yml'))),
+                key=lambda n: n.count('/')
+            )
+            if not manifests:
+                raise PackageError("В архиве нет course.json / course.yaml")
+            base = posixpath.dirname(manifests[0])
+            doc = _load_manifest(manifests[0].lower(), archive.read(manifests[0]))
+            files = {
+                posixpath.relpath(n, base) if base else n: archive.read(n)
+                for n in archive.namelist()
+                if not n.endswith('/') and n != manifests[0]
+            }
+        elif name.endswith(('.json', '.yaml', '.yml')):
+            doc = _load_manifest(name, raw)
+        else:
+            raise PackageError("Поддерживаются файлы .json, .yaml, .yml и .zip")
+    except (zipfile.BadZipFile, UnicodeDecodeError, json.JSONDecodeError, yaml.YAMLError) as e:
+        raise PackageError(f"Не удалось прочитать пакет: {e}")
+    return _validate_package(doc, files), files
+
+
+def _validate_package(doc, files: Dict[str, bytes]) -> List[dict]:
+    errors = []
+
+    def text(item, key, where, required=True):
+        value = item.get(key)
+        if value is None and not required:
+            return None
+        if not isinstance(value, str) or not value.strip():
+            errors.append(f"{where}: поле «{key}» должно быть непустой строкой")
+            return ""
+        return value.strip()
+
+    def media(item, where, kind):
+        if 'media' not in item:
+            return _KEEP
+        ref = item['media']
+        if ref is None:
+            return None
+        if not isinstance(ref, str) or not ref:
+            errors.append(f"{where}: поле «media» должно быть строкой")
+            return None
+        if '.' in ref or '/' in ref:
+            path = posixpath.normpath(ref)
+            if path not in files:
+                errors.append(f"{where}: файл «{ref}» не найден в архиве")
+                return None
+            return ('file', path, kind)
+        return ('file_id', ref, kind)
+
+    def items(parent, key, where):
+        value = parent.get(key, [])
+        if not isinstance(value, list) or not all(isinstance(item, dict) for item in value):
+            errors.append(f"{where}: «{key}» должно быть списком объектов")
+            return []
+        return value
+
+    if isinstance(doc, dict) and 'courses' not in doc:
+        doc = {'courses': [doc]}
+    if not isinstance(doc, dict):
+        raise PackageError("Ожидается объект с полем «courses»")
+
+    courses = []
+    seen_courses = set()
+    for i, course in enumerate(items(doc, 'courses', "пакет")):
+        where = f"courses[{i}]"
+        title = text(course, 'title', where)
+        if title in seen_courses:
+            errors.append(f"{where}: курс «{title}» указан дважды")
+        seen_courses.add(title)
+        modules = []
+        seen_modules = set()
+        for j, module in enumerate(items(course, 'modules', where)):
+            module_where = f"{where}.modules[{j}]"
+            module_title = text(module, 'title', module_where)
+            if module_title in seen_modules:
+                errors.append(f"{module_where}: модуль «{module_title}» указан дважды")
+            seen_modules.add(module_title)
+            tasks = []
+            seen_tasks = set()
+            for k, task in enumerate(items(module, 'tasks', module_where)):
+                task_where = f"{module_where}.tasks[{k}]"
+                task_title = text(task, 'title', task_where)
+                if task_title in seen_tasks:
+                    errors.append(f"{task_where}: задание «{task_title}» указано дважды")
+                seen_tasks.add(task_title)
+                tasks.append({
+                    'title': task_title,
+                    'content': text(task, 'content', task_where),
+                    'media': media(task, task_where, DOCUMENT_MEDIA),
+                })
+            modules.append({
+                'title': module_title,
+                'media': media(module, module_where, PHOTO_MEDIA),
+                'tasks': tasks,
+            })
+        courses.append({
+            'title': title,
+            'description': text(course, 'description', where, required=False) if 'description' in course else _KEEP,
+            'media': media(course, where, PHOTO_MEDIA),
+            'modules': modules,
+        })
+
+    if not courses and not errors:
+        errors.append("пакет: нет ни одного курса")
+    if errors:
+        raise PackageError("\n".join(errors[:20]))
+    return courses
+
+
+def package_media(courses: List[dict], files: Dict[str, bytes]) -> Dict[tuple, Tuple[str, bytes]]:
+    """Заменяет ссылки на файлы архива ссылками по хешу; возвращает {(sha256, kind): (имя, данные)}."""
+    blobs = {}
+
+    def convert(ref):
+        if isinstance(ref, tuple) and ref[0] == 'file':
+            _, path, kind = ref
+            digest = hashlib.sha256(files[path]).hexdigest()
+            blobs[(digest, kind)] = (posixpath.basename(path), files[path])
+            return ('hash', digest, kind)
+        return ref
+
+    for course in courses:
+        course['media'] = convert(course['media'])
+        for module in course['modules']:
+            module['media'] = convert(module['media'])
+            for task in module['tasks']:
+                task['media'] = convert(task['media'])
+    return blobs
+
+
+class ImportReport:
+    LABELS = {'course': "курс", 'module': "модуль", 'task': "задание"}
+
+    def __init__(self, dry_run: bool):
+        self.dry_run = dry_run
+        self.counts: Dict[Tuple[str, str], int] = {}
+        self.lines: List[str] = []
+        self.uploads = 0
+
+    def add(self, kind: str, action: str, path: str):
+        self.counts[(kind, action)] = self.counts.get((kind, action), 0) + 1
+        if action != 'unchanged':
+            icon = "➕" if action == 'created' else "✏️"
+            self.lines.append(f"{icon} {self.LABELS[kind]} «{path}»")
+
+    def render(self, limit: int = 40) -> str:
+        text = "📦 Пробный импорт (ничего не записано):\n\n" if self.dry_run else "✅ Импорт выполнен:\n\n"
+        for kind, title in (('course', "Курсы"), ('module', "Модули"), ('task', "Задания")):
+            text += (
+                f"{title}: ➕ {self.counts.get((kind, 'created'), 0)}"
+                f"  ✏️ {self.counts.get((kind, 'updated'), 0)}"
+                f"  = {self.counts.get((kind, 'unchanged'), 0)}\n"
+            )
+        if self.uploads:
+            text += f"Медиафайлов {'к загрузке' if self.dry_run else 'загружено'}: {self.uploads}\n"
+        if self.lines:
+            text += "\n" + "\n".join(self.lines[:limit])
+            if len(self.lines) > limit:
+                text += f"\n… и еще {len(self.lines) - limit}"
+        return text
+
+
+def sync_course_package(cursor, courses: List[dict], media: Dict[tuple, str],
+                        report: ImportReport, cache_rows=()):
+    """Идемпотентно применяет пакет: сопоставление по названиям, вставки и
+    обновления пачками через executemany. В режиме dry_run только считает diff.
+    """
+    dry_run = report.dry_run
+    if cache_rows and not dry_run:
+        cursor.executemany(
+            "INSERT OR REPLACE INTO media_cache (sha256, kind, file_id) VALUES (?, ?, ?)", cache_rows
+        )
+
+    def resolve(ref, current):
+        if ref is _KEEP:
+            return current
+        if ref is None:
+            return None
+        if ref[0] == 'hash':
+            return media.get((ref[1], ref[2]), f"upload:{ref[1]}")
+        return ref[1]
+
+    def load_courses():
+        return {row['title']: row for row in cursor.execute(
+            "SELECT course_id, title, description, media_id FROM courses")}
+
+    def load_modules():
+        return {(row['course_id'], row['title']): row for row in cursor.execute(
+            "SELECT module_id, course_id, title, media_id FROM modules")}
+
+    def load_tasks():
+        return {(row['module_id'], row['title']): row for row in cursor.execute(
+            "SELECT task_id, module_id, title, content, file_id FROM tasks")}
+
+    # Курсы
+    existing = load_courses()
+    inserts, updates = [], []
+    for course in courses:
+        row = existing.get(course['title'])
+        media_id = resolve(course['media'], row['media_id'] if row else None)
+        description = course['description']
+        if description is _KEEP:
+            description = row['description'] if row else None
+        if row is None:
+            inserts.append((course['title'], description, media_id))
+            report.add('course', 'created', course['title'])
+        elif (row['description'], row['media_id']) != (description, media_id):
+            updates.append((description, media_id, row['course_id']))
+            report.add('course', 'updated', course['title'])
+        else:
+            report.add('course', 'unchanged', course['title'])
+    if not dry_run:
+        cursor.executemany("INSERT INTO courses (title, description, media_id) VALUES (?, ?, ?)", inserts)
+        cursor.executemany("UPDATE courses SET description = ?, media_id = ? WHERE course_id = ?", updates)
+        existing = load_courses()
+    course_ids = {title: row['course_id'] for title, row in existing.items()}
+
+    # Модули
+    existing = load_modules()
+    inserts, updates = [], []
+    for course in courses:
+        course_id = course_ids.get(course['title'])
+        for module in course['modules']:
+            row = existing.get((course_id, module['title']))
+            path = f"{course['title']} / {module['title']}"
+            media_id = resolve(module['media'], row['media_id'] if row else None)
+            if row is None:
+                inserts.append((course_id, module['title'], media_id))
+                report.add('module', 'created', path)
+            elif row['media_id'] != media_id:
+                updates.append((media_id, row['module_id']))
+                report.add('module', 'updated', path)
+            else:
+                report.add('module', 'unchanged', path)
+    if not dry_run:
+        cursor.executemany("INSERT INTO modules (course_id, title, media_id) VALUES (?, ?, ?)", inserts)
+        cursor.executemany("UPDATE modules SET media_id = ? WHERE module_id = ?", updates)
+        existing = load_modules()
+    module_ids = {key: row['module_id'] for key, row in existing.items()}
+
+    # Задания
+    existing = load_tasks()
+    inserts, updates = [], []
+    for course in courses:
+        course_id = course_ids.get(course['title'])
+        for module in course['modules']:
+            module_id = module_ids.get((course_id, module['title']))
+            for task in module['tasks']:
+                row = existing.get((module_id, task['title']))
+                path = f"{course['title']} / {module['title']} / {task['title']}"
+                file_id = resolve(task['media'], row['file_id'] if row else None)
+                if row is None:
+                    inserts.append((module_id, task['title'], task['content'], file_id))
+                    report.add('task', 'created', path)
+                elif (row['content'], row['file_id']) != (task['content'], file_id):
+                    updates.append((task['content'], file_id, row['task_id']))
+                    report.add('task', 'updated', path)
+                else:
+                    report.add('task', 'unchanged', path)
+    if not dry_run:
+        cursor.executemany(
+            "INSERT INTO tasks (module_id, title, content, file_id) VALUES (?, ?, ?, ?)", inserts
+        )
+        cursor.executemany("UPDATE tasks SET content = ?, file_id = ? WHERE task_id = ?", updates)
+    return report
+
+
+async def upload_package_media(chat_id: int, blobs: Dict[tuple, Tuple[str, bytes]]) -> List[tuple]:
+    """Загружает в Telegram медиа, которых еще нет в media_cache; возвращает строки для кэша."""
+    rows = []
+    for (digest, kind), (name, data) in blobs.items():
+        file = BufferedInputFile(data, filename=name)
+        if kind == PHOTO_MEDIA:
+            method = SendPhoto(chat_id=chat_id, photo=file, caption=f"📎 {name}", disable_notification=True)
+        else:
+            method = SendDocument(chat_id=chat_id, document=file, caption=f"📎 {name}", disable_notification=True)
+        sent = await (await outbox.send(method))
+        file_id = sent.photo[-1].file_id if kind == PHOTO_MEDIA else sent.document.file_id
+        rows.append((digest, kind, file_id))
+    return rows
+
+
+async def run_course_import(message: Message, document: types.Document, dry_run: bool) -> ImportReport:
+    buffer = await bot.download(document)
+    loop = asyncio.get_running_loop()
+    courses, files = await loop.run_in_executor(
+        None, parse_course_package, document.file_name or "", buffer.read()
+    )
+    blobs = package_media(courses, files)
+
+    def _cached(cursor):
+        digests = list({digest for digest, _ in blobs})
+        if not digests:
+            return {}
+        rows = cursor.execute(
+            f"SELECT sha256, kind, file_id FROM media_cache WHERE sha256 IN ({','.join('?' * len(digests))})",
+            digests
+        )
+        return {(row['sha256'], row['kind']): row['file_id'] for row in rows}
+
+    media = await db.read(_cached)
+    pending = {key: blob for key, blob in blobs.items() if key not in media}
+    report = ImportReport(dry_run)
+    report.uploads = len(pending)
+    if dry_run:
+        return await db.read(sync_course_package, courses, media, report)
+
+    cache_rows = await upload_package_media(message.chat.id, pending)
+    media.update({(digest, kind): file_id for digest, kind, file_id in cache_rows})
+    await db.transaction(sync_course_package, courses, media, report, cache_rows)
+    await db.read(catalog.load)
+    return report
+
+
+@dp.message(Command("import"))
+async def import_start(message: Message, command: CommandObject, state: FSMContext):
+    if message.from_user.id != int(ADMIN_ID):
+        return
+
+    dry_run = (command.args or "").strip().lower() in ("dry", "dry-run", "check")
+    await state.set_state(AdminForm.import_package)
+    await state.update_data(import_dry_run=dry_run)
+    await message.answer(
+        "Отправьте пакет курса файлом: .json, .yaml или .zip (манифест + медиа)."
+        + ("\nРежим проверки: изменения не будут записаны." if dry_run else ""),
+        reply_markup=cancel_button()
+    )
+
+
+@dp.message(AdminForm.import_package, F.document)
+async def import_package_received(message: Message, state: FSMContext):
+    data = await state.get_data()
+    dry_run = data.get('import_dry_run', False)
+    await state.clear()
+    await process_course_import(message, message.document, dry_run, state)
+
+
+async def process_course_import(message: Message, document: types.Document, dry_run: bool,
+                                state: FSMContext):
+    try:
+        report = await run_course_import(message, document, dry_run)
+    except PackageError as e:
+        await message.answer(f"❌ Пакет не прошел проверку:\n{e}")
+        return
+    except Exception as e:
+        logger.error(f"Ошибка импорта курса: {e}", exc_info=True)
+        await message.answer("❌ Ошибка при импорте, изменения не записаны")
+        return
+
+    kb = None
+    if dry_run:
+        # Документ запоминаем, чтобы применить проверенный пакет без повторной загрузки
+        await state.update_data(import_document=document.model_dump(mode='json'))
+        builder = InlineKeyboardBuilder()
+        builder.button(text="✅ Применить", callback_data="import_apply")
+        builder.button(text="❌ Отмена", callback_data="cancel")
+        kb = builder.as_markup()
+    await message.answer(report.render(), reply_markup=kb or admin_menu())
+
+
+@callbacks.route("import_apply")
+async def import_apply(callback: CallbackQuery, state: FSMContext):
+    if callback.from_user.id != int(ADMIN_ID):
+        return
+
+    data = await state.get_data()
+    if not data.get('import_document'):
+        await callback.answer("⚠️ Пакет не найден, отправьте его снова через /import")
+        return
+    await state.update_data(import_document=None)
+    await callback.answer("⏳ Импортирую...")
+    await callback.message.edit_reply_markup(reply_markup=None)
+    document = types.Document.model_validate(data['import_document'])
+    await process_course_import(callback.message, document, False, state)
+
+
+### BLOCK 14: UPDATE PROCESSING ###
+class ThrottlingMiddleware(BaseMiddleware):
+    """Антифлуд для сообщений и нажатий кнопок.
+
+    У каждого пользователя свой token bucket (rate в секунду, всплеск
+    до burst). Проверка идет при получении апдейта, до очереди
+    планировщика, поэтому флуд одного пользователя не занимает место
+    в очереди остальных. Администратор и проверяющие не ограничиваются:
+    в очереди проверки они быстро отмечают решения и листают страницы.
+
+    Альбом расходует один токен на первую часть, а остальные части идут
+    по отдельному бюджету альбома (не больше album_parts частей, как
+    у Telegram); части отклоненного альбома отбрасываются все. На первое
+    отброшенное сообщение пользователь получает одно предупреждение —
+    следующее только после того, как сообщение снова прошло.
+    """
+
+    MAX_BUCKETS = 10000
+    MAX_ALBUMS = 10000
+
+    def __init__(self, rate: float, burst: float, album_parts: int = 10):
+        self.rate = rate
+        self.burst = burst
+        self.album_parts = album_parts
+        self._buckets: Dict[int, TokenBucket] = {}
+        # (user_id, media_group_id) → сколько частей альбома еще можно принять
+        self._albums: "OrderedDict[tuple, int]" = OrderedDict()
+        self._warned = set()
+
+    def _bucket(self, user_id: int) -> TokenBucket:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_BUCKETS:
+                # Полные корзины ничем не отличаются от новых — их можно выбросить
+                for key in [key for key, value in self._buckets.items() if value.full()]:
+                    del self._buckets[key]
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def _allow_album_part(self, user_id: int, media_group_id: str) -> bool:
+        key = (user_id, media_group_id)
+        left = self._albums.get(key)
+        if left is None:
+            left = self.album_parts if self._bucket(user_id).try_acquire() else 0
+            if len(self._albums) >= self.MAX_ALBUMS:
+                self._albums.popitem(last=False)
+        if left <= 0:
+            self._albums[key] = 0
+            return False
+        self._albums[key] = left - 1
+        return True
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user is None or reviewers.is_reviewer(user.id):
+            return await handler(event, data)
+
+        if event.message and event.message.media_group_id:
+            allowed = self._allow_album_part(user.id, event.message.media_group_id)
+        else:
+            allowed = self._bucket(user.id).try_acquire()
+        if allowed:
+            self._warned.discard(user.id)
+            return await handler(event, data)
+
+        if event.callback_query:
+            THROTTLED_TOTAL.inc("callback")
+            await event.callback_query.answer("⏳ Слишком часто, подождите секунду")
+            return None
+        THROTTLED_TOTAL.inc("message")
+        if event.message and user.id not in self._warned:
+            if len(self._warned) >= self.MAX_BUCKETS:
+                self._warned.clear()
+            self._warned.add(user.id)
+            try:
+                await event.message.answer("⏳ Слишком часто, подождите немного — это сообщение не обработано")
+            except Exception as e:
+                logger.warning(f"Не удалось предупредить {user.id} об антифлуде: {e}")
+        return None
+
+
+throttling = ThrottlingMiddleware(THROTTLE_RATE, THROTTLE_BURST)
+dp.update.outer_middleware(throttling)
+
+
+class UpdateScheduler(BaseMiddleware):
+    """Планировщик апдейтов: параллельно между чатами, строго по порядку внутри чата.
+
+    Апдейт попадает в очередь своего чата, workers обработчиков берут
+    чаты по очереди и выполняют из каждого по одному апдейту, так что
+    шаги FSM одного пользователя никогда не идут одновременно. Всего в
+    очереди и в работе не больше max_pending апдейтов: следующий ждет
+    места, и при polling с detach_updates=True это останавливает
+    чтение getUpdates. Повторное нажатие той же кнопки, пока первое
+    еще в очереди или в работе, подтверждается и отбрасывается.
+
+    Без detach_updates (вебхук, feed_update) вызов ждет обработки и
+    возвращает ее результат, как обычный middleware; запрос вебхука
+    ждет места в очереди так же, как чтение getUpdates.
+
+    С detach_updates ErrorsMiddleware диспетчера уже не видит исключений,
+    поэтому worker сам передает их обработчикам @dp.errors(), а строку
+    aiogram «Update id=… is handled» пишет после обработки, а не при
+    постановке в очередь (см. _QueuedUpdateLogFilter).
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.in_flight = 0
+        self._chats: Dict[Any, deque] = {}
+        self._callbacks = set()
+        self._ready: Optional[asyncio.Queue] = None
+        self._space: Optional[asyncio.Event] = None
+        self._idle: Optional[asyncio.Event] = None
+        self._tasks: List[asyncio.Task] = []
+        # update_id апдейтов, поставленных в очередь без ожидания результата
+        self.detached = set()
+
+    @property
+    def depth(self) -> int:
+        return sum(len(items) for items in self._chats.values())
+
+    def _start(self):
+        if self._ready is None:
+            self._ready = asyncio.Queue()
+            self._space = asyncio.Event()
+            self._space.set()
+            self._idle = asyncio.Event()
+            self._idle.set()
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    @staticmethod
+    def _chat_key(event, data):
+        chat = data.get('event_chat')
+        if chat is not None:
+            return chat.id
+        user = data.get('event_from_user')
+        if user is not None:
+            return user.id
+        return ('update', event.update_id)
+
+    @staticmethod
+    def _callback_key(event):
+        callback = event.callback_query
+        if callback is None:
+            return None
+        return callback.from_user.id, callback.message.message_id if callback.message else None, callback.data
+
+    async def __call__(self, handler, event, data):
+        self._start()
+        callback_key = self._callback_key(event)
+        if callback_key is not None and callback_key in self._callbacks:
+            THROTTLED_TOTAL.inc("duplicate")
+            await event.callback_query.answer()
+            return None
+        if event.callback_query is not None:
+            # Отсчет подтверждения идет с момента получения, а не после ожидания в очереди
+            callback_acks.start(event.callback_query)
+
+        while self.in_flight >= self.max_pending:
+            self._space.clear()
+            await self._space.wait()
+
+        future = None if data.get('detach_updates') else asyncio.get_running_loop().create_future()
+        if future is None:
+            self.detached.add(event.update_id)
+        key = self._chat_key(event, data)
+        self.in_flight += 1
+        self._idle.clear()
+        if callback_key is not None:
+            self._callbacks.add(callback_key)
+        items = self._chats.get(key)
+        if items is None:
+            items = self._chats[key] = deque()
+            self._ready.put_nowait(key)
+        items.append((handler, event, data, time.monotonic(), future, callback_key))
+        if future is None:
+            return None
+        return await future
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            items = self._chats[key]
+            handler, event, data, queued_at, future, callback_key = items.popleft()
+            UPDATE_QUEUE_SECONDS.observe(time.monotonic() - queued_at)
+            result = UNHANDLED
+            try:
+                result = await handler(event, data)
+            except asyncio.CancelledError:
+                if future is not None:
+                    future.cancel()
+                raise
+            except Exception as e:
+                if future is None:
+                    result = await self._handle_error(event, data, e)
+                elif not future.done():
+                    future.set_exception(e)
+            else:
+                if future is not None and not future.done():
+                    future.set_result(result)
+            finally:
+                if future is None:
+                    self.detached.discard(event.update_id)
+                    _AIOGRAM_EVENTS.info(
+                        "Update id=%s is %s. Duration %d ms by bot id=%d",
+                        event.update_id, "handled" if result is not UNHANDLED else "not handled",
+                        (time.monotonic() - queued_at) * 1000, data['bot'].id
+                    )
+                # Чат возвращается в конец очереди: остальные чаты не ждут длинную серию одного
+                if items:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._chats[key]
+                self._callbacks.discard(callback_key)
+                if event.callback_query is not None:
+                    await callback_acks.finish(event.callback_query)
+                self.in_flight -= 1
+                if self.in_flight < self.max_pending:
+                    self._space.set()
+                if not self.in_flight:
+                    self._idle.set()
+
+    @staticmethod
+    async def _handle_error(event, data, error: Exception):
+        """То же, что ErrorsMiddleware диспетчера: исключение уходит в @dp.errors()."""
+        try:
+            response = await dp.propagate_event(
+                update_type="error", event=ErrorEvent(update=event, exception=error), **data
+            )
+        except Exception as e:
+            logger.error(f"Ошибка обработки апдейта {event.update_id}: {e}", exc_info=True)
+            return UNHANDLED
+        if response is UNHANDLED:
+            logger.error(f"Ошибка обработки апдейта {event.update_id}: {error}", exc_info=error)
+        return response
+
+    async def drain(self, timeout: float):
+        if self._idle is None:
+            return
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Остановка: не дождались {self.in_flight} апдейтов")
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._ready = self._space = self._idle = None
+
+
+class AlbumFlushMiddleware(BaseMiddleware):
+    """Досохраняет альбом пользователя перед его следующим апдейтом.
+
+    Альбом собирается по таймеру, и без этого текст, отправленный сразу
+    после него, обработался бы раньше: например, «❌ Отмена» сбросила бы
+    состояние до того, как альбом сохранился как решение. Стоит после
+    планировщика (апдейты чата уже идут по очереди) и до FSM-контекста,
+    чтобы следующий апдейт видел состояние после сохранения альбома.
+    """
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        is_album_part = event.message is not None and event.message.media_group_id is not None
+        if user is not None and not is_album_part and albums.pending(user.id):
+            await albums.flush_user(user.id)
+        return await handler(event, data)
+
+
+class _QueuedUpdateLogFilter(logging.Filter):
+    """Скрывает «is handled» aiogram для апдейта, который только поставлен в очередь."""
+
+    def __init__(self, scheduler: UpdateScheduler):
+        super().__init__()
+        self._scheduler = scheduler
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return not (isinstance(record.msg, str) and record.msg.startswith("Update id=")
+                    and record.args and record.args[0] in self._scheduler.detached)
+
+
+update_scheduler = UpdateScheduler(UPDATE_CONCURRENCY, UPDATE_QUEUE_SIZE)
+dp.update.outer_middleware(update_scheduler)
+_AIOGRAM_EVENTS = logging.getLogger("aiogram.event")
+_AIOGRAM_EVENTS.addFilter(_QueuedUpdateLogFilter(update_scheduler))
+dp.update.outer_middleware(AlbumFlushMiddleware())
+# Dispatcher регистрирует FSMContextMiddleware при создании, то есть до планировщика:
+# тогда raw_state читался бы при получении апдейта, а не когда до него дошла очередь
+# чата. Переносим его после планировщика, чтобы фильтры видели актуальное состояние
+dp.update.outer_middleware.unregister(dp.fsm)
+dp.update.outer_middleware(dp.fsm)
+
+
+class CallbackAckMiddleware(BaseMiddleware):
+    """Подтверждает нажатие кнопки, если обработчик сам не ответил.
+
+    Обработчик, который так и не вызвал callback.answer(...), получает
+    пустой ответ после завершения, и клиент убирает индикатор загрузки.
+    Маршруты с deferred_ack (долгие обработчики без подсказок, если
+    проверка маршрута прошла) подтверждаются раньше: через delay секунд после получения апдейта
+    (планировщик вызывает start() еще до очереди чата). На один
+    callback_query Telegram принимает только один ответ, поэтому у таких
+    маршрутов более поздний callback.answer(text) middleware сессии
+    отправляет обычным сообщением в чат с кнопкой. Ответы остальных
+    обработчиков уходят в Bot API как есть.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        # callback_query_id → был ли уже отправлен ответ
+        self._answered: Dict[str, bool] = {}
+        # callback_query_id → чат для подсказок, опоздавших к раннему подтверждению
+        self._chats: Dict[str, int] = {}
+        self._timers: Dict[str, asyncio.Task] = {}
+        self.request_middleware = _AnswerOnceMiddleware(self._answered, self._chats)
+
+    def start(self, callback: CallbackQuery):
+        if callback.id in self._answered:
+            return
+        self._answered[callback.id] = False
+        if not callbacks.deferred_ack(callback.data or ""):
+            return
+        if callback.message:
+            self._chats[callback.id] = callback.message.chat.id
+        self._timers[callback.id] = asyncio.create_task(self._expire(callback))
+
+    async def _expire(self, callback: CallbackQuery):
+        await asyncio.sleep(self.delay)
+        self._timers.pop(callback.id, None)
+        if self._answered.get(callback.id) is False:
+            await self._acknowledge(callback)
+
+    async def finish(self, callback: CallbackQuery):
+        """Подтверждает нажатие, если никто не ответил, и забывает его."""
+        timer = self._timers.pop(callback.id, None)
+        if timer is not None:
+            timer.cancel()
+        if self._answered.get(callback.id) is False:
+            await self._acknowledge(callback)
+        self._answered.pop(callback.id, None)
+        self._chats.pop(callback.id, None)
+
+    async def _acknowledge(self, callback: CallbackQuery):
+        try:
+            await callback.answer()
+        except Exception as e:
+            logger.warning(f"Не удалось подтвердить callback {callback.id}: {e}")
+
+    async def __call__(self, handler, event, data):
+        self.start(event)
+        try:
+            return await handler(event, data)
+        finally:
+            await self.finish(event)
+
+
+class _AnswerOnceMiddleware(BaseRequestMiddleware):
+    """Повторный answerCallbackQuery для подтвержденного нажатия не уходит в Bot API.
+
+    Для маршрутов с deferred_ack текст такого ответа отправляется
+    сообщением, чтобы итог действия не пропал.
+    """
+
+    def __init__(self, answered: Dict[str, bool], chats: Dict[str, int]):
+        self._answered = answered
+        self._chats = chats
+
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, AnswerCallbackQuery):
+            answered = self._answered.get(method.callback_query_id)
+            if answered:
+                chat_id = self._chats.get(method.callback_query_id)
+                if method.text and chat_id is not None:
+                    await outbox.send(SendMessage(chat_id=chat_id, text=method.text))
+                return True
+            if answered is not None:
+                self._answered[method.callback_query_id] = True
+        return await make_request(bot, method)
+
+
+callback_acks = CallbackAckMiddleware(CALLBACK_ACK_DELAY)
+dp.callback_query.outer_middleware(callback_acks)
+bot.session.middleware(callback_acks.request_middleware)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware: число апдейтов и полное время их обработки по типам."""
+
+    async def __call__(self, handler, event, data):
+        update_type = event.event_type
+        UPDATES_TOTAL.inc(update_type)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATE_SECONDS.observe(time.perf_counter() - start, update_type)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренний middleware: время и ошибки конкретного обработчика."""
+
+    async def __call__(self, handler, event, data):
+        callback = data["handler"].callback
+        if callback is route_callback_query:
+            name = callbacks.handler_name(event.data or "")
+        else:
+            name = callback.__name__
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            HANDLER_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, name)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: задержка и ошибки запросов к Bot API."""
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - start, name)
+
+
+if metrics.enabled:
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    for observer_name, observer in dp.observers.items():
+        if observer_name not in ('update', 'error'):
+            observer.middleware(HandlerMetricsMiddleware())
+    bot.session.middleware(ApiMetricsMiddleware())
+    metrics.gauge("bot_updates_in_flight", "Апдейты в обработке", lambda: update_scheduler.in_flight)
+    metrics.gauge("bot_update_queue_depth", "Апдейты в очереди планировщика", lambda: update_scheduler.depth)
+    metrics.gauge("bot_outbox_depth", "Сообщения в очереди отправки", lambda: outbox.depth)
+    metrics.gauge("bot_profile_cache_size", "Профили пользователей в кеше", lambda: len(profiles))
+
+
+async def metrics_endpoint(request: web.Request):
+    return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+
+class MetricsServer:
+    """Отдельный локальный HTTP-сервер для /metrics (METRICS_HOST:METRICS_PORT)."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/metrics', metrics_endpoint)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Метрики доступны на http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+metrics_server = MetricsServer(METRICS_HOST, METRICS_PORT)
+
+
+@dp.startup()
+async def on_startup(bot: Bot):
+    callbacks.validate(dp)
+    if BOT_MODE == 'webhook':
+        if WEBHOOK_BASE_URL:
+            await bot.set_webhook(
+                f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+        else:
+            logger.warning("WEBHOOK_BASE_URL не задан, вебхук не регистрируется")
+    else:
+        # getUpdates не работает, пока установлен вебхук
+        await bot.delete_webhook()
+    # В режиме вебхука на том же порту /metrics отдает основное приложение
+    if metrics.enabled and not (BOT_MODE == 'webhook' and METRICS_PORT == WEB_PORT):
+        await metrics_server.start()
+    await broadcasts.resume()
+    reviewers.start()
+    cache_sync.start()
+
+
+@dp.shutdown()
+async def on_shutdown():
+    await update_scheduler.drain(SHUTDOWN_TIMEOUT)
+    await update_scheduler.close()
+    # Незавершенные рассылки остаются в статусе running и продолжатся после запуска
+    await albums.close()
+    # FSMContextMiddleware.close уже сохранил FSM до этого обработчика, а апдейты
+    # из очереди могли изменить состояния после — сохраняем еще раз
+    await fsm_storage.close()
+    await reviewers.stop()
+    await cache_sync.stop()
+    await broadcasts.stop()
+    await exports.stop()
+    await outbox.close(SHUTDOWN_TIMEOUT)
+    await metrics_server.stop()
+
+
+async def healthz(request: web.Request):
+    try:
+        await db.fetchone("SELECT 1")
+    except Exception as e:
+        logger.error(f"Health check failed: {e}")
+        return web.json_response({"status": "error"}, status=503)
+    return web.json_response({
+        "status": "ok",
+        "in_flight": update_scheduler.in_flight,
+        "outbox": outbox.metrics()
+    })
+
+
+def run_webhook():
+    if not WEBHOOK_SECRET:
+        logger.warning("WEBHOOK_SECRET не задан, запросы к вебхуку не проверяются")
+
+    app = web.Application()
+    app.router.add_get('/healthz', healthz)
+    if metrics.enabled and METRICS_PORT == WEB_PORT:
+        app.router.add_get('/metrics', metrics_endpoint)
+
+    async def drain_updates(_app):
+        await update_scheduler.drain(SHUTDOWN_TIMEOUT)
+        # Исходящие нужно отправить до закрытия сессии бота
+        await albums.close()
+        await fsm_storage.close()
+        await reviewers.stop()
+        await cache_sync.stop()
+        await broadcasts.stop()
+        await exports.stop()
+        await outbox.close(SHUTDOWN_TIMEOUT)
+
+    # Порядок остановки: дождаться апдейтов → закрыть сессию бота → shutdown диспетчера
+    app.on_shutdown.append(drain_updates)
+    # Ответ на запрос вебхука отдается после обработки апдейта: иначе aiogram
+    # запускает обработку в фоне, запрос сразу получает 200, и UPDATE_QUEUE_SIZE
+    # ничего не ограничивает. Пока очередь планировщика полна, запрос ждет места,
+    # и Telegram не присылает новые апдейты сверх max_connections открытых запросов
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+        handle_in_background=False
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    web.run_app(app, host=WEB_HOST, port=WEB_PORT, shutdown_timeout=SHUTDOWN_TIMEOUT)
+
+
    ### BLOCK 15 (UPDATED): STARTUP ###
 if __name__ == '__main__':
     logger.info("Бот запускается...")
     try:
-        dp.run_polling(bot)
+        init_db()
+        if BOT_MODE == 'webhook':
+            run_webhook()
+        else:
+            # Апдейт из getUpdates только ставится в очередь планировщика;
+            # при заполненной очереди чтение getUpdates ждет
+            dp.run_polling(bot, handle_as_tasks=False, detach_updates=True)
     except Exception as e:
         logger.error(f"Ошибка запуска: {e}")
     finally:
-
-        pass  # Соединение закрывается автоматически через контекстный менеджер
+        db.close()
+        db_pool.close()